@@ -0,0 +1,88 @@
+import sqlite3 as sq
+import threading
+import datetime
+import zlib
+
+dt_format = "%Y-%m-%dT%H:%M:%S"
+busy_timeout_s = 30.0  # how long a write waits for another process to release its lock
+
+_caches = {}  # filename -> ArticleCache, one per process
+_caches_lock = threading.Lock()
+
+
+class ArticleCache(object):
+    """A local store of extracted article text, keyed by URL
+
+    Text is kept zlib-compressed in its own SQLite database so that the news database (and its backups) stay small.
+    A URL whose page has no extractable content is stored with content None, so it is not fetched again either.
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the cache database. It is created if it does not exist
+    """
+
+    def __init__(self, db_filename):
+        self.db_filename = db_filename
+        self._lock = threading.Lock()
+        # Several processes (e.g. parallel rescoring workers) may write to the same cache
+        self._conn = sq.connect(db_filename, check_same_thread=False, timeout=busy_timeout_s)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS article_bodies (
+                              url TEXT PRIMARY KEY,
+                              content BLOB,
+                              fetched_at DATETIME,
+                              extractor_version INTEGER
+                              )
+                           ''')
+        self._conn.commit()
+
+    def get(self, url):
+        """Look up the stored text of a URL
+
+        Returns
+        ----------------
+        entry : None if url is not in the cache, otherwise a tuple (content, fetched_at, extractor_version) where
+                content is a string or None, fetched_at is a string of the form YYYY-MM-DDTHH:MM:SS
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT content, fetched_at, extractor_version FROM article_bodies WHERE url=?',
+                                     (url,)).fetchone()
+        if row is None:
+            return None
+        content, fetched_at, extractor_version = row
+        if content is not None:
+            content = zlib.decompress(content).decode('utf-8')
+        return content, fetched_at, extractor_version
+
+    def put_many(self, entries, extractor_version):
+        """Store the text of many URLs in a single transaction
+
+        Parameters
+        ----------------
+        entries : An iterable of tuples (url, content), where content is a string, or None if the URL has no content
+        extractor_version : An int, the version of the extractor which produced the content
+        """
+        fetched_at = datetime.datetime.strftime(datetime.datetime.now(), dt_format)
+        rows = [(url, None if content is None else zlib.compress(content.encode('utf-8')), fetched_at,
+                 extractor_version) for url, content in entries]
+        with self._lock:
+            with self._conn:
+                self._conn.executemany('''INSERT OR REPLACE INTO article_bodies(url, content, fetched_at,
+                                          extractor_version) VALUES(?, ?, ?, ?)''', rows)
+
+    def put(self, url, content, extractor_version):
+        """Store the text of a single URL, see put_many"""
+        self.put_many([(url, content)], extractor_version)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_article_cache(db_filename):
+    """Get the process-wide ArticleCache stored in db_filename, opening it on first use"""
+    with _caches_lock:
+        cache = _caches.get(db_filename)
+        if cache is None:
+            cache = _caches[db_filename] = ArticleCache(db_filename)
+        return cache
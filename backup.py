@@ -0,0 +1,446 @@
+import argparse
+import datetime
+import glob
+import os
+import shutil
+import sqlite3 as sq
+import struct
+import threading
+import metrics
+import news_db
+
+pages_per_step = 256  # pages copied per step of an online backup; other connections can write between steps
+step_sleep_s = 0.005  # pause between steps, so that a backup does not hog the disk
+max_restarts = 5  # times a stepped backup may restart because of writes, before copying in one step instead
+retention = 3  # backup generations kept per database, the newest ones
+backup_dir = None  # directory of the backups, by default the directory of each database
+wal_shipping = False  # if True, back up by shipping new WAL frames, taking a full snapshot only every snapshot_period_h
+snapshot_period_h = 24.0  # with wal_shipping, the age at which a generation is replaced by a new full snapshot
+
+_wal_header = struct.Struct('>8I')  # magic, version, page size, checkpoint sequence, salt-1, salt-2, checksum-1, -2
+_frame_header = struct.Struct('>6I')  # page number, database size after commit (0 if not a commit), salt-1, salt-2,
+# checksum-1, checksum-2
+_wal_magic = (0x377f0682, 0x377f0683)  # checksums of little-endian, big-endian words
+_log_magic = b'QNEWSWAL'
+_log_header = struct.Struct('>8sI')  # _log_magic, page size
+_log_record = struct.Struct('>II')  # page number, database size after commit (0 if not a commit), then the page
+_stamp_format = '%Y%m%dT%H%M%S.%f'
+
+_lock = threading.Lock()
+_threads = {}  # db_filename -> thread running backups of it
+_pending = set()  # db_filenames whose backups were requested while one was running
+_shippers = {}  # db_filename -> WalShipper
+
+
+def configure(**settings):
+    """Change the backup settings (pages_per_step, step_sleep_s, max_restarts, retention, backup_dir, wal_shipping or
+    snapshot_period_h). Call it before the news database is first opened, since WAL shipping turns off the automatic
+    checkpoints of news_db connections (the shipper checkpoints once it has copied the frames instead).
+
+    Example
+    ------------------
+    >>> configure(retention=7, wal_shipping=True)
+    """
+    for name, value in settings.items():
+        if name not in ('pages_per_step', 'step_sleep_s', 'max_restarts', 'retention', 'backup_dir', 'wal_shipping',
+                        'snapshot_period_h'):
+            raise ValueError('Unknown backup setting: {}'.format(name))
+        globals()[name] = value
+    news_db.wal_autocheckpoint = 0 if wal_shipping else 1000
+
+
+def _prefix(db_filename):
+    directory = os.path.dirname(os.path.abspath(db_filename)) if backup_dir is None else backup_dir
+    return os.path.join(directory, os.path.basename(db_filename))
+
+
+def generations(db_filename):
+    """The backup generations of a database, oldest first
+
+    A generation is a snapshot <db_filename>.<time>.bckup of the whole database, plus, with WAL shipping, a log
+    <db_filename>.<time>.wal of the transactions committed after it.
+
+    Returns
+    ----------------
+    generations : A list of tuples (snapshot filename, log filename or None)
+    """
+    prefix = _prefix(db_filename)
+    result = []
+    for snapshot_filename in sorted(glob.glob(glob.escape(prefix) + '.*.bckup')):
+        log_filename = snapshot_filename[:-len('.bckup')] + '.wal'
+        result.append((snapshot_filename, log_filename if os.path.exists(log_filename) else None))
+    return result
+
+
+def prune(db_filename, keep=None):
+    """Delete all but the newest keep (by default, retention) backup generations of a database"""
+    keep = retention if keep is None else keep
+    old = generations(db_filename)
+    for snapshot_filename, log_filename in old[:max(len(old) - keep, 0)]:
+        os.remove(snapshot_filename)
+        if log_filename is not None:
+            os.remove(log_filename)
+
+
+def _copy(conn, dest_filename):
+    """Copy the database of conn into dest_filename with the online backup API, pages_per_step pages at a time
+
+    Each step reads a consistent snapshot, and other connections can write between steps. A write by another
+    connection restarts the copy, so after max_restarts restarts the rest is copied in one step (which in WAL mode
+    still does not block writers, only holds back checkpoints while it runs).
+    """
+    restarts = [0, None]  # restarts so far, pages remaining after the last step
+
+    def progress(status, remaining, total):
+        if restarts[1] is not None and remaining > restarts[1]:
+            restarts[0] += 1
+            if restarts[0] > max_restarts:
+                raise _TooManyRestarts()
+        restarts[1] = remaining
+
+    dest = sq.connect(dest_filename)
+    try:
+        try:
+            conn.backup(dest, pages=pages_per_step, progress=progress, sleep=step_sleep_s)
+        except _TooManyRestarts:
+            conn.backup(dest, pages=-1)
+    finally:
+        dest.close()
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def snapshot(db_filename, dest_filename):
+    """Copy a live database into dest_filename without blocking its readers or writers, replacing dest_filename
+    atomically once the copy is complete (so that a backup is never half written)
+    """
+    tmp_filename = dest_filename + '.tmp'
+    conn = sq.connect(db_filename, timeout=news_db.busy_timeout_s)
+    try:
+        _copy(conn, tmp_filename)
+        os.replace(tmp_filename, dest_filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    finally:
+        conn.close()
+
+
+def _checksum(data, s0, s1, endian):
+    """SQLite's WAL checksum of data, continuing from s0, s1"""
+    words = struct.unpack('{0}{1:d}I'.format(endian, len(data) // 4), data)
+    for i in range(0, len(words), 2):
+        s0 = (s0 + words[i] + s1) & 0xffffffff
+        s1 = (s1 + words[i + 1] + s0) & 0xffffffff
+    return s0, s1
+
+
+class WalShipper(object):
+    """Backs up a database by shipping the frames its write-ahead log gains between calls of ship
+
+    Each generation starts from a full snapshot, and a log of the frames of every transaction committed since is
+    appended to on each ship, so a ship costs only as much as was written since the previous one, however large the
+    database grows. Frames are copied while holding the write lock, and the shipper then checkpoints them itself,
+    with the automatic checkpoints of the news_db connections turned off (see configure), so the WAL does not grow
+    without bound.
+
+    Between ships, the shipper holds a read transaction open. No connection, in this process or another (e.g. the read
+    connection of rescore_parallel, or score_articles.py), can checkpoint frames past it, so the WAL cannot be
+    restarted over frames which were not shipped yet. After a ship that checkpointed the whole WAL, the read
+    transaction reads from the database file alone, which blocks every checkpoint, so the WAL can be restarted at most
+    once, over shipped frames only, before the next ship. Otherwise the salt and checkpoint sequence of the WAL header
+    must be those of the last shipped frame; if they differ, the chain is broken and ship starts a new generation
+    from a full snapshot.
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the database
+    """
+
+    def __init__(self, db_filename):
+        self.db_filename = db_filename
+        self.log_filename = None
+        self.started = None  # datetime the current generation started
+        self._state = None  # (checkpoint sequence, salt-1, salt-2, offset, checksum) after the last shipped frame
+        self._checkpointed = False  # True if the WAL was completely checkpointed after the last ship, and pinned since
+        # The writer connection holds the write lock while frames are copied, the second one checkpoints them then,
+        # and the third one pins the WAL between ships
+        self._conn = sq.connect(db_filename, timeout=news_db.busy_timeout_s, isolation_level=None,
+                                check_same_thread=False)
+        self._checkpoint_conn = sq.connect(db_filename, timeout=news_db.busy_timeout_s, isolation_level=None,
+                                           check_same_thread=False)
+        self._pin_conn = sq.connect(db_filename, timeout=news_db.busy_timeout_s, isolation_level=None,
+                                    check_same_thread=False)
+        self._page_size = self._conn.execute('PRAGMA page_size').fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+        self._checkpoint_conn.close()
+        self._pin_conn.close()
+
+    def _pin(self):
+        """Start the read transaction which keeps other connections from checkpointing frames that were not shipped"""
+        self._pin_conn.execute('BEGIN')
+        self._pin_conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+
+    def _unpin(self):
+        if self._pin_conn.in_transaction:
+            self._pin_conn.execute('ROLLBACK')
+
+    def _read_frames(self):
+        """The committed frames after the last shipped one, as a list of (page number, commit size, page), or None if
+        the chain of frames is broken. Call with the write lock held.
+        """
+        try:
+            with open(self.db_filename + '-wal', 'rb') as infile:
+                header = infile.read(_wal_header.size)
+                if len(header) < _wal_header.size:  # no WAL yet, or truncated after a complete checkpoint
+                    return [] if self._state is None or self._checkpointed else None
+                magic, _, page_size, sequence, salt1, salt2, check1, check2 = _wal_header.unpack(header)
+                if magic not in _wal_magic:
+                    raise ValueError('{} is not a write-ahead log'.format(self.db_filename + '-wal'))
+                if page_size != self._page_size:
+                    raise ValueError('The page size of {} has changed'.format(self.db_filename))
+                endian = '>' if magic & 1 else '<'
+                if self._state is not None and self._state[:3] == (sequence, salt1, salt2):
+                    offset, checksum = self._state[3:]
+                elif self._state is None or self._checkpointed:  # a WAL restarted over shipped frames only
+                    offset, checksum = _wal_header.size, (check1, check2)
+                    if _checksum(header[:24], 0, 0, endian) != checksum:
+                        return [] if self._state is None else None
+                else:
+                    return None
+                infile.seek(offset)
+                data = infile.read()
+        except FileNotFoundError:
+            return [] if self._state is None or self._checkpointed else None
+
+        frames, committed = [], []
+        frame_size = _frame_header.size + page_size
+        for start in range(0, len(data) - frame_size + 1, frame_size):
+            page_number, commit_size, frame_salt1, frame_salt2, check1, check2 = _frame_header.unpack_from(data, start)
+            if (frame_salt1, frame_salt2) != (salt1, salt2):
+                break
+            page = data[start + _frame_header.size:start + frame_size]
+            checksum = _checksum(data[start:start + 8] + page, checksum[0], checksum[1], endian)
+            if checksum != (check1, check2):
+                break
+            frames.append((page_number, commit_size, page))
+            if commit_size:
+                committed.extend(frames)
+                frames = []
+                self._state = (sequence, salt1, salt2, offset + start + frame_size, checksum)
+        if self._state is None or self._state[:3] != (sequence, salt1, salt2):
+            self._state = (sequence, salt1, salt2, offset, checksum)
+        return committed
+
+    def _ship(self, log_filename):
+        """Append the frames committed since the last ship to a log (or skip them if log_filename is None), then
+        checkpoint them
+
+        Returns
+        ----------------
+        n_frames : An int, the number of frames shipped, or None if the chain of frames is broken
+        """
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            frames = self._read_frames()
+            if frames is None:
+                return None
+            if frames and log_filename is not None:
+                with open(log_filename, 'ab') as outfile:
+                    if outfile.tell() == 0:
+                        outfile.write(_log_header.pack(_log_magic, self._page_size))
+                    for page_number, commit_size, page in frames:
+                        outfile.write(_log_record.pack(page_number, commit_size))
+                        outfile.write(page)
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+            # Still holding the write lock, so that no frame is committed between the checkpoint and the new pin
+            self._checkpointed = False
+            self._unpin()
+            busy, n_log, n_checkpointed = self._checkpoint_conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+            self._pin()
+            self._checkpointed = busy == 0 and n_log == n_checkpointed
+            return len(frames)
+        finally:
+            self._conn.execute('ROLLBACK')
+
+    def _start_generation(self):
+        """Take a full snapshot, and start a log of the transactions after it"""
+        self._state = None
+        if self._ship(None) is None:  # find the end of the WAL, to ship from there once the snapshot is taken
+            raise RuntimeError('Could not read the write-ahead log of {}'.format(self.db_filename))
+        started = datetime.datetime.now()
+        prefix = '{0}.{1}'.format(_prefix(self.db_filename), started.strftime(_stamp_format))
+        try:
+            _copy(self._conn, prefix + '.bckup.tmp')
+            # The snapshot is at least as new as the WAL position found above, so replaying the log from there
+            # brings it to the state of the last transaction shipped
+            if self._ship(prefix + '.wal.tmp') is None:
+                return False
+            if os.path.exists(prefix + '.wal.tmp'):
+                os.replace(prefix + '.wal.tmp', prefix + '.wal')
+            else:
+                with open(prefix + '.wal', 'wb') as outfile:
+                    outfile.write(_log_header.pack(_log_magic, self._page_size))
+            os.replace(prefix + '.bckup.tmp', prefix + '.bckup')
+        finally:
+            for tmp_filename in (prefix + '.bckup.tmp', prefix + '.wal.tmp'):
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+        self.log_filename = prefix + '.wal'
+        self.started = started
+        prune(self.db_filename)
+        return True
+
+    def ship(self):
+        """Ship the transactions committed since the last call, starting a new generation if there is none yet, it
+        is older than snapshot_period_h, or the chain of frames is broken
+
+        Returns
+        ----------------
+        n_frames : An int, the number of frames shipped (0 when a new generation starts)
+        """
+        if self.started is not None and (datetime.datetime.now() - self.started).total_seconds() < \
+                snapshot_period_h * 3600:
+            n_frames = self._ship(self.log_filename)
+            if n_frames is not None:
+                metrics.inc('wal_frames_shipped_total', n_frames)
+                return n_frames
+            print('WAL of {} was restarted before it was shipped, starting a new backup'.format(self.db_filename))
+        for _ in range(max_restarts):
+            if self._start_generation():
+                metrics.inc('backup_snapshots_total')
+                return 0
+        raise RuntimeError('Could not start a backup of {}: its WAL keeps being restarted'.format(self.db_filename))
+
+
+def backup_db(db_filename):
+    """Back up a database now, with a rotating snapshot or (if wal_shipping) by shipping its new WAL frames"""
+    with metrics.timer('backup_seconds'):
+        if wal_shipping:
+            with _lock:
+                shipper = _shippers.get(db_filename)
+                if shipper is None:
+                    shipper = _shippers[db_filename] = WalShipper(db_filename)
+            shipper.ship()
+        else:
+            snapshot(db_filename, '{0}.{1}.bckup'.format(_prefix(db_filename),
+                                                         datetime.datetime.now().strftime(_stamp_format)))
+            metrics.inc('backup_snapshots_total')
+            prune(db_filename)
+
+
+def _run_backups(db_filename):
+    while True:
+        try:
+            backup_db(db_filename)
+        except Exception as e:
+            metrics.inc('backup_errors_total')
+            print('WARNING: could not back up {0}: {1!r}'.format(db_filename, e))
+        with _lock:
+            if db_filename in _pending:
+                _pending.discard(db_filename)
+                continue
+            del _threads[db_filename]
+            return
+
+
+def request_backup(db_filename):
+    """Back up a database on a background thread, so that the caller (e.g. the tweet loop) does not wait for it
+
+    A request made while a backup of the same database is running is served by one more backup after it, however many
+    such requests are made.
+    """
+    with _lock:
+        if db_filename in _threads:
+            _pending.add(db_filename)
+            return
+        thread = _threads[db_filename] = threading.Thread(target=_run_backups, args=(db_filename,),
+                                                          name='backup', daemon=True)
+        thread.start()
+
+
+def wait():
+    """Wait for the requested backups to finish, then close the connections of the WAL shippers"""
+    while True:
+        with _lock:
+            threads = list(_threads.values())
+        if not threads:
+            break
+        for thread in threads:
+            thread.join()
+    with _lock:
+        for shipper in _shippers.values():
+            shipper.close()
+        _shippers.clear()
+
+
+def restore(db_filename, dest_filename, generation=-1):
+    """Rebuild a database from a backup generation: its snapshot, with the transactions of its log (if any) replayed
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the database which was backed up
+    dest_filename : A string, the name of the database to write. It must not be open, and is replaced atomically
+    generation : An int, the index of the generation in generations(db_filename), by default the newest one
+
+    Returns
+    ----------------
+    n_transactions : An int, the number of transactions replayed from the log
+    """
+    snapshot_filename, log_filename = generations(db_filename)[generation]
+    tmp_filename = dest_filename + '.tmp'
+    shutil.copyfile(snapshot_filename, tmp_filename)
+    n_transactions = 0
+    try:
+        with open(tmp_filename, 'r+b') as outfile:
+            if log_filename is not None:
+                with open(log_filename, 'rb') as infile:
+                    magic, page_size = _log_header.unpack(infile.read(_log_header.size))
+                    if magic != _log_magic:
+                        raise ValueError('{} is not a WAL shipping log'.format(log_filename))
+                    pages = []
+                    while True:
+                        record = infile.read(_log_record.size)
+                        page = infile.read(page_size)
+                        if len(record) < _log_record.size or len(page) < page_size:
+                            break  # the end of the log, or a transaction cut short by a crash while shipping it
+                        page_number, commit_size = _log_record.unpack(record)
+                        pages.append((page_number, page))
+                        if commit_size:
+                            for page_number, page in pages:
+                                outfile.seek((page_number - 1) * page_size)
+                                outfile.write(page)
+                            outfile.truncate(commit_size * page_size)
+                            pages = []
+                            n_transactions += 1
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_filename, dest_filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+    return n_transactions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Back up the news database, or restore it from a backup.")
+    parser.add_argument('-db_filename', default='news.db', type=str, help="Name of news database. Default = news.db")
+    parser.add_argument('-backup_dir', default=None, type=str,
+                        help="Directory of the backups. Default: the directory of the database")
+    parser.add_argument('-restore', default=None, type=str,
+                        help="Restore the newest backup into this file, instead of backing up")
+    args = parser.parse_args()
+
+    configure(backup_dir=args.backup_dir)
+    if args.restore is None:
+        backup_db(args.db_filename)
+        print('Backed up {0} to {1}'.format(args.db_filename, generations(args.db_filename)[-1][0]))
+    else:
+        n = restore(args.db_filename, args.restore)
+        print('Restored {0} to {1} ({2} transactions replayed)'.format(args.db_filename, args.restore, n))
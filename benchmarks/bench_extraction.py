@@ -0,0 +1,70 @@
+import argparse
+import os
+import re
+import timeit
+import tracemalloc
+from bs4 import BeautifulSoup
+from get_full_content import extract_story
+from sources import SourceRegistry
+from benchmarks.pages import fixture_filename
+
+
+def legacy_extract_story(html, class_matcher):
+    """The two-pass extraction get_url_content used before extract_story, kept for comparison"""
+    soup = BeautifulSoup(html, "lxml")
+    story_raw = BeautifulSoup(''.join([str(s) for s in soup.find_all(class_=class_matcher)]), 'lxml')
+    return re.sub('<[^<>]*>', '', ' '.join([str(s) for s in story_raw.find_all('p')]))
+
+
+def peak_memory(extract, html, class_matcher):
+    """Peak memory (bytes) allocated while extracting a story"""
+    tracemalloc.start()
+    extract(html, class_matcher)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def bench_extraction(url_lookup='url_content_lookup.csv', number=20):
+    """Time legacy and single-pass extraction on the saved page of each source in the URL lookup table
+
+    Parameters
+    ----------------
+    url_lookup : A string, the path to the URL lookup table
+    number : An int, the number of extractions timed per page
+
+    Returns
+    ----------------
+    results : A list of tuples (keyword, legacy ms per page, single-pass ms per page, legacy peak KiB,
+              single-pass peak KiB)
+    """
+    results = []
+    for source in SourceRegistry(url_lookup).sources:
+        filename = fixture_filename(source)
+        if not os.path.exists(filename):
+            print('No fixture for {0} ({1}), skipping'.format(source.source_id, filename))
+            continue
+        with open(filename, 'rb') as infile:
+            html = infile.read()
+        timings = []
+        for extract in (legacy_extract_story, extract_story):
+            seconds = min(timeit.repeat(lambda: extract(html, source.class_matcher), number=number, repeat=3))
+            timings.append(1e3 * seconds / number)
+        memory = [peak_memory(extract, html, source.class_matcher) / 1024.
+                  for extract in (legacy_extract_story, extract_story)]
+        results.append((source.keyword, timings[0], timings[1], memory[0], memory[1]))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark article extraction on saved pages of each news source.")
+    parser.add_argument('-url_path', default='url_content_lookup.csv', type=str,
+                        help="Directory of the url lookup table")
+    parser.add_argument('-number', default=20, type=int, help="Extractions timed per page (default = 20)")
+    args = parser.parse_args()
+
+    print('{0:<20}{1:>12}{2:>12}{3:>10}{4:>14}{5:>14}'.format('source', 'legacy ms', 'single ms', 'speedup',
+                                                            'legacy KiB', 'single KiB'))
+    for keyword, legacy_ms, single_ms, legacy_kib, single_kib in bench_extraction(args.url_path, args.number):
+        print('{0:<20}{1:>12.2f}{2:>12.2f}{3:>9.1f}x{4:>14.0f}{5:>14.0f}'.format(
+            keyword, legacy_ms, single_ms, legacy_ms / single_ms, legacy_kib, single_kib))
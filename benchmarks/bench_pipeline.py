@@ -0,0 +1,204 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+import get_articles
+import get_full_content
+import http_client
+import score_articles
+import tweeting
+from benchmarks.corpus import Corpus
+from benchmarks.standin import Standin, newsapi_url
+
+stage_names = ('get_many_results', 'get_url_content', 'score_all', 'update_news_db', 'tweet_news')
+
+
+class NullTwitter(object):
+    """Stands in for a tweepy.api.API, keeping the statuses it is asked to post"""
+
+    def __init__(self):
+        self.statuses = []
+
+    def update_status(self, status):
+        self.statuses.append(status)
+
+
+class StageTimer(object):
+    """Accumulates the time spent in, and the peak memory allocated by, the calls of one stage
+
+    Peak memory is what the calls allocated above what was already allocated when each started, measured with
+    tracemalloc if it is tracing (so it counts Python allocations only, not e.g. lxml's), otherwise None.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.peak_bytes = 0 if tracemalloc.is_tracing() else None
+
+    def call(self, func, *args, **kwargs):
+        if self.peak_bytes is not None:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.seconds += time.perf_counter() - start
+        if self.peak_bytes is not None:
+            self.peak_bytes = max(self.peak_bytes, tracemalloc.get_traced_memory()[1] - baseline)
+        return result
+
+    def result(self, size, items, unit):
+        return {'size': size, 'stage': self.name, 'seconds': self.seconds, 'items': items, 'unit': unit,
+                'per_s': items / self.seconds if self.seconds > 0 else float('inf'),
+                'peak_mib': None if self.peak_bytes is None else self.peak_bytes / 2. ** 20,
+                'maxrss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2. ** 10}
+
+
+def bench_size(corpus, workdir, qaly_path, url_path, stages=stage_names, max_fetches=2000, chunk_size=10000,
+               n_tweets=100, fetch_workers=8, page_workers=4):
+    """Time each stage of the pipeline on a corpus, served by a Standin which http_client is already pointed at
+
+    Parameters
+    ----------------
+    corpus : A Corpus
+    workdir : A string, an empty directory for the databases
+    qaly_path : A string, directory of the QALY table
+    url_path : A string, directory of the url lookup table
+    stages : A collection of strings, the names of the stages to run, see stage_names
+    max_fetches : An int, the number of articles get_url_content is timed on, at most
+    chunk_size : An int, the number of articles scored and inserted per call of score_all and update_news_db
+    n_tweets : An int, the number of tweets timed after the first
+    fetch_workers : An int, see get_articles.get_many_results
+    page_workers : An int, see get_articles.get_many_results
+
+    Returns
+    ----------------
+    results : A list of dicts, one per stage, see StageTimer.result
+    """
+    n = len(corpus)
+    results = []
+    tweet_db = None
+
+    if 'get_many_results' in stages:
+        timer = StageTimer('get_many_results')
+        db_filename = os.path.join(workdir, 'ingest.db')
+        tweeting.create_db(db_filename, tweeting.news_create_str)
+        stats_before = http_client.pool_stats()
+        timer.call(get_articles.get_many_results, '', db_filename, qaly_path, url_path,
+                   page_limit_per_request=int(math.ceil(n / 100.)), results_per_page=100,
+                   cache_filename=os.path.join(workdir, 'ingest_cache.db'), fetch_workers=fetch_workers,
+                   page_workers=page_workers, requests_per_s=1e6)
+        stats = http_client.pool_stats()
+        result = timer.result(n, n, 'articles')
+        result['http'] = {key: stats[key] - stats_before.get(key, 0) for key in stats}
+        results.append(result)
+        tweet_db = db_filename
+
+    if 'get_url_content' in stages:
+        timer = StageTimer('get_url_content')
+        urls = [corpus.url(i) for i in range(n) if corpus.source(i) is not None][:max_fetches]
+        for url in urls:
+            timer.call(get_full_content.get_url_content, url_path, url)
+        results.append(timer.result(n, len(urls), 'articles'))
+
+    if 'score_all' in stages or 'update_news_db' in stages:
+        scorer = score_articles.load_qaly_scorer(qaly_path)
+        db_filename = os.path.join(workdir, 'update.db')
+        tweeting.create_db(db_filename, tweeting.news_create_str)
+        score_timer, update_timer = StageTimer('score_all'), StageTimer('update_news_db')
+        for start in range(0, n, chunk_size):
+            article_dict = corpus.article_dict(start, start + chunk_size)
+            if 'score_all' in stages:
+                article_dict = score_timer.call(score_articles.score_all, article_dict, scorer)
+            else:
+                article_dict = score_articles.score_all(article_dict, scorer)
+            if 'update_news_db' in stages:
+                update_timer.call(get_articles.update_news_db, db_filename, article_dict, scorer)
+        if 'score_all' in stages:
+            results.append(score_timer.result(n, n, 'articles'))
+        if 'update_news_db' in stages:
+            results.append(update_timer.result(n, n, 'articles'))
+            tweet_db = tweet_db or db_filename
+
+    if 'tweet_news' in stages and tweet_db is not None:
+        twitter = NullTwitter()
+        # A refresh period this long means tweet_news only checks whether the database is out of date
+        kwargs = dict(tweet_time_window=2 * corpus.span_hours, news_refresh_period=1e9)
+        timer = StageTimer('tweet_news (first)')
+        timer.call(tweeting.tweet_news, twitter, '', qaly_path, url_path, tweet_db, **kwargs)
+        results.append(timer.result(n, n, 'articles'))
+        timer = StageTimer('tweet_news')
+        for _ in range(n_tweets):
+            timer.call(tweeting.tweet_news, twitter, '', qaly_path, url_path, tweet_db, **kwargs)
+        results.append(timer.result(n, n_tweets, 'tweets'))
+
+    return results
+
+
+def bench_pipeline(sizes, qaly_path, url_path, stages=stage_names, delay_s=0.0, **kwargs):
+    """Run bench_size on a corpus of each size, each behind its own Standin and in its own temporary directory
+
+    Returns
+    ----------------
+    results : A list of dicts, see StageTimer.result. Where both ran on the same database, a row 'end to end' adds up
+              the time taken to build the news database with get_many_results and to post the first tweet from it
+    """
+    results = []
+    for size in sizes:
+        corpus = Corpus(url_path, size)
+        with Standin(corpus, delay_s=delay_s) as standin, tempfile.TemporaryDirectory() as workdir:
+            http_client.configure(proxy_url=standin.proxy_url)
+            get_articles.newsapi_url = newsapi_url
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                size_results = bench_size(corpus, workdir, qaly_path, url_path, stages=stages, **kwargs)
+        by_stage = {result['stage']: result for result in size_results}
+        if 'get_many_results' in by_stage and 'tweet_news (first)' in by_stage:
+            seconds = by_stage['get_many_results']['seconds'] + by_stage['tweet_news (first)']['seconds']
+            peaks = [by_stage[name]['peak_mib'] for name in ('get_many_results', 'tweet_news (first)')]
+            size_results.append({'size': size, 'stage': 'end to end', 'seconds': seconds, 'items': size,
+                                 'unit': 'articles', 'per_s': size / seconds,
+                                 'peak_mib': None if peaks[0] is None else max(peaks),
+                                 'maxrss_mib': by_stage['tweet_news (first)']['maxrss_mib']})
+        results.extend(size_results)
+    http_client.configure(proxy_url=None)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the news pipeline offline, against a local stand-in for "
+                                                 "NewsAPI and the publishers of a synthetic corpus.")
+    parser.add_argument('-sizes', default=[1000, 10000], type=int, nargs='+',
+                        help="Numbers of articles in the corpora (default = 1000 10000)")
+    parser.add_argument('-stages', default=list(stage_names), nargs='+', choices=stage_names,
+                        help="Stages to run (default = all)")
+    parser.add_argument('-qaly_path', default='global_prios/global_prios.csv', type=str,
+                        help="Directory of the QALY table")
+    parser.add_argument('-url_path', default='url_content_lookup.csv', type=str,
+                        help="Directory of the url lookup table")
+    parser.add_argument('-max_fetches', default=2000, type=int,
+                        help="Articles get_url_content is timed on, at most (default = 2000)")
+    parser.add_argument('-delay_ms', default=0.0, type=float,
+                        help="Simulated network latency of each response of the stand-in (default = 0)")
+    parser.add_argument('-memory', action='store_true',
+                        help="Measure the peak memory allocated by each stage with tracemalloc (slows every stage)")
+    parser.add_argument('-json', default=None, type=str, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.memory:
+        tracemalloc.start()
+    results = bench_pipeline(args.sizes, args.qaly_path, args.url_path, stages=args.stages,
+                             delay_s=args.delay_ms / 1e3, max_fetches=args.max_fetches)
+
+    print('{0:>9}  {1:<20}{2:>10}{3:>10}{4:>9}{5:>14}{6:>11}{7:>12}'.format(
+        'size', 'stage', 'seconds', 'items', 'unit', 'items/s', 'peak MiB', 'maxrss MiB'))
+    for result in results:
+        peak = '-' if result['peak_mib'] is None else '{:.1f}'.format(result['peak_mib'])
+        print('{size:>9d}  {stage:<20}{seconds:>10.2f}{items:>10d}{unit:>9}{per_s:>14.1f}{0:>11}{maxrss_mib:>12.1f}'
+              .format(peak, **result))
+    if args.json is not None:
+        with open(args.json, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
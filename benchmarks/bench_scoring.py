@@ -0,0 +1,77 @@
+import argparse
+import random
+import timeit
+import numpy as np
+import score_articles
+from keyword_matcher import KeywordMatcher
+from benchmarks.corpus import make_text
+from benchmarks.pages import vocabulary
+
+
+def legacy_keyword_presence(keywords, articles):
+    """The keyword presence of one substring search per keyword and article, kept for comparison"""
+    return dict((keyword, np.fromiter((bool(keyword) and keyword in article for article in articles), dtype=bool,
+                                      count=len(articles))) for keyword in keywords)
+
+
+def make_keywords(qaly_scorer, n_keywords, rng):
+    """The keywords of a QALY table, padded to n_keywords with phrases of the benchmark vocabulary and made-up words,
+    as a large table would have
+    """
+    keywords = set(qaly_scorer.keywords)
+    while len(keywords) < n_keywords:
+        if rng.random() < 0.5:
+            keywords.add(' '.join(rng.choice(vocabulary) for _ in range(rng.randint(2, 3))))
+        else:
+            keywords.add(''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 10))))
+    return sorted(keywords)
+
+
+def bench_scoring(qaly_path='global_prios/global_prios.csv', keyword_counts=(100, 500, 2000), n_articles=200,
+                  n_words=800, seed=0):
+    """Time keyword presence over a batch of articles by one substring search per keyword and article (legacy), and by
+    one scan of each article (score_articles.keyword_presence), for keyword sets of several sizes
+
+    Parameters
+    ----------------
+    qaly_path : A string, the path to the QALY table whose keywords are padded to each size
+    keyword_counts : A list of ints, the sizes of the keyword sets
+    n_articles : An int, the number of articles in the batch
+    n_words : An int, the number of words of each article
+    seed : An int, the seed of the keywords and the text of the articles
+
+    Returns
+    ----------------
+    results : A list of tuples (number of keywords, legacy ms per article, scan ms per article)
+    """
+    rng = random.Random(seed)
+    qaly_scorer = score_articles.load_qaly_scorer(qaly_path)
+    articles = [make_text(rng, n_words) for _ in range(n_articles)]
+    results = []
+    for n_keywords in keyword_counts:
+        keywords = make_keywords(qaly_scorer, n_keywords, rng)
+        matcher = KeywordMatcher(keywords)
+        legacy = legacy_keyword_presence(keywords, articles)
+        present = score_articles.keyword_presence(keywords, articles, matcher)
+        assert all(np.array_equal(legacy[keyword], present[keyword]) for keyword in keywords)
+        timings = []
+        for presence in (lambda: legacy_keyword_presence(keywords, articles),
+                         lambda: score_articles.keyword_presence(keywords, articles, matcher)):
+            timings.append(1e3 * min(timeit.repeat(presence, number=1, repeat=3)) / n_articles)
+        results.append((len(keywords), timings[0], timings[1]))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark finding the keywords of a batch of articles.")
+    parser.add_argument('-qaly_path', type=str, default='global_prios/global_prios.csv',
+                        help="Path to the QALY table (default = global_prios/global_prios.csv)")
+    parser.add_argument('-keywords', type=int, nargs='+', default=[100, 500, 2000],
+                        help="Sizes of the keyword sets (default = 100 500 2000)")
+    parser.add_argument('-articles', default=200, type=int, help="Articles per batch (default = 200)")
+    parser.add_argument('-words', default=800, type=int, help="Words per article (default = 800)")
+    args = parser.parse_args()
+
+    print('{0:>10}{1:>12}{2:>12}{3:>10}'.format('keywords', 'legacy ms', 'scan ms', 'speedup'))
+    for n_keywords, legacy_ms, scan_ms in bench_scoring(args.qaly_path, args.keywords, args.articles, args.words):
+        print('{0:>10}{1:>12.3f}{2:>12.3f}{3:>9.1f}x'.format(n_keywords, legacy_ms, scan_ms, legacy_ms / scan_ms))
@@ -0,0 +1,133 @@
+import datetime
+import random
+from urllib.parse import urlparse
+from sources import SourceRegistry
+from benchmarks.pages import make_article_page, make_paragraph, vocabulary
+
+dt_format = "%Y-%m-%dT%H:%M:%S"
+unsupported_host = 'www.example.com'  # a publisher with no row in the URL lookup table
+
+
+def source_host(source):
+    """A hostname which the source's keyword matches, e.g. www.bbc.com for bbc, news.vice.com for news.vice"""
+    return source.keyword + '.com' if '.' in source.keyword else 'www.' + source.keyword + '.com'
+
+
+def make_text(rng, n_words):
+    words = [rng.choice(vocabulary) for _ in range(n_words)]
+    words[0] = words[0].capitalize()
+    return ' '.join(words) + '.'
+
+
+class Corpus(object):
+    """A synthetic corpus of news articles, every part of which is generated on demand from the article's index
+
+    Nothing is held in memory per article, so a corpus of a million articles costs no more than one of a thousand.
+    Article 0 is the newest; publication times are spread evenly over span_hours before now. Articles are spread over
+    the sources of the URL lookup table in turn, and a fraction of them come from a publisher which has no extractor.
+
+    Parameters
+    ----------------
+    url_lookup : A string, the path to the URL lookup table
+    n_articles : An int, the number of articles
+    seed : An int, the seed of the text of the articles
+    now : A datetime, the publication time of the newest article (default: the time the corpus is made)
+    span_hours : A float, the number of hours the articles are published over
+    unsupported_every : An int, every unsupported_every-th article comes from unsupported_host (0 for none)
+    n_paragraphs : An int, the number of paragraphs of each story
+    """
+
+    def __init__(self, url_lookup, n_articles, seed=0, now=None, span_hours=24.0, unsupported_every=20,
+                 n_paragraphs=10):
+        self.url_lookup = url_lookup
+        self.n_articles = n_articles
+        self.seed = seed
+        self.now = datetime.datetime.now().replace(microsecond=0) if now is None else now
+        self.span_hours = span_hours
+        self.unsupported_every = unsupported_every
+        self.n_paragraphs = n_paragraphs
+        self.sources = SourceRegistry(url_lookup).sources
+        self.hosts = {source_host(source): source for source in self.sources}
+
+    def __len__(self):
+        return self.n_articles
+
+    def _rng(self, i):
+        return random.Random(self.seed * 10 ** 9 + i)
+
+    def source(self, i):
+        """The Source of article i, or None if it comes from unsupported_host"""
+        if self.unsupported_every and i % self.unsupported_every == self.unsupported_every - 1:
+            return None
+        return self.sources[i % len(self.sources)]
+
+    def url(self, i):
+        source = self.source(i)
+        host = unsupported_host if source is None else source_host(source)
+        return 'http://{0}/news/{1:d}'.format(host, i)
+
+    @staticmethod
+    def index(url):
+        """The index of the article at a URL, or None if the URL is not one of the corpus"""
+        path = urlparse(url).path
+        if not path.startswith('/news/'):
+            return None
+        try:
+            return int(path[len('/news/'):])
+        except ValueError:
+            return None
+
+    def published_at(self, i):
+        """The publication time of article i, a string of the form YYYY-MM-DDTHH:MM:SS"""
+        delta = datetime.timedelta(hours=self.span_hours * i / max(self.n_articles, 1))
+        return datetime.datetime.strftime(self.now - delta, dt_format)
+
+    def description(self, i):
+        return make_text(self._rng(-i - 1), 25)
+
+    def text(self, i):
+        """The plain text of story i, as an extractor would return it"""
+        rng = self._rng(i)
+        return ' '.join(make_text(rng, rng.randint(20, 60)) for _ in range(self.n_paragraphs))
+
+    def page(self, i):
+        """The HTML page of article i, laid out like its publisher's pages (see pages.make_article_page)"""
+        rng = self._rng(i)
+        source = self.source(i) or self.sources[0]
+        paragraphs = [make_paragraph(rng, rng.randint(20, 60)) for _ in range(self.n_paragraphs)]
+        return make_article_page(source, 'Headline {:d}'.format(i), paragraphs, rng)
+
+    def newsapi_article(self, i):
+        """Article i as NewsAPI's /v2/everything endpoint returns it"""
+        source = self.source(i)
+        source_id = 'example' if source is None else source.source_id
+        return {'source': {'id': source_id, 'name': source_id},
+                'author': None,
+                'title': 'Headline {:d}'.format(i),
+                'description': self.description(i),
+                'url': self.url(i),
+                'urlToImage': None,
+                'publishedAt': self.published_at(i) + 'Z',
+                'content': None}
+
+    def newsapi_page(self, page, page_size):
+        """A page of NewsAPI results, newest first, or NewsAPI's error for a page past the end of the results"""
+        start = (page - 1) * page_size
+        if page < 1 or start >= max(self.n_articles, 1):
+            return {'status': 'error', 'code': 'maximumResultsReached',
+                    'message': 'You have requested too many results.'}
+        return {'status': 'ok', 'totalResults': self.n_articles,
+                'articles': [self.newsapi_article(i) for i in range(start, min(start + page_size, self.n_articles))]}
+
+    def article_dict(self, start, stop):
+        """Articles start to stop, in the form get_articles.process_page passes to score_articles.score_all"""
+        article_dict = {}
+        for i in range(start, min(stop, self.n_articles)):
+            source = self.source(i)
+            content = self.description(i)
+            if source is not None:
+                content += ' ' + self.text(i)
+            article_dict[self.url(i)] = {'content': content,
+                                         'publishedAt': self.published_at(i),
+                                         'source': 'example' if source is None else source.source_id}
+        return article_dict
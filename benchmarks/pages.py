@@ -0,0 +1,81 @@
+import os
+import random
+from sources import SourceRegistry
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+vocabulary = ('the government said on Tuesday that cancer rates in India and the United States had fallen while '
+              'extreme poverty remains a global challenge and climate change threatens developing countries across '
+              'Africa Brazil Nigeria Pakistan and Bangladesh according to a report published by researchers at the '
+              'world health organisation who warned that progress could stall without new funding').split()
+
+
+def make_paragraph(rng, n_words):
+    words = [rng.choice(vocabulary) for _ in range(n_words)]
+    words[0] = words[0].capitalize()
+    i = rng.randrange(n_words)
+    words[i] = '<a href="/news/{0}">{1}</a>'.format(rng.randrange(10 ** 6), words[i])
+    j = rng.randrange(n_words)
+    words[j] = '<em>{}</em> &amp;'.format(words[j])
+    return ' '.join(words) + '.'
+
+
+def make_article_page(source, title, paragraphs, rng):
+    """Make an HTML page laid out like a publisher's article page, with the story inside an element whose class
+    matches the source's delimiter, surrounded by navigation, scripts and related links
+
+    Parameters
+    ----------------
+    source : A sources.Source, the publisher
+    title : A string, the headline
+    paragraphs : A list of strings, the HTML of the paragraphs of the story
+    rng : A random.Random
+
+    Returns
+    ----------------
+    html : A string
+    """
+    nav = ''.join('<li class="nav__item"><a href="/section/{0}">Section {0}</a></li>'.format(i) for i in range(60))
+    related = ''.join('<li class="related__item"><a href="/news/{0}"><p>{1}</p></a></li>'.format(
+        rng.randrange(10 ** 6), make_paragraph(rng, 8)) for _ in range(20))
+    script = '<script>window.__data = {%s};</script>' % ','.join('"k%d": %d' % (i, i) for i in range(400))
+    return '''<!DOCTYPE html>
+<html lang="en">
+<head><meta charset="utf-8"><title>{title}</title>
+<link rel="stylesheet" href="/static/main.css">{script}</head>
+<body>
+<header class="site-header"><nav><ul>{nav}</ul></nav></header>
+<main>
+<div class="page-wrapper">
+<h1 class="headline">{title}</h1>
+<div class="{delimiter} main-content">
+<figure><img src="/img/{img}.jpg"><figcaption>Photo credit</figcaption></figure>
+{paragraphs}
+</div>
+<aside class="sidebar"><p>Advertisement</p><ul>{related}</ul></aside>
+</div>
+</main>
+<footer class="site-footer"><p>&copy; {source_id}</p>{script}</footer>
+</body>
+</html>
+'''.format(title=title, script=script, nav=nav, delimiter=source.delimiter, img=rng.randrange(10 ** 6),
+           paragraphs='\n'.join('<p>{}</p>'.format(p) for p in paragraphs), related=related,
+           source_id=source.source_id)
+
+
+def fixture_filename(source):
+    return os.path.join(fixtures_dir, '{0}.html'.format(source.keyword))
+
+
+def write_fixtures(url_lookup='url_content_lookup.csv', n_paragraphs=30, seed=0):
+    """Write a synthetic article page for each source of the URL lookup table into fixtures_dir"""
+    rng = random.Random(seed)
+    os.makedirs(fixtures_dir, exist_ok=True)
+    for source in SourceRegistry(url_lookup).sources:
+        paragraphs = [make_paragraph(rng, rng.randint(20, 60)) for _ in range(n_paragraphs)]
+        with open(fixture_filename(source), 'w') as outfile:
+            outfile.write(make_article_page(source, 'Headline for {}'.format(source.source_id), paragraphs, rng))
+
+
+if __name__ == '__main__':
+    write_fixtures()
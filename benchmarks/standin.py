@@ -0,0 +1,123 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from benchmarks.corpus import Corpus
+
+newsapi_host = 'newsapi.org'
+newsapi_url = 'http://newsapi.org/v2/everything'  # point get_articles.newsapi_url here to query the stand-in
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Serves a corpus as NewsAPI and its publishers would
+
+    Requests may come through the stand-in as an HTTP proxy (with an absolute URL, see http_client.proxy_url) or
+    directly (with a Host header). NewsAPI queries on newsapi_host get a page of JSON results, article URLs on a
+    publisher's host get the article's HTML page, anything else gets a 404.
+    """
+    protocol_version = 'HTTP/1.1'  # keep connections alive, as real servers do
+    disable_nagle_algorithm = True  # headers and body are written separately, don't wait for an ACK in between
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        host = url.hostname or (self.headers.get('Host') or '').split(':')[0]
+        corpus = self.server.corpus
+        if self.server.delay_s > 0:
+            time.sleep(self.server.delay_s)
+        if host == newsapi_host and url.path == '/v2/everything':
+            query = parse_qs(url.query)
+            page = int(query.get('page', ['1'])[0])
+            page_size = int(query.get('pagesize', ['20'])[0])
+            self._send(200, 'application/json', json.dumps(corpus.newsapi_page(page, page_size)).encode('utf-8'))
+            return
+        i = corpus.index(self.path)
+        if host in corpus.hosts and i is not None and 0 <= i < len(corpus):
+            self._send(200, 'text/html; charset=utf-8', corpus.page(i).encode('utf-8'))
+        else:
+            self._send(404, 'text/plain', b'Not found')
+
+    def _send(self, status, content_type, body):
+        etag = '"{}"'.format(hashlib.blake2b(body, digest_size=8).hexdigest())
+        if status == 200 and self.headers.get('If-None-Match') == etag:  # see http_client.ResponseCache
+            status, body = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if status in (200, 304):
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(corpus, port=0, delay_s=0.0, ready=None):
+    """Serve a corpus on 127.0.0.1 until the process is stopped
+
+    Parameters
+    ----------------
+    corpus : A Corpus
+    port : An int, the port to listen on, 0 for any free port
+    delay_s : A float, the time each response is held back, to simulate network latency
+    ready : A multiprocessing Connection, which the port is sent on once the server listens
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandinHandler)
+    server.daemon_threads = True
+    server.corpus = corpus
+    server.delay_s = delay_s
+    if ready is not None:
+        ready.send(server.server_address[1])
+    server.serve_forever()
+
+
+class Standin(object):
+    """A stand-in for NewsAPI and the publishers of a corpus, run in a child process so that serving does not compete
+    with the code being measured for the GIL
+
+    Use as a context manager, and point the pipeline at it with http_client.configure(proxy_url=standin.proxy_url) and
+    get_articles.newsapi_url = newsapi_url. Article URLs in the corpus are plain http, so they go through the proxy
+    without a tunnel.
+
+    Parameters
+    ----------------
+    corpus : A Corpus
+    delay_s : A float, the time each response is held back, to simulate network latency
+    """
+
+    def __init__(self, corpus, delay_s=0.0):
+        self.corpus = corpus
+        self.delay_s = delay_s
+        self.proxy_url = None
+        self._process = None
+
+    def __enter__(self):
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+        self._process = context.Process(target=serve, args=(self.corpus, 0, self.delay_s, sender), daemon=True)
+        self._process.start()
+        sender.close()  # so that recv raises EOFError, rather than waits forever, if the server fails to start
+        self.proxy_url = 'http://127.0.0.1:{:d}'.format(receiver.recv())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._process.terminate()
+        self._process.join()
+        self._process = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a synthetic corpus as NewsAPI and its publishers would.")
+    parser.add_argument('-url_path', default='url_content_lookup.csv', type=str,
+                        help="Directory of the url lookup table")
+    parser.add_argument('-n_articles', default=1000, type=int, help="Number of articles in the corpus")
+    parser.add_argument('-port', default=8080, type=int, help="Port to listen on")
+    parser.add_argument('-delay_ms', default=0.0, type=float, help="Simulated latency of each response")
+    args = parser.parse_args()
+
+    print('Serving {0} articles as an HTTP proxy on 127.0.0.1:{1}, NewsAPI at {2}'.format(args.n_articles, args.port,
+                                                                                        newsapi_url))
+    serve(Corpus(args.url_path, args.n_articles), args.port, args.delay_ms / 1e3)
@@ -0,0 +1,155 @@
+import asyncio
+import backup
+import datetime
+import math
+import metrics
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import news_db
+import score_articles
+import tweeting
+
+dt_format = "%Y-%m-%dT%H:%M:%S"
+
+
+async def run_periodically(name, period_s, func, executor, stop, start=None):
+    """Run a blocking function on an executor every period_s seconds until stop is set
+
+    Runs are scheduled on a fixed grid from the first run, so the cadence does not drift with the time each run takes.
+    A run which overruns its slot makes the task skip the slots it missed, rather than run back to back.
+
+    Parameters
+    ----------------
+    name : A string, the name of the task, for logging
+    period_s : A float, the period in seconds
+    func : A function taking no arguments
+    executor : A concurrent.futures.Executor, to run func on
+    stop : An asyncio.Event, set to stop the task after the current run
+    start : An asyncio.Event, if given the first run waits until it is set
+    """
+    loop = asyncio.get_running_loop()
+    if start is not None:
+        waiters = [asyncio.ensure_future(start.wait()), asyncio.ensure_future(stop.wait())]
+        _, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+    next_run = loop.time()
+    while not stop.is_set():
+        try:
+            await loop.run_in_executor(executor, func)
+        except Exception as e:
+            print('WARNING: {0} failed: {1!r}'.format(name, e))
+        next_run += period_s
+        now = loop.time()
+        if next_run < now:
+            missed = math.ceil((now - next_run) / period_s)
+            print('WARNING: {0} overran, skipping {1} run(s)'.format(name, missed))
+            next_run += missed * period_s
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=next_run - loop.time())
+        except asyncio.TimeoutError:
+            pass
+
+
+class _Rescorer(object):
+    """Rescores the tweet window incrementally whenever the QALY table changes"""
+
+    def __init__(self, db_filename, qaly_path, url_path, cache_filename, tweet_time_window):
+        self.db_filename = db_filename
+        self.qaly_path = qaly_path
+        self.url_path = url_path
+        self.cache_filename = cache_filename
+        self.tweet_time_window = tweet_time_window
+        self.version = None
+
+    def __call__(self):
+        qaly_scorer = score_articles.load_qaly_scorer(self.qaly_path)
+        if qaly_scorer.version == self.version:
+            return
+        since = datetime.datetime.now() - datetime.timedelta(hours=self.tweet_time_window)
+        with metrics.timer('rescore_seconds'), metrics.profiled('rescore'):
+            n_rescored, _ = score_articles.rescore_incremental(self.db_filename, qaly_scorer,
+                                                               datetime.datetime.strftime(since, dt_format),
+                                                               self.url_path, self.cache_filename)
+        if n_rescored > 0:
+            print('Rescored {} articles with the new QALY table'.format(n_rescored))
+        self.version = qaly_scorer.version
+
+
+def _close_thread_connections(barrier):
+    barrier.wait()  # make sure each executor thread runs exactly one of these
+    news_db.close_connections()
+
+
+async def run(tweepyapi, api_key, qaly_path, url_path, db_filename, tweet_time_window, news_refresh_period,
+              periodicity_s, ingest_check_s=600.0, rescore_check_s=300.0, backup_check_s=600.0, dbg_mode=False,
+              cache_filename='article_cache.db', hot_days=None, compare_qaly_paths=(), queue_filename=None):
+    """Run ingestion, rescoring and tweeting as independent periodic tasks until SIGINT or SIGTERM
+
+    Tweets go out every periodicity_s seconds however long a news refresh takes, since each task runs on its own
+    thread of a shared pool (whose threads hold the database connections). On a signal, each task finishes its current
+    run, then the connections are closed.
+
+    Parameters
+    ----------------
+    tweepyapi : tweepy.api.API object, contains Twitter API credentials and allows tweeting
+    api_key : A string, the API key of the news API
+    qaly_path : A string, directory of the QALY table
+    url_path : A string, the directory of the URL lookup table for news sources
+    db_filename : A string, the name of the news database
+    tweet_time_window : A float, the number of hours prior to now to draw from the news database to tweet from
+    news_refresh_period : A float, the longest period in hours between polls of a news source, see
+                          tweeting.refresh_news
+    periodicity_s : A float, the period in seconds between tweets
+    ingest_check_s : A float, the period in seconds between checks of whether any news source is due a poll
+    rescore_check_s : A float, the period in seconds between checks of whether the QALY table has changed
+    backup_check_s : A float, the period in seconds between shipments of the news database's WAL, if
+                     backup.wal_shipping (otherwise the database is backed up after each refresh only)
+    dbg_mode : A bool, if True enter debug mode
+    cache_filename : A string, the name of the article cache database
+    hot_days : A float, see tweeting.refresh_news
+    compare_qaly_paths : A list of strings, see tweeting.refresh_news
+    queue_filename : A string, see tweeting.refresh_news
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    is_first_time_setup = tweeting.create_db(db_filename, tweeting.news_create_str)
+    has_news = asyncio.Event()  # don't tweet from an empty database while it is first being built
+    if not is_first_time_setup:
+        has_news.set()
+
+    def ingest():
+        tweeting.refresh_news(api_key, qaly_path, url_path, db_filename, news_refresh_period, dbg_mode=dbg_mode,
+                              cache_filename=cache_filename, hot_days=hot_days,
+                              compare_qaly_paths=compare_qaly_paths, queue_filename=queue_filename)
+        loop.call_soon_threadsafe(has_news.set)
+
+    def tweet():
+        tweeting.tweet_from_db(tweepyapi, db_filename, tweet_time_window)
+
+    schedule = [('ingestion', ingest_check_s, ingest, None),
+                ('rescoring', rescore_check_s,
+                 _Rescorer(db_filename, qaly_path, url_path, cache_filename, tweet_time_window), has_news),
+                ('tweeting', periodicity_s, tweet, has_news)]
+    if backup.wal_shipping:
+        schedule.append(('backup', backup_check_s, lambda: backup.request_backup(db_filename), has_news))
+    # One thread (and so one persistent connection per database) for each task
+    n_threads = len(schedule)
+    executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix='propnews')
+    tasks = [run_periodically(name, period_s, func, executor, stop, start=start)
+             for name, period_s, func, start in schedule]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        print('Shutting down...')
+        if backup.wal_shipping:
+            backup.request_backup(db_filename)  # ship what the tasks wrote since the last shipment
+        await loop.run_in_executor(None, backup.wait)
+        barrier = threading.Barrier(n_threads)
+        await asyncio.gather(*[loop.run_in_executor(executor, _close_thread_connections, barrier)
+                               for _ in range(n_threads)])
+        executor.shutdown(wait=True)
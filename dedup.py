@@ -0,0 +1,114 @@
+import hashlib
+import re
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import numpy as np
+
+# Query parameters which only track where a click came from, and never change the page served
+tracking_params = frozenset(['fbclid', 'gclid', 'dclid', 'msclkid', 'igshid', 'mc_cid', 'mc_eid', 'ocid', 'cmpid',
+                             'cmp', 'ito', 'ref', 'rss', 'ns_mchannel', 'ns_source', 'ns_campaign', 'ns_linkname',
+                             'ns_fee', 'at_medium', 'at_campaign', 'at_custom1', 'at_custom2', 'at_custom3',
+                             'at_custom4', 'outputtype', '__twitter_impression'])
+tracking_prefixes = ('utm_', '_ga', '_hs')
+default_ports = {'http': 80, 'https': 443}
+
+n_bits = 64  # bits in a SimHash fingerprint
+shingle_size = 3  # words per shingle
+min_words = 12  # texts with fewer words are too short to fingerprint reliably
+max_distance = 3  # fingerprints which differ in at most this many bits are near-duplicates
+
+_word_matcher = re.compile(r'\w+')
+
+
+def canonicalize_url(url):
+    """The canonical form of an article URL, so that variants of one URL are recognised as the same article
+
+    The scheme and host are lower-cased, default ports and fragments are dropped, tracking parameters (utm_*, fbclid,
+    ...) are removed, and the remaining query parameters are sorted. The path is left as it is, since publishers'
+    paths can be case-sensitive.
+
+    Parameters
+    ----------------
+    url : A string, the URL of an article
+
+    Returns
+    ----------------
+    canonical_url : A string
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').rstrip('.')
+    if parts.port is not None and parts.port != default_ports.get(scheme):
+        host += ':{:d}'.format(parts.port)
+    params = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+              if key.lower() not in tracking_params and not key.lower().startswith(tracking_prefixes)]
+    return urlunsplit((scheme, host, parts.path or '/', urlencode(sorted(params)), ''))
+
+
+def simhash(text):
+    """The SimHash fingerprint of a text, over its overlapping shingles of shingle_size words
+
+    Texts which share most of their shingles (e.g. one wire story, lightly edited by two publishers) get fingerprints
+    which differ in only a few bits.
+
+    Parameters
+    ----------------
+    text : A string
+
+    Returns
+    ----------------
+    fingerprint : An int of n_bits bits, or None if the text has fewer than min_words words
+    """
+    words = _word_matcher.findall(text.lower()) if text else []
+    if len(words) < min_words:
+        return None
+    shingles = set(' '.join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1))
+    digests = b''.join(hashlib.blake2b(shingle.encode('utf-8'), digest_size=n_bits // 8).digest()
+                       for shingle in shingles)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(len(shingles), n_bits // 8), axis=1)
+    votes = 2 * bits.sum(axis=0, dtype=np.int64) - len(shingles)  # +1 for each shingle with the bit set, -1 otherwise
+    return int.from_bytes(np.packbits(votes > 0).tobytes(), 'big')
+
+
+def to_signed(fingerprint):
+    """A fingerprint as a signed 64-bit int, as SQLite stores integers"""
+    return fingerprint - (1 << n_bits) if fingerprint >= 1 << (n_bits - 1) else fingerprint
+
+
+def from_signed(value):
+    """The inverse of to_signed"""
+    return value + (1 << n_bits) if value < 0 else value
+
+
+class SimHashIndex(object):
+    """Finds a stored fingerprint within max_distance bits of a query fingerprint, without comparing against them all
+
+    Fingerprints are split into max_distance + 1 bands. Two fingerprints which differ in at most max_distance bits
+    must agree exactly on at least one band, so only the fingerprints sharing a band with the query are compared.
+    """
+
+    def __init__(self):
+        self._n_bands = max_distance + 1
+        self._band_bits = -(-n_bits // self._n_bands)
+        self._tables = [{} for _ in range(self._n_bands)]  # band value -> list of (fingerprint, key)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _bands(self, fingerprint):
+        mask = (1 << self._band_bits) - 1
+        return [(fingerprint >> (i * self._band_bits)) & mask for i in range(self._n_bands)]
+
+    def add(self, key, fingerprint):
+        """Store the fingerprint of key (e.g. an article's URL)"""
+        for table, band in zip(self._tables, self._bands(fingerprint)):
+            table.setdefault(band, []).append((fingerprint, key))
+        self._size += 1
+
+    def find(self, fingerprint):
+        """The key of a stored fingerprint within max_distance bits of fingerprint, or None if there is none"""
+        for table, band in zip(self._tables, self._bands(fingerprint)):
+            for candidate, key in table.get(band, ()):
+                if bin(candidate ^ fingerprint).count('1') <= max_distance:
+                    return key
+        return None
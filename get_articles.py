@@ -1,168 +1,281 @@
-import requests
-from get_full_content import get_url_content
-import os
-import sqlite3 as sq
+import dedup
+import http_client
+import job_queue
+import metrics
+import news_store
+from news_store import update_news_db
+from get_full_content import fetch_many_contents
+from sources import get_source_registry
+import news_db
 import score_articles
 import datetime
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
 
 dt_format = "%Y-%m-%dT%H:%M:%S"
+newsapi_url = 'https://newsapi.org/v2/everything'
 
 
-def find_newest_db_article(db_filename, lag_minutes=0):
-    """Find the time of the newest article in the database, with lag
+def get_query(api_key, source_ids, query_from=None, results_per_page=100, query_to=None):
+    """Build the NewsAPI query for news from the given sources, without its page number
 
     Parameters
-    -------------
+    ---------------
+    api_key : A string, the NewsAPI API key
+    source_ids : A list of strings, the NewsAPI ids of the sources
+    query_from : A string, the time to query the API from, of the form YYYY-MM-DDTHH:MM:SS
+    results_per_page : An int, Maximum number of results to request per page from the API
+    query_to : A string, the time to query the API to, of the form YYYY-MM-DDTHH:MM:SS (UTC, as NewsAPI's times are)
+
+    Returns
+    ---------------
+    query : A string, the URL of the query. Append 'page=<n>&' to it to get a page
+    """
+    source_str = 'sources=' + ','.join(source_ids) + ',&'
+    query_from_str = '' if query_from is None else 'from={}&'.format(query_from)
+    query_to_str = '' if query_to is None else 'to={}&'.format(query_to)
+    return (newsapi_url + '?'
+            + source_str
+            + query_from_str
+            + query_to_str +
+            'sort=date_published&'
+            + 'pagesize={}&'.format(results_per_page)
+            + 'apiKey={}&'.format(api_key))
+
+
+def load_checkpoint(db_filename, query_key, max_attempts, max_age_h=None):
+    """Find the unfinished refresh of a query, if any, and count a new attempt at it
+
+    Parameters
+    ---------------
     db_filename : A string, the name of the news database
-    lag_minutes : An int, the number of minutes backwards in time since the newest article that the API should be called
-                  from. This is to take into account latency between a story being published on the website and being
-                  discoverable on NewsAPI.
+    query_key : A string, identifies the query (sources and page size), without its time window
+    max_attempts : An int, a refresh which has been attempted this many times is abandoned
+    max_age_h : A float, a refresh started more than this many hours ago is abandoned, since a newer one covering its
+                time window will have been made since (e.g. for the same sources grouped differently, see scheduler).
+                None to resume refreshes however old they are
 
     Returns
-    ------------
-    query_from : A string of the form YYYY-MM-DDTHH:MM:SS, the time of the newest article in the database, with lag
+    ---------------
+    checkpoint : None, or a dict with keys 'id', 'query_from', 'query_to', 'n_pages' (None if unknown) and
+                 'pages_done' (a set)
     """
+    conn = news_db.connect(db_filename)
+    with conn:
+        if max_age_h is not None:
+            oldest = datetime.datetime.now() - datetime.timedelta(hours=max_age_h)
+            n_expired = conn.execute('''UPDATE refresh_checkpoints SET finished=1
+                                        WHERE finished=0 AND started_at < ?''',
+                                     (datetime.datetime.strftime(oldest, dt_format),)).rowcount
+            if n_expired > 0:
+                print('WARNING: abandoning {0} refreshes started more than {1} hours ago'.format(n_expired, max_age_h))
+        row = conn.execute('''SELECT id, query_from, query_to, n_pages, pages_done, attempts FROM refresh_checkpoints
+                              WHERE query=? AND finished=0 ORDER BY id DESC LIMIT 1''', (query_key,)).fetchone()
+        if row is None:
+            return None
+        checkpoint_id, query_from, query_to, n_pages, pages_done, attempts = row
+        if attempts >= max_attempts:
+            print('WARNING: abandoning refresh from {0} after {1} attempts'.format(query_from, attempts))
+            conn.execute('UPDATE refresh_checkpoints SET finished=1 WHERE id=?', (checkpoint_id,))
+            return None
+        conn.execute('UPDATE refresh_checkpoints SET attempts=attempts+1 WHERE id=?', (checkpoint_id,))
+    return {'id': checkpoint_id, 'query_from': query_from, 'query_to': query_to, 'n_pages': n_pages,
+            'pages_done': set(json.loads(pages_done))}
 
-    if os.path.exists(db_filename):
-        conn = sq.connect(db_filename)
-        c = conn.cursor()
-        date_query = '''SELECT published_at FROM news
-                        ORDER BY published_at
-                        DESC
-                        LIMIT 1
-        '''
-        c.execute(date_query)
-        date_latest = c.fetchall()[0][0]
-        conn.close()
-
-        # Subtract lag_minutes
-        date_latest_dtm = datetime.datetime.strptime(date_latest, dt_format)
-        query_from_dtm = date_latest_dtm + datetime.timedelta(minutes=-lag_minutes)
-        query_from = datetime.datetime.strftime(query_from_dtm,dt_format)
-        return query_from
-    else:
-        raise Exception('News database not found!')
+
+def new_checkpoint(db_filename, query_key, query_from):
+    """Start recording the progress of a refresh, see load_checkpoint. Its time window ends now, so that the pages of
+    the refresh keep the same results if it is resumed
+    """
+    conn = news_db.connect(db_filename)
+    with conn:
+        started_at = datetime.datetime.strftime(datetime.datetime.now(), dt_format)
+        query_to = datetime.datetime.strftime(datetime.datetime.utcnow(), dt_format)
+        cursor = conn.execute('''INSERT INTO refresh_checkpoints(query, query_from, query_to, n_pages, pages_done,
+                                 attempts, started_at) VALUES(?, ?, ?, NULL, '[]', 1, ?)''',
+                              (query_key, query_from, query_to, started_at))
+    return {'id': cursor.lastrowid, 'query_from': query_from, 'query_to': query_to, 'n_pages': None,
+            'pages_done': set()}
+
+
+def save_checkpoint(db_filename, checkpoint, finished=False):
+    """Save the progress of a refresh, see load_checkpoint"""
+    conn = news_db.connect(db_filename)
+    with conn:
+        conn.execute('UPDATE refresh_checkpoints SET n_pages=?, pages_done=?, finished=? WHERE id=?',
+                     (checkpoint['n_pages'], json.dumps(sorted(checkpoint['pages_done'])), int(finished),
+                      checkpoint['id']))
 
 
-def update_news_db(db_filename, article_dict):
-    """Append article_dict into news database
+def process_page(js, db_filename, qaly_scorer, url_path, cache_filename, fetch_workers, dedup_index=None):
+    """Fetch the content of the articles of a page of NewsAPI results, score them, and save them to the news database
+
+    URLs are canonicalized first (see dedup.canonicalize_url), and articles whose URL is already known are neither
+    fetched nor scored again. An article whose text is a near-duplicate of one already in dedup_index (e.g. the same
+    wire story from another source) is recorded as a duplicate of it, rather than saved as an article of its own.
 
     Parameters
-    ----------------
+    ---------------
+    js : A dict, the decoded JSON of the page
     db_filename : A string, the name of the news database
-    article_dict: A dict of dicts, the keys are URLS, the values are dicts which must contain at least:
-        score : A float, the score of the article
-        topics : A list of strings, the topics associated with the URL
-        published_at : A string, of the form YYYY-MM-DDTHH:MM:SS, the datetime the article was published
+    qaly_scorer : A QalyScorer, or a MultiQalyScorer to also score against alternative QALY tables
+    url_path : A string, directory of the url lookup table
+    cache_filename : A string, the name of the article cache database, which extracted article text is saved to
+    fetch_workers : An int, the maximum number of article pages fetched concurrently
+    dedup_index : A dedup.SimHashIndex of the articles to check for near-duplicates against, which new articles are
+                  added to. If None, near-duplicates are not detected
     """
-    conn = sq.connect(db_filename)
-    c = conn.cursor()
-    for url, url_dict in article_dict.items():
-        insert_string = '''INSERT or IGNORE INTO news(
-                        url,
-                        score,
-                        topics,
-                        published_at,
-                        source)
-                        VALUES(
-                        {0},
-                        {1},
-                        {2},
-                        {3},
-                        {4}
-                        )
-                        '''.format(score_articles.add_quotes(url), url_dict['score'],
-                                   score_articles.add_quotes(score_articles.get_topic_string(url_dict['topics'])),
-                                   score_articles.add_quotes(url_dict['publishedAt']),
-                                   score_articles.add_quotes(url_dict['source']))
-        c.execute(insert_string)
-    conn.commit()
-    conn.close()
-    print('News db updated!')
+    article_dict = {}  # stores articles indexed by URL
+    fingerprints = []
+    duplicates = []
+
+    # Skip the articles which were seen before, under any variant of their URL
+    articles = []
+    seen = news_store.find_known_urls(db_filename,
+                                      [dedup.canonicalize_url(article['url']) for article in js['articles']],
+                                      [article['publishedAt'] for article in js['articles']])
+    for article in js['articles']:
+        url = dedup.canonicalize_url(article['url'])
+        if url in seen:
+            metrics.inc('duplicate_urls_total')
+            continue
+        seen.add(url)
+        articles.append((url, article))
+
+    # Fetch the content of every new result in the page concurrently
+    print('Fetching {0} results'.format(len(articles)))
+    contents = fetch_many_contents(url_path, [url for url, _ in articles], cache_filename, max_workers=fetch_workers)
+
+    # Iterate over results in a page
+    for (url, article), content in zip(articles, contents):
+        desc = article['description']
+        published_at = article['publishedAt'][:-1]
+        source_id = article['source']['id']
+
+        fingerprint = dedup.simhash(desc if content is None else content)
+        if fingerprint is not None and dedup_index is not None:
+            original_url = dedup_index.find(fingerprint)
+            if original_url is not None:
+                metrics.inc('near_duplicates_total')
+                duplicates.append((url, original_url))
+                continue
+            dedup_index.add(url, fingerprint)
+            fingerprints.append((url, fingerprint, published_at))
+
+        article_dict[url] = {'content': score_articles.scored_text(desc, content),
+                             'description': desc,
+                             'publishedAt': published_at,
+                             'source': source_id}
+    article_dict = score_articles.score_all(article_dict, qaly_scorer)
+    update_news_db(db_filename, article_dict, qaly_scorer)
+    news_store.save_fingerprints(db_filename, fingerprints, duplicates)
 
 
 def get_many_results(api_key, db_filename, qaly_path, url_path, query_from=None, page_limit_per_request=10,
-                     results_per_page=100):
+                     results_per_page=100, cache_filename='article_cache.db', fetch_workers=8, page_workers=4,
+                     requests_per_s=2.0, max_attempts=3, compare_qaly_paths=(), source_ids=None,
+                     queue_filename=None, max_age_h=None):
     """Query NewsAPI for URLs and metadata, score articles, and save to news database
 
+    The first page tells how many pages there are; the remaining pages are then requested concurrently, under a
+    token-bucket rate limit, and processed in page order. Progress is checkpointed in the news database after each
+    page, so if a refresh is interrupted (or some pages fail) the next call resumes it, with its original time window
+    (both ends of it, so that the pages still hold the same results), and only requests the pages which are missing.
+
     Parameters
     ---------------
     api_key : A string, the NewsAPI API key
     db_filename : A string, the name of the news database
     qaly_path : A string, directory of the QALY table
     url_path : A string, directory of the url lookup table
-    query_from : A string, the time to query the API from, of the form YYYY-MM-DDTHH:MM:SS
+    query_from : A string, the time to query the API from, of the form YYYY-MM-DDTHH:MM:SS. Ignored if an
+                 unfinished refresh is resumed
     page_limit_per_request : An int, Maximum number of pages to request from the API
     results_per_page : An int, Maximum number of results to request per page from the API
+    cache_filename : A string, the name of the article cache database, which extracted article text is saved to
+    fetch_workers : An int, the maximum number of article pages fetched concurrently
+    page_workers : An int, the maximum number of NewsAPI pages requested concurrently
+    requests_per_s : A float, the maximum sustained rate of NewsAPI requests
+    max_attempts : An int, the number of calls after which an unfinished refresh is abandoned rather than resumed
+    compare_qaly_paths : A list of strings, paths of alternative QALY tables to also score each article against, in
+                         the same scan, into the table_scores table
+    source_ids : A list of strings, the NewsAPI ids of the sources to query (see scheduler.due_groups), by default all
+                 the sources of the url lookup table
+    queue_filename : A string, the name of a job queue database (see job_queue). If given, the articles of each page
+                     are queued for workers to fetch and score, rather than fetched and scored here
+    max_age_h : A float, unfinished refreshes started more than this many hours ago are abandoned rather than resumed
+                (see load_checkpoint). Default: resume them however old they are
     """
 
-    # Iterate over pages - rate limited
-    for i in range(page_limit_per_request):
-        article_dict = {}  # stores articles indexed by URL. Reset every page to spare memory
+    news_db.migrate(db_filename)
+    if compare_qaly_paths:
+        qaly_scorer = score_articles.load_multi_scorer([qaly_path] + list(compare_qaly_paths), primary_path=qaly_path)
+    else:
+        qaly_scorer = score_articles.load_qaly_scorer(qaly_path)
+    if source_ids is None:
+        source_ids = get_source_registry(url_path).source_ids()
+    query_key = get_query('', source_ids, results_per_page=results_per_page)
+
+    checkpoint = load_checkpoint(db_filename, query_key, max_attempts, max_age_h=max_age_h)
+    if checkpoint is not None:
+        print('Resuming refresh from {0}, {1} pages done'.format(checkpoint['query_from'],
+                                                                 len(checkpoint['pages_done'])))
+    else:
+        checkpoint = new_checkpoint(db_filename, query_key, query_from)
+    query = get_query(api_key, source_ids, query_from=checkpoint['query_from'], results_per_page=results_per_page,
+                      query_to=checkpoint['query_to'])
+    if checkpoint['query_from'] is None:
+        dedup_since = datetime.datetime.now()
+    else:
+        dedup_since = datetime.datetime.strptime(checkpoint['query_from'], dt_format)
+    dedup_index = news_store.load_dedup_index(db_filename,
+                                             dedup_since - datetime.timedelta(hours=news_store.dedup_window_hours))
+    rate_limit = http_client.TokenBucket(requests_per_s, capacity=page_workers)
+
+    def get_page(p):
+        rate_limit.acquire()
+        metrics.inc('newsapi_requests_total')
+        with metrics.timer('newsapi_request_seconds'):
+            return http_client.get_json(query + 'page={}&'.format(p))
+
+    def run_page(p, js):
+        """Process a page, returns False if the API returned an error instead of results"""
         try:
-            p = i + 1
-            page_str = 'page={}&'.format(p)
-            pagesize_str = 'pagesize={}&'.format(results_per_page)
-            api_key_str = 'apiKey={}'.format(api_key)
-            source_str = 'sources='
-            with open(url_path, 'r') as infile:
-                for line_num, line in enumerate(infile):
-                    if line_num == 0:
-                        continue
-                    source, keyword, delimiter = line.split(',')
-                    source_str += source + ','
-            source_str += '&'
-
-            if query_from is not None:
-                query_from_str = 'from={}&'.format(query_from)
-                query = ('https://newsapi.org/v2/everything?'
-                         + source_str
-                         + page_str
-                         + query_from_str +
-                         'sort=date_published&'
-                         + pagesize_str
-                         + api_key_str)
-            else:
-                query = ('https://newsapi.org/v2/everything?'
-                         + source_str
-                         + page_str +
-                         'sort=date_published&'
-                         + pagesize_str
-                         + api_key_str)
-            response = requests.get(query)
-            js = response.json()
             # store the maximum number of pages which can be accessed from this call
-            max_page = js['totalResults']/results_per_page + 1
+            checkpoint['n_pages'] = min(page_limit_per_request, int(math.ceil(js['totalResults']/results_per_page)))
             print('Accessing page {0}'.format(p))
-
-            # Iterate over results in a page
-            for k in range(len(js['articles'])):
-                if k % 20 == 0:
-                    print('Processing result {0} of {1}'.format(k, len(js['articles'])))
-                article = js['articles'][k]
-                desc = article['description']
-                url = article['url']
-                content = get_url_content(url_path, url)
-                published_at = article['publishedAt'][:-1]
-                source_id = article['source']['id']
-                if content is not None:
-                    if desc is None:
-                        desc = ''
-                    article_dict[url] = {'content': desc + ' ' + content,
-                                         'publishedAt': published_at,
-                                         'source': source_id}
+            with metrics.timer('newsapi_page_seconds'):
+                if queue_filename is None:
+                    process_page(js, db_filename, qaly_scorer, url_path, cache_filename, fetch_workers,
+                                 dedup_index=dedup_index)
                 else:
-                    article_dict[url] = {'content': desc,
-                                         'publishedAt': published_at,
-                                         'source': source_id}
-            qaly_scorer = score_articles.get_qaly_data(qaly_path)
-            article_dict = score_articles.score_all(article_dict, qaly_scorer)
-            update_news_db(db_filename, article_dict)
+                    job_queue.enqueue_page(queue_filename, db_filename, js)
+            success = True
         except KeyError as e:
+            metrics.inc('newsapi_errors_total')
             print(e)
-            print('WARNING: Key error in calling API. Some articles may be lost.')
-            break
+            print('WARNING: Key error in calling API on page {}. Some articles may be lost.'.format(p))
+            success = False
+        # An error from the API itself (e.g. past the last page the plan allows) won't go away on a retry, so the page
+        # is done either way. Pages only stay to do if the refresh is interrupted (e.g. by a network error).
+        checkpoint['pages_done'].add(p)
+        save_checkpoint(db_filename, checkpoint)
+        return success
+
+    # Without a page count yet, the first page needed has to be fetched on its own
+    if checkpoint['n_pages'] is None:
+        p = min(set(range(1, page_limit_per_request + 1)) - checkpoint['pages_done'])
+        if not run_page(p, get_page(p)):
+            save_checkpoint(db_filename, checkpoint, finished=True)
+            return
+
+    # Prevent any calls which would exceed the number of results in total
+    pages = sorted(set(range(1, checkpoint['n_pages'] + 1)) - checkpoint['pages_done'])
+    with ThreadPoolExecutor(max_workers=page_workers) as executor:
+        futures = [executor.submit(get_page, p) for p in pages]
+        for p, future in zip(pages, futures):
+            run_page(p, future.result())
 
-        # Prevent any calls which would exceed the number of results in total
-        if p >= max_page:
-            break
+    if len(checkpoint['pages_done']) >= checkpoint['n_pages']:
+        save_checkpoint(db_filename, checkpoint, finished=True)
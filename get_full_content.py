@@ -1,32 +1,185 @@
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import urllib3
-import certifi
-import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from article_cache import get_article_cache
+from sources import get_source_registry
+import http_client
+import metrics
 
+extractor_version = 2  # bump whenever a change to get_url_content changes the text it extracts
 
-def get_url_content(url_lookup, url):
+
+def extract_story(html, class_matcher):
+    """Extract the text of the paragraphs of a story from an HTML page in a single parse
+
+    Only the elements whose class matches class_matcher (and their descendants) are built into a tree. The text of the
+    <p> elements inside them is joined with spaces. A matching element nested inside another is not read twice.
+
+    Parameters
+    ----------------
+    html : A string or bytes, the HTML page
+    class_matcher : A compiled regular expression, matching the class of the elements holding the story
+
+    Returns
+    ----------------
+    story : A string, the text of the story
+    """
+    soup = BeautifulSoup(html, 'lxml', parse_only=SoupStrainer(class_=class_matcher))
+    paragraphs = []
+    for container in soup.find_all(True, recursive=False):
+        if container.name == 'p':
+            paragraphs.append(container.get_text())
+        else:
+            paragraphs.extend(p.get_text() for p in container.find_all('p'))
+    return ' '.join(paragraphs)
+
+
+def get_url_content(url_lookup, url, timeout=None):
     """Takes a given URl and returns all relevant article content
 
     Parameters
     ----------------
     url_lookup, A string, the path to database of URLs for which content can be taken
     url, url we wish to query
+    timeout, A float, the connect and read timeout in seconds (default: see http_client)
+
+    Returns
+    ----------------
+    story_processed : A string, or None if the URL does not belong to any source in url_lookup, in which case nothing
+                      is fetched
     """
 
-    http = urllib3.PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
-    content = http.request('GET', url)
-    soup = BeautifulSoup(content.data, "lxml")
-    story_processed = None  # Ensures None is returned if URL is incompatible format
-    with open(url_lookup, 'r') as infile:
-        for line_num, line in enumerate(infile):
-            line = line[:-1]  # remove \n
-            if line_num == 0:
-                continue
-            source, keyword, delimiter = line.split(',')
-
-            if keyword in url:
-                story_raw = BeautifulSoup(''.join([str(s) for s in soup.find_all(class_=re.compile(delimiter))]),
-                                          'lxml')
-                story_processed = re.sub('<[^<>]*>', '', ' '.join([str(s) for s in story_raw.find_all('p')]))
+    source = get_source_registry(url_lookup).lookup(url)
+    if source is None:  # URL is incompatible format
+        metrics.inc('unsupported_urls_total')
+        return None
+
+    metrics.inc('page_fetches_total')
+    with metrics.timer('page_fetch_seconds'):
+        content = http_client.request(url, timeout=timeout)
+    with metrics.timer('html_parse_seconds'):
+        story_processed = extract_story(content.data, source.class_matcher)
 
     return story_processed
+
+
+def get_cached_url_content(url_lookup, url, cache_filename, offline=False):
+    """Like get_url_content, but reads the content from the local article cache, and stores it there after fetching
+
+    Parameters
+    ----------------
+    url_lookup, A string, the path to database of URLs for which content can be taken
+    url, url we wish to query
+    cache_filename : A string, the name of the article cache database
+    offline : A bool, if True never fetch, and return whatever the cache holds (even from an older extractor)
+
+    Returns
+    ----------------
+    content : A string, or None if the URL has no extractable content
+
+    Raises
+    ----------------
+    KeyError : if offline is True and url is not in the cache
+    """
+    cache = get_article_cache(cache_filename)
+    entry = cache.get(url)
+    if entry is not None and (offline or entry[2] == extractor_version):
+        metrics.inc('article_cache_hits_total')
+        return entry[0]
+    metrics.inc('article_cache_misses_total')
+    if offline:
+        raise KeyError(url)
+    content = get_url_content(url_lookup, url)
+    cache.put(url, content, extractor_version)
+    return content
+
+
+def _fetch_with_retries(url_lookup, url, host_slots, timeout, retries, backoff):
+    """Fetch a URL with get_url_content, holding one of its host's slots, and retry with exponential backoff
+
+    Returns
+    ----------------
+    fetched : A bool, False if every attempt failed
+    content : A string or None, see get_url_content
+    """
+    for attempt in range(retries + 1):
+        with host_slots(url):
+            try:
+                return True, get_url_content(url_lookup, url, timeout=timeout)
+            except http_client.CacheMissError as e:  # replaying, so a retry would miss again
+                error = e
+                break
+            except urllib3.exceptions.HTTPError as e:
+                error = e
+        if attempt < retries:
+            metrics.inc('page_fetch_retries_total')
+            time.sleep(backoff * 2 ** attempt)  # back off without holding the host's slot
+    metrics.inc('page_fetch_errors_total')
+    print('WARNING: could not fetch {0}: {1}'.format(url, error))
+    return False, None
+
+
+def fetch_many_contents(url_lookup, urls, cache_filename, max_workers=8, max_per_host=2, timeout=None, retries=2,
+                        backoff=1.0):
+    """Get the content of many URLs, fetching those not in the article cache concurrently
+
+    Parameters
+    ----------------
+    url_lookup : A string, the path to database of URLs for which content can be taken
+    urls : A list of strings, the URLs to get
+    cache_filename : A string, the name of the article cache database
+    max_workers : An int, the maximum number of fetches in flight
+    max_per_host : An int, the maximum number of fetches in flight to any single host
+    timeout : A float, the connect and read timeout of each fetch, in seconds (default: see http_client)
+    retries : An int, the number of times a failed fetch is retried
+    backoff : A float, the delay before the first retry in seconds, doubled for each further retry
+
+    Returns
+    ----------------
+    contents : A list with the content of each URL in urls, in the same order (see get_url_content). The content of a
+               URL which could not be fetched is None, and it is not cached so that it is retried next time.
+    """
+    cache = get_article_cache(cache_filename)
+    registry = get_source_registry(url_lookup)
+    contents = [None] * len(urls)
+    to_fetch = {}  # url -> indices into urls
+    for i, url in enumerate(urls):
+        if registry.lookup(url) is None:  # no extractor, so nothing to fetch
+            metrics.inc('unsupported_urls_total')
+            continue
+        entry = cache.get(url)
+        if entry is not None and entry[2] == extractor_version:
+            metrics.inc('article_cache_hits_total')
+            contents[i] = entry[0]
+        else:
+            metrics.inc('article_cache_misses_total')
+            to_fetch.setdefault(url, []).append(i)
+    if not to_fetch:
+        return contents
+
+    semaphores = {}
+    semaphores_lock = threading.Lock()
+
+    def host_slots(url):
+        host = urlparse(url).hostname
+        with semaphores_lock:
+            if host not in semaphores:
+                semaphores[host] = threading.BoundedSemaphore(max_per_host)
+            return semaphores[host]
+
+    fetch_urls = list(to_fetch)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda url: _fetch_with_retries(url_lookup, url, host_slots, timeout, retries,
+                                                                    backoff), fetch_urls))
+
+    fetched = []
+    for url, (ok, content) in zip(fetch_urls, results):
+        for i in to_fetch[url]:
+            contents[i] = content
+        if ok:
+            fetched.append((url, content))
+    cache.put_many(fetched, extractor_version)
+    return contents
@@ -0,0 +1,330 @@
+import json
+import sqlite3 as sq
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import certifi
+import urllib3
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import metrics
+
+# Settings of the process-wide pool manager, see configure
+connect_timeout = 5.0  # seconds
+read_timeout = 30.0  # seconds
+num_pools = 50  # number of hosts to keep connection pools for
+maxsize = 4  # number of keep-alive connections to keep per host
+host_maxsize = {}  # hostname -> maxsize, overrides maxsize for busy hosts
+proxy_url = None  # e.g. 'http://127.0.0.1:8080', send every request through this HTTP proxy
+default_headers = {'Accept-Encoding': 'gzip, deflate',
+                   'User-Agent': 'propNews'}
+
+# Settings of the process-wide response cache, see configure
+cache_filename = None  # e.g. 'http_cache.db', keep the responses to GET requests in this SQLite database
+cache_ttl_s = 3600.0  # seconds a stored response is served without asking the server whether it changed
+host_cache_ttl_s = {}  # hostname -> cache_ttl_s, overrides cache_ttl_s for some hosts
+cache_keep_s = 7 * 24 * 3600.0  # seconds after which stored responses are deleted (when the cache is opened)
+replay = False  # if True, serve every GET request from the cache whatever its age, and never use the network
+cache_ignored_params = frozenset(['apikey'])  # query parameters (lower case) left out of cache keys, e.g. credentials
+
+_settings = ('connect_timeout', 'read_timeout', 'num_pools', 'maxsize', 'host_maxsize', 'proxy_url', 'default_headers',
+             'cache_filename', 'cache_ttl_s', 'host_cache_ttl_s', 'cache_keep_s', 'replay', 'cache_ignored_params')
+_cacheable_statuses = (200, 203, 300, 301, 404, 410)  # served from the cache outside replay too, see RFC 7231
+_unstored_headers = ('content-encoding', 'transfer-encoding', 'content-length')  # the stored body is decoded
+
+_manager = None
+_cache = None
+_manager_lock = threading.Lock()
+_stats = {'requests': 0, 'pool_misses': 0, 'hosts': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+class _CountingPoolMixin(object):
+    """Counts connection checkouts, and those which had to open a new connection instead of reusing a kept-alive one"""
+
+    def _get_conn(self, timeout=None):
+        _count('requests')
+        return super(_CountingPoolMixin, self)._get_conn(timeout)
+
+    def _new_conn(self):
+        _count('pool_misses')
+        return super(_CountingPoolMixin, self)._new_conn()
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _CountingManagerMixin(object):
+    """A pool manager which counts pool use and sizes the connection pool of each host from host_maxsize"""
+
+    def __init__(self, *args, **kwargs):
+        super(_CountingManagerMixin, self).__init__(*args, **kwargs)
+        self.pool_classes_by_scheme = {'http': _CountingHTTPConnectionPool, 'https': _CountingHTTPSConnectionPool}
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        if request_context is None:
+            request_context = self.connection_pool_kw.copy()
+        request_context['maxsize'] = host_maxsize.get(host, maxsize)
+        _count('hosts')
+        return super(_CountingManagerMixin, self)._new_pool(scheme, host, port, request_context=request_context)
+
+
+class _PoolManager(_CountingManagerMixin, urllib3.PoolManager):
+    pass
+
+
+class _ProxyManager(_CountingManagerMixin, urllib3.ProxyManager):
+    pass
+
+
+def configure(**settings):
+    """Change the settings of the process-wide pool manager (connect_timeout, read_timeout, num_pools, maxsize,
+    host_maxsize, proxy_url or default_headers) or response cache (cache_filename, cache_ttl_s, host_cache_ttl_s,
+    cache_keep_s, replay or cache_ignored_params). Pools opened, and the cache opened, with the previous settings are
+    closed.
+
+    Example
+    ------------------
+    >>> configure(read_timeout=10.0, host_maxsize={'www.bbc.co.uk': 8})
+    >>> configure(cache_filename='http_cache.db', replay=True)
+    """
+    global _manager, _cache
+    with _manager_lock:
+        for name, value in settings.items():
+            if name not in _settings:
+                raise ValueError('Unknown HTTP client setting: {}'.format(name))
+            globals()[name] = value
+        if _manager is not None:
+            _manager.clear()
+            _manager = None
+        if _cache is not None:
+            _cache.close()
+            _cache = None
+
+
+def get_pool_manager():
+    """Get the process-wide pool manager, creating it on first use"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            kwargs = dict(num_pools=num_pools, cert_reqs='CERT_REQUIRED', ca_certs=certifi.where(),
+                          headers=default_headers, timeout=urllib3.Timeout(connect=connect_timeout, read=read_timeout))
+            if proxy_url is None:
+                _manager = _PoolManager(**kwargs)
+            else:
+                _manager = _ProxyManager(proxy_url, **kwargs)
+        return _manager
+
+
+def get_response_cache():
+    """Get the process-wide ResponseCache, opening it on first use, or None if cache_filename is not set"""
+    global _cache
+    with _manager_lock:
+        if _cache is None and cache_filename is not None:
+            _cache = ResponseCache(cache_filename)
+        return _cache
+
+
+def request(url, method='GET', fields=None, headers=None, timeout=None):
+    """Make an HTTP request through the process-wide pool manager, and (if cache_filename is set) response cache
+
+    Parameters
+    ----------------
+    url : A string, the URL to request
+    method : A string, the HTTP method
+    fields : A dict, query parameters to encode into the URL
+    headers : A dict, headers to send in addition to default_headers
+    timeout : A float or urllib3.Timeout, overrides connect_timeout and read_timeout for this request
+
+    Returns
+    ----------------
+    response : A urllib3 HTTPResponse, with its body already read (and decompressed) into response.data
+    """
+    if headers is not None:
+        headers = dict(default_headers, **headers)
+    kwargs = {} if timeout is None else {'timeout': timeout}
+    cache = get_response_cache() if method == 'GET' else None
+    if cache is None:
+        return get_pool_manager().request(method, url, fields=fields, headers=headers, **kwargs)
+    if fields:
+        url += ('&' if '?' in url else '?') + urlencode(fields)
+    return cache.request(url, headers=headers, **kwargs)
+
+
+def get_json(url, fields=None, timeout=None):
+    """GET a URL and decode its body as JSON, see request"""
+    response = request(url, fields=fields, timeout=timeout)
+    return json.loads(response.data.decode('utf-8'))
+
+
+def cache_key(url, method='GET'):
+    """The key of a request in the response cache: the method, and the URL with its scheme and host lower-cased, no
+    fragment, and its query parameters sorted, leaving out cache_ignored_params
+    """
+    parts = urlsplit(url)
+    params = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                    if key.lower() not in cache_ignored_params)
+    return '{0} {1}'.format(method, urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/',
+                                                urlencode(params), '')))
+
+
+class CacheMissError(urllib3.exceptions.HTTPError):
+    """A request in replay mode which has no response in the cache"""
+    pass
+
+
+class ResponseCache(object):
+    """An on-disk store of HTTP responses to GET requests, keyed by cache_key, so that a rerun does not request what
+    was requested a short while ago again
+
+    A stored response younger than cache_ttl_s (or its host's host_cache_ttl_s) is served as it is. An older one is
+    revalidated with If-None-Match / If-Modified-Since if the server sent an ETag or Last-Modified, so an unchanged
+    page costs a 304 instead of a download. Responses with Cache-Control: no-store, and server errors, are not stored.
+    In replay mode, every request is served from the store, and a request which is not in it raises CacheMissError.
+
+    Bodies are kept decoded and zlib-compressed, in their own SQLite database (like the article cache).
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the cache database. It is created if it does not exist
+    """
+
+    def __init__(self, db_filename):
+        self.db_filename = db_filename
+        self._lock = threading.Lock()
+        self._conn = sq.connect(db_filename, check_same_thread=False, timeout=30.0)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                              key TEXT PRIMARY KEY,
+                              status INTEGER NOT NULL,
+                              headers TEXT NOT NULL,
+                              body BLOB NOT NULL,
+                              stored_at REAL NOT NULL
+                              )
+                           ''')
+        if not replay:
+            self._conn.execute('DELETE FROM responses WHERE stored_at < ?', (time.time() - cache_keep_s,))
+        self._conn.commit()
+
+    def get(self, key):
+        """Look up a stored response
+
+        Returns
+        ----------------
+        entry : None if key is not in the cache, otherwise a tuple (status, headers, body, stored_at) where status is
+                an int, headers a dict, body bytes and stored_at a float, seconds since the epoch
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT status, headers, body, stored_at FROM responses WHERE key=?',
+                                     (key,)).fetchone()
+        if row is None:
+            return None
+        status, headers, body, stored_at = row
+        return status, json.loads(headers), zlib.decompress(body), stored_at
+
+    def put(self, key, response):
+        """Store a response (a urllib3 HTTPResponse whose body has been read)"""
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in _unstored_headers}
+        with self._lock:
+            with self._conn:
+                self._conn.execute('''INSERT OR REPLACE INTO responses(key, status, headers, body, stored_at)
+                                      VALUES(?, ?, ?, ?, ?)''', (key, response.status, json.dumps(headers),
+                                                                   zlib.compress(response.data), time.time()))
+
+    def touch(self, key):
+        """Record that a stored response was revalidated, so that it is fresh for another TTL"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute('UPDATE responses SET stored_at=? WHERE key=?', (time.time(), key))
+
+    def request(self, url, headers=None, **kwargs):
+        """GET a URL through the cache, see request"""
+        key = cache_key(url)
+        entry = self.get(key)
+        if entry is not None:
+            status, stored_headers, body, stored_at = entry
+            ttl_s = host_cache_ttl_s.get(urlsplit(url).hostname, cache_ttl_s)
+            if replay or (status in _cacheable_statuses and time.time() - stored_at < ttl_s):
+                metrics.inc('http_cache_hits_total')
+                return urllib3.HTTPResponse(body=body, headers=stored_headers, status=status)
+        metrics.inc('http_cache_misses_total')
+        if replay:
+            raise CacheMissError('No response to {} in the cache'.format(key))
+
+        headers = dict(default_headers if headers is None else headers)
+        if entry is not None and status in _cacheable_statuses:
+            stored = urllib3.HTTPHeaderDict(stored_headers)
+            if 'ETag' in stored:
+                headers['If-None-Match'] = stored['ETag']
+            if 'Last-Modified' in stored:
+                headers['If-Modified-Since'] = stored['Last-Modified']
+        response = get_pool_manager().request('GET', url, headers=headers, **kwargs)
+        if response.status == 304 and entry is not None:
+            metrics.inc('http_cache_revalidations_total')
+            self.touch(key)
+            return urllib3.HTTPResponse(body=body, headers=stored_headers, status=status)
+        if response.status < 500 and 'no-store' not in response.headers.get('Cache-Control', '').lower():
+            self.put(key, response)
+        return response
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def pool_stats():
+    """Connection pool statistics since the process started
+
+    Returns
+    ----------------
+    stats : A dict with keys
+                - 'requests' : An int, the number of connections checked out of a pool
+                - 'pool_hits' : An int, the number of requests which reused a kept-alive connection
+                - 'pool_misses' : An int, the number of requests which had to open a new connection
+                - 'hosts' : An int, the number of host connection pools created
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['pool_hits'] = stats['requests'] - stats['pool_misses']
+    return stats
+
+
+class TokenBucket(object):
+    """A token-bucket rate limiter, shared by the threads making requests to one service
+
+    Tokens accrue at rate per second, up to capacity, and each request takes one. A request made when the bucket is
+    empty reserves the next token and sleeps until it has accrued, so waiting requests are served in order.
+
+    Parameters
+    ----------------
+    rate : A float, the sustained number of requests per second
+    capacity : A float, the number of requests which may be made in a burst
+    """
+
+    def __init__(self, rate, capacity=1.0):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, blocking until one is available"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1.0
+            wait_s = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait_s > 0:
+            time.sleep(wait_s)
@@ -0,0 +1,452 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import signal
+import socket
+import sqlite3 as sq
+import subprocess
+import sys
+import threading
+import time
+import dedup
+import metrics
+import news_db
+import news_store
+import score_articles
+from get_full_content import fetch_many_contents
+from sources import get_source_registry
+
+dt_format = "%Y-%m-%dT%H:%M:%S"
+lease_s = 300.0  # a claimed job not reported back within this time is handed to another worker
+claim_size = 20  # jobs a worker claims at a time
+max_attempts = 3  # claims of a job whose page could not be fetched before it is scored on its description alone
+retry_delay_s = 60.0  # delay before a job whose page could not be fetched is claimed again, doubled for each attempt
+write_batch_size = 500  # scored jobs written to the news database per transaction
+idle_sleep_s = 1.0  # how long a worker, or the writer, waits before looking at an empty queue again
+drain_timeout_s = 120.0  # the longest drain waits for workers; results still outstanding are written by the next one
+journal_mode = 'WAL'  # 'DELETE' if workers on several hosts share the queue over a network filesystem, where WAL fails
+
+_jobs_create_str = '''CREATE TABLE IF NOT EXISTS jobs (
+                      url TEXT PRIMARY KEY,
+                      published_at DATETIME,
+                      source TEXT,
+                      description TEXT,
+                      state TEXT NOT NULL DEFAULT 'pending',
+                      attempts INTEGER NOT NULL DEFAULT 0,
+                      worker TEXT,
+                      available_at REAL NOT NULL,
+                      enqueued_at REAL NOT NULL,
+                      score REAL,
+                      topics TEXT,
+                      simhash INTEGER,
+                      scorer_version TEXT,
+                      table_scores TEXT
+                      )
+                   '''
+_local = threading.local()  # per-thread dict of queue_filename -> connection
+
+
+def configure(**settings):
+    """Change the queue settings (lease_s, claim_size, max_attempts, retry_delay_s, write_batch_size, idle_sleep_s,
+    drain_timeout_s or journal_mode). Call it before the queue is first opened.
+
+    Example
+    ------------------
+    >>> configure(lease_s=600.0, journal_mode='DELETE')
+    """
+    for name, value in settings.items():
+        if name not in ('lease_s', 'claim_size', 'max_attempts', 'retry_delay_s', 'write_batch_size', 'idle_sleep_s',
+                        'drain_timeout_s', 'journal_mode'):
+            raise ValueError('Unknown job queue setting: {}'.format(name))
+        globals()[name] = value
+
+
+def connect(queue_filename):
+    """Get this thread's persistent connection to a job queue, creating the queue on first use
+
+    The connection is in autocommit mode; the queue's functions open their own write transactions, with BEGIN
+    IMMEDIATE so that two workers never claim the same job.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(queue_filename)
+    if conn is None:
+        conn = sq.connect(queue_filename, timeout=news_db.busy_timeout_s, isolation_level=None)
+        conn.execute('PRAGMA journal_mode={}'.format(journal_mode))
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(_jobs_create_str)
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_state_available_at ON jobs(state, available_at)')
+        connections[queue_filename] = conn
+    return conn
+
+
+@contextlib.contextmanager
+def _transaction(conn):
+    """A write transaction on an autocommit connection, taken with BEGIN IMMEDIATE"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def enqueue_page(queue_filename, db_filename, js):
+    """Queue the articles of a page of NewsAPI results to be fetched and scored by workers, see process_page
+
+    URLs are canonicalized first (see dedup.canonicalize_url), and articles already in the news database, or already
+    queued, are skipped.
+
+    Parameters
+    ----------------
+    queue_filename : A string, the name of the job queue database
+    db_filename : A string, the name of the news database
+    js : A dict, the decoded JSON of the page
+
+    Returns
+    ----------------
+    n_queued : An int, the number of articles queued
+    """
+    now = time.time()
+    jobs = []
+    seen = news_store.find_known_urls(db_filename,
+                                      [dedup.canonicalize_url(article['url']) for article in js['articles']],
+                                      [article['publishedAt'] for article in js['articles']])
+    for article in js['articles']:
+        url = dedup.canonicalize_url(article['url'])
+        if url in seen:
+            metrics.inc('duplicate_urls_total')
+            continue
+        seen.add(url)
+        jobs.append((url, article['publishedAt'][:-1], article['source']['id'], article['description'], now, now))
+    conn = connect(queue_filename)
+    with _transaction(conn):
+        before = conn.total_changes
+        conn.executemany('''INSERT OR IGNORE INTO jobs(url, published_at, source, description, available_at,
+                            enqueued_at) VALUES(?, ?, ?, ?, ?, ?)''', jobs)
+        n_queued = conn.total_changes - before
+    metrics.inc('jobs_queued_total', n_queued)
+    print('Queued {} results'.format(n_queued))
+    return n_queued
+
+
+def status(queue_filename):
+    """The number of jobs in each state: 'pending', 'leased' (claimed by a worker), 'done' (scored, waiting to be
+    written) and 'failed' (claimed max_attempts times by workers which never reported back)
+    """
+    counts = dict((state, 0) for state in ('pending', 'leased', 'done', 'failed'))
+    counts.update(connect(queue_filename).execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+    return counts
+
+
+def claim(queue_filename, worker, n_jobs):
+    """Lease up to n_jobs jobs to a worker, oldest first, including jobs whose lease by another worker has run out
+
+    Returns
+    ----------------
+    jobs : A list of tuples (url, published_at, source, description, attempts), attempts counting this claim
+    """
+    now = time.time()
+    conn = connect(queue_filename)
+    with _transaction(conn):
+        # A job whose every lease ran out is failing its workers (e.g. crashing them), so stop handing it out
+        failed = conn.execute('''UPDATE jobs SET state='failed', worker=NULL
+                                 WHERE state='leased' AND available_at <= ? AND attempts >= ?''',
+                              (now, max_attempts)).rowcount
+        jobs = conn.execute('''SELECT url, published_at, source, description, attempts, state FROM jobs
+                               WHERE state IN ('pending', 'leased') AND available_at <= ?
+                               ORDER BY enqueued_at, rowid LIMIT ?''', (now, n_jobs)).fetchall()
+        conn.executemany('''UPDATE jobs SET state='leased', worker=?, attempts=attempts+1, available_at=?
+                            WHERE url=?''', [(worker, now + lease_s, job[0]) for job in jobs])
+    metrics.inc('jobs_failed_total', failed)
+    metrics.inc('jobs_claimed_total', len(jobs))
+    metrics.inc('job_leases_expired_total', sum(1 for job in jobs if job[5] == 'leased'))
+    return [(url, published_at, source, description, attempts + 1)
+            for url, published_at, source, description, attempts, _ in jobs]
+
+
+def _load_scorer(qaly_path, compare_qaly_paths):
+    if compare_qaly_paths:
+        return score_articles.load_multi_scorer([qaly_path] + list(compare_qaly_paths), primary_path=qaly_path)
+    return score_articles.load_qaly_scorer(qaly_path)
+
+
+def work(queue_filename, worker, qaly_path, url_path, cache_filename='article_cache.db', fetch_workers=8,
+         compare_qaly_paths=()):
+    """Claim a batch of jobs, fetch, extract and score their articles, and report the results back to the queue
+
+    A job whose page could not be fetched is released to be claimed again after retry_delay_s (doubling with each
+    attempt); on its last attempt it is scored on its description, as process_page would. Results are only accepted
+    while the worker still holds the job's lease.
+
+    Parameters
+    ----------------
+    queue_filename : A string, the name of the job queue database
+    worker : A string, identifies the worker, e.g. <host>:<pid>
+    qaly_path : A string, directory of the QALY table
+    url_path : A string, directory of the url lookup table
+    cache_filename : A string, the name of the article cache database, which extracted article text is saved to
+    fetch_workers : An int, the maximum number of article pages fetched concurrently
+    compare_qaly_paths : A list of strings, see get_articles.get_many_results
+
+    Returns
+    ----------------
+    n_claimed : An int, the number of jobs claimed, 0 if the queue had none to hand out
+    """
+    jobs = claim(queue_filename, worker, claim_size)
+    if not jobs:
+        return 0
+    qaly_scorer = _load_scorer(qaly_path, compare_qaly_paths)
+    registry = get_source_registry(url_path)
+    contents = fetch_many_contents(url_path, [job[0] for job in jobs], cache_filename, max_workers=fetch_workers)
+
+    article_dict = {}
+    fingerprints = {}
+    retries = []
+    now = time.time()
+    for (url, published_at, source, desc, attempts), content in zip(jobs, contents):
+        if content is None and registry.lookup(url) is not None and attempts < max_attempts:
+            retries.append((now + retry_delay_s * 2 ** (attempts - 1), url, worker))
+            continue
+        fingerprints[url] = dedup.simhash(desc if content is None else content)
+        article_dict[url] = {'content': score_articles.scored_text(desc, content)}
+    article_dict = score_articles.score_all(article_dict, qaly_scorer)
+
+    if isinstance(qaly_scorer, score_articles.MultiQalyScorer):
+        scorer_version = qaly_scorer.scorers[qaly_scorer.primary].version
+    else:
+        scorer_version = qaly_scorer.version
+    results = []
+    for url, url_dict in article_dict.items():
+        fingerprint = fingerprints[url]
+        results.append((url_dict['score'], json.dumps(url_dict['topics']),
+                        None if fingerprint is None else dedup.to_signed(fingerprint), scorer_version,
+                        json.dumps(url_dict['table_scores']) if 'table_scores' in url_dict else None, url, worker))
+    conn = connect(queue_filename)
+    with _transaction(conn):
+        conn.executemany('''UPDATE jobs SET state='done', worker=NULL, score=?, topics=?, simhash=?, scorer_version=?,
+                                table_scores=?
+                            WHERE url=? AND worker=? AND state='leased' ''', results)
+        conn.executemany('''UPDATE jobs SET state='pending', worker=NULL, available_at=?
+                            WHERE url=? AND worker=? AND state='leased' ''', retries)
+    metrics.inc('job_retries_total', len(retries))
+    return len(jobs)
+
+
+def run_worker(queue_filename, qaly_path, url_path, cache_filename='article_cache.db', fetch_workers=8,
+               compare_qaly_paths=(), until_empty=False, stop=None):
+    """Work on the queue until stopped, see work
+
+    Parameters
+    ----------------
+    until_empty : A bool, if True return once no job is pending or leased, rather than wait for more
+    stop : A threading.Event, which stops the worker once its current batch is reported back
+    """
+    worker = '{0}:{1:d}'.format(socket.gethostname(), os.getpid())
+    stop = threading.Event() if stop is None else stop
+    while not stop.is_set():
+        if work(queue_filename, worker, qaly_path, url_path, cache_filename=cache_filename,
+                fetch_workers=fetch_workers, compare_qaly_paths=compare_qaly_paths) == 0:
+            counts = status(queue_filename)
+            if until_empty and counts['pending'] == 0 and counts['leased'] == 0:
+                return
+            stop.wait(idle_sleep_s)
+
+
+def start_workers(n_workers, queue_filename, qaly_path, url_path, cache_filename='article_cache.db', fetch_workers=8,
+                  compare_qaly_paths=(), until_empty=False):
+    """Start worker processes on this host, each running this module's command line (see run_worker), e.g. alongside
+    the coordinator. They are separate processes, rather than threads, so that scoring uses as many cores.
+
+    Returns
+    ----------------
+    processes : A list of subprocess.Popen, see stop_workers
+    """
+    command = [sys.executable, os.path.abspath(__file__), '-worker', '-queue_filename', queue_filename,
+               '-qaly_path', qaly_path, '-url_path', url_path, '-cache_filename', cache_filename,
+               '-fetch_workers', str(fetch_workers), '-lease_s', repr(lease_s), '-claim_size', str(claim_size),
+               '-journal_mode', journal_mode]
+    if compare_qaly_paths:
+        command += ['-compare_qaly_paths'] + list(compare_qaly_paths)
+    if until_empty:
+        command.append('-until_empty')
+    return [subprocess.Popen(command) for _ in range(n_workers)]
+
+
+def stop_workers(processes):
+    """Ask worker processes to finish their current batch and exit, and wait for them"""
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def write_results(queue_filename, db_filename, qaly_path, compare_qaly_paths=(), dedup_index=None):
+    """Write a batch of scored jobs to the news database, and remove them from the queue
+
+    Only one process should write results to a news database, so that near-duplicates are detected against every
+    article written before them, in the order they were queued. Jobs scored by a different version of the QALY table
+    than the current one are queued again, so every article records the version which scored it.
+
+    Parameters
+    ----------------
+    queue_filename : A string, the name of the job queue database
+    db_filename : A string, the name of the news database
+    qaly_path : A string, directory of the QALY table
+    compare_qaly_paths : A list of strings, see get_articles.get_many_results
+    dedup_index : A dedup.SimHashIndex, see get_articles.process_page
+
+    Returns
+    ----------------
+    n_written : An int, the number of jobs taken off the queue, as new articles or duplicates
+    """
+    conn = connect(queue_filename)
+    rows = conn.execute('''SELECT url, published_at, source, description, score, topics, simhash, scorer_version,
+                               table_scores FROM jobs WHERE state='done' ORDER BY enqueued_at, rowid LIMIT ?''',
+                        (write_batch_size,)).fetchall()
+    if not rows:
+        return 0
+    qaly_scorer = _load_scorer(qaly_path, compare_qaly_paths)
+    if isinstance(qaly_scorer, score_articles.MultiQalyScorer):
+        scorer_version = qaly_scorer.scorers[qaly_scorer.primary].version
+    else:
+        scorer_version = qaly_scorer.version
+
+    known = news_store.find_known_urls(db_filename, [row[0] for row in rows], [row[1] for row in rows])
+    article_dict = {}
+    fingerprints = []
+    duplicates = []
+    stale = []
+    for url, published_at, source, description, score, topics, fingerprint, version, table_scores in rows:
+        if url in known:  # written before the queue was last cleared, e.g. by a writer which crashed
+            continue
+        if version != scorer_version:
+            stale.append(url)
+            continue
+        if fingerprint is not None and dedup_index is not None:
+            fingerprint = dedup.from_signed(fingerprint)
+            original_url = dedup_index.find(fingerprint)
+            if original_url is not None:
+                metrics.inc('near_duplicates_total')
+                duplicates.append((url, original_url))
+                continue
+            dedup_index.add(url, fingerprint)
+            fingerprints.append((url, fingerprint, published_at))
+        article_dict[url] = {'score': score,
+                             'topics': json.loads(topics),
+                             'publishedAt': published_at,
+                             'source': source,
+                             'description': description}
+        if table_scores is not None:
+            article_dict[url]['table_scores'] = dict((name, tuple(result))
+                                                     for name, result in json.loads(table_scores).items())
+
+    if article_dict:
+        news_store.update_news_db(db_filename, article_dict, qaly_scorer)
+    news_store.save_fingerprints(db_filename, fingerprints, duplicates)
+    now = time.time()
+    with _transaction(conn):
+        conn.executemany("UPDATE jobs SET state='pending', attempts=0, available_at=? WHERE url=? AND state='done'",
+                         [(now, url) for url in stale])
+        conn.executemany("DELETE FROM jobs WHERE url=? AND state='done'",
+                         [(row[0],) for row in rows if row[0] not in stale])
+    metrics.inc('jobs_written_total', len(rows) - len(stale))
+    return len(rows) - len(stale)
+
+
+def drain(queue_filename, db_filename, qaly_path, compare_qaly_paths=(), timeout_s=None):
+    """Write the results of the queued jobs as workers finish them, until no job is left or timeout_s runs out
+
+    Parameters
+    ----------------
+    queue_filename : A string, the name of the job queue database
+    db_filename : A string, the name of the news database
+    qaly_path : A string, directory of the QALY table
+    compare_qaly_paths : A list of strings, see get_articles.get_many_results
+    timeout_s : A float, the longest to wait for workers, by default drain_timeout_s
+
+    Returns
+    ----------------
+    n_written : An int, see write_results
+    """
+    timeout_s = drain_timeout_s if timeout_s is None else timeout_s
+    conn = connect(queue_filename)
+    oldest = conn.execute('SELECT MIN(published_at) FROM jobs').fetchone()[0]
+    if oldest is None:
+        return 0
+    since = datetime.datetime.strptime(oldest, dt_format) - datetime.timedelta(hours=news_store.dedup_window_hours)
+    dedup_index = news_store.load_dedup_index(db_filename, since)
+
+    start = time.time()
+    n_written = 0
+    while True:
+        n_batch = write_results(queue_filename, db_filename, qaly_path, compare_qaly_paths=compare_qaly_paths,
+                                dedup_index=dedup_index)
+        n_written += n_batch
+        if n_batch > 0:
+            continue
+        counts = status(queue_filename)
+        if counts['pending'] == 0 and counts['leased'] == 0:
+            break
+        if time.time() - start > timeout_s:
+            print('WARNING: {0} jobs still pending and {1} leased, leaving them for the next refresh'.format(
+                counts['pending'], counts['leased']))
+            break
+        time.sleep(idle_sleep_s)
+    if counts['failed'] > 0:
+        print('WARNING: {} jobs failed, see the jobs table of {}'.format(counts['failed'], queue_filename))
+    return n_written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fetch, extract and score queued articles, as one of the workers of "
+                                                 "main.py -queue_filename.")
+    parser.add_argument('-queue_filename', default='jobs.db', type=str,
+                        help="The job queue database (default = jobs.db)")
+    parser.add_argument('-worker', action='store_true', help="Work on the queue until stopped")
+    parser.add_argument('-workers', default=1, type=int,
+                        help="With -worker, the number of worker processes to run on this host (default = 1)")
+    parser.add_argument('-until_empty', action='store_true',
+                        help="With -worker, stop once no job is pending, rather than wait for more")
+    parser.add_argument('-qaly_path', default='global_prios/global_prios.csv', type=str,
+                        help="Path to the QALY table (default = global_prios/global_prios.csv)")
+    parser.add_argument('-compare_qaly_paths', default=[], type=str, nargs='+',
+                        help="Alternative QALY tables to also score against, as given to main.py")
+    parser.add_argument('-url_path', default='url_content_lookup.csv', type=str,
+                        help="Directory of the url lookup table")
+    parser.add_argument('-cache_filename', default='article_cache.db', type=str,
+                        help="The database caching extracted article text, on a disk local to this host "
+                             "(default = article_cache.db)")
+    parser.add_argument('-fetch_workers', default=8, type=int,
+                        help="Maximum number of article pages each worker fetches concurrently (default = 8)")
+    parser.add_argument('-lease_s', default=lease_s, type=float,
+                        help="Time after which a job claimed by a worker which has not reported back is handed to "
+                             "another (s). Default = 300.")
+    parser.add_argument('-claim_size', default=claim_size, type=int,
+                        help="Number of jobs a worker claims at a time (default = 20)")
+    parser.add_argument('-journal_mode', default=journal_mode, type=str,
+                        help="Journal mode of the queue database: WAL, or DELETE if workers on several hosts share it "
+                             "over a network filesystem (default = WAL)")
+    args = parser.parse_args()
+    configure(lease_s=args.lease_s, claim_size=args.claim_size, journal_mode=args.journal_mode)
+
+    if args.worker and args.workers > 1:
+        _processes = start_workers(args.workers, args.queue_filename, args.qaly_path, args.url_path,
+                                   cache_filename=args.cache_filename, fetch_workers=args.fetch_workers,
+                                   compare_qaly_paths=args.compare_qaly_paths, until_empty=args.until_empty)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_workers(_processes))
+        for _process in _processes:
+            _process.wait()
+    elif args.worker:
+        _stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: _stop.set())
+        run_worker(args.queue_filename, args.qaly_path, args.url_path, cache_filename=args.cache_filename,
+                   fetch_workers=args.fetch_workers, compare_qaly_paths=args.compare_qaly_paths,
+                   until_empty=args.until_empty, stop=_stop)
+    else:
+        for _state, _count in status(args.queue_filename).items():
+            print('{0}: {1}'.format(_state, _count))
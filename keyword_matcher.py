@@ -0,0 +1,77 @@
+from collections import deque
+
+
+class KeywordMatcher(object):
+    """Aho-Corasick automaton which finds every keyword of a fixed set occurring in a text in a single scan
+
+    Matching is case-sensitive substring matching, i.e. keyword k is found in text iff `k in text`.
+
+    Parameters
+    ----------------
+    keywords : An iterable of strings, the keywords to search for
+    """
+
+    def __init__(self, keywords):
+        self.keywords = frozenset(k for k in keywords if k)
+        # State 0 is the root. goto[s] maps a character to the next state, fail[s] is the failure link and out[s]
+        # holds the keywords which end at state s (including those inherited through failure links).
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for keyword in sorted(self.keywords):
+            self._add(keyword)
+        self._link()
+
+    def _add(self, keyword):
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+                self._goto[state][char] = next_state
+            state = next_state
+        self._out[state] = (keyword,)
+
+    def _link(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+    def find(self, text):
+        """Find the keywords which occur in text
+
+        Parameters
+        ----------------
+        text : A string, the text to scan
+
+        Returns
+        ----------------
+        found : A set of strings, the keywords which occur in text
+        """
+        found = set()
+        if not text or not self.keywords:
+            return found
+        goto, fail, out = self._goto, self._fail, self._out
+        root = goto[0]
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0) if state else root.get(char, 0)
+            if out[state]:
+                found.update(out[state])
+                if len(found) == len(self.keywords):
+                    break
+        return found
@@ -26,6 +26,70 @@ def flatten(y):
     return out
 
 
+def build_tree(y):
+    """Converts a nested token list into a boolean expression tree without expanding it
+
+    Returns
+    -----------
+    tree : A string (a single keyword), or a tuple (op, children) where op is 'AND' or 'OR' and children is a tuple of
+           trees. Repeated children are dropped and single-child nodes are collapsed, so equal subexpressions compare
+           (and hash) equal.
+    """
+    if isinstance(y, str):
+        return y.strip('"')
+    if 'AND' in y and 'OR' in y:
+        raise RuntimeError('check bracketing--cannot have both AND and OR in same clause: %s' % str(y))
+    op = 'OR' if 'OR' in y else 'AND'
+    children = []
+    for a in y:
+        if a == op:
+            continue
+        child = build_tree(a)
+        # Flatten e.g. a AND (b AND c) into a AND b AND c
+        if not isinstance(child, str) and child[0] == op:
+            grandchildren = child[1]
+        else:
+            grandchildren = (child,)
+        for grandchild in grandchildren:
+            if grandchild not in children:
+                children.append(grandchild)
+    if len(children) == 1:
+        return children[0]
+    return op, tuple(children)
+
+
+def tokenize(x):
+    """Parses a logic statement into a nested list of tokens, following its bracketing"""
+    content = pyparsing.Word(pyparsing.alphanums)
+    parser = pyparsing.nestedExpr('(', ')', content=content)
+    x = '('+x+')'
+    token_list = parser.parseString(x).asList()
+    while len(token_list) == 1:
+        token_list = token_list[0]
+    return token_list
+
+
+def parse_expression(x):
+    """Parses a logic statement into a boolean expression tree (see build_tree).
+
+    Unlike parse_keywords, the statement is not expanded into DNF, so its size stays linear in the length of x.
+
+    Parameters
+    ------------------
+    x : A string, a logical statement, in the format accepted by parse_keywords
+
+    Returns
+    -----------
+    tree : A string or a tuple (op, children), the logical statement x as a tree
+
+    Example
+    ------------------
+    >>> parse_expression('poverty AND (global OR "international challenge" OR (africa AND subafrica))')
+    >>> ('AND', ('poverty', ('OR', ('global', 'international challenge', ('AND', ('africa', 'subafrica'))))))
+    """
+    return build_tree(tokenize(x))
+
+
 def parse_keywords(x):
     """Parses a logic statement and outputs its DNF form (ORs of ANDs).
     
@@ -53,12 +117,6 @@ def parse_keywords(x):
         ['poverty', 'lower', 'mid', 'income'],
         ['poverty', 'lower', 'm', 'M', 'income']]
     """
-    content = pyparsing.Word(pyparsing.alphanums)
-    parser = pyparsing.nestedExpr('(', ')', content=content)
-    x = '('+x+')'
-    token_list = parser.parseString(x).asList()
-    while len(token_list) == 1:
-        token_list = token_list[0]
-    token_list = [flatten(x) for x in unroll(token_list)]
+    token_list = [flatten(x) for x in unroll(tokenize(x))]
 
     return token_list
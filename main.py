@@ -1,29 +1,91 @@
 import tweepy
 import tweeting
 import argparse
+import asyncio
+import atexit
+import backup
+import daemon
+import http_client
+import job_queue
+import metrics
 from time import sleep
 
 parser = argparse.ArgumentParser(description="Tweet news stories periodically according to global priorities.")
-parser.add_argument('-dbg_mode', default=False, type=bool, nargs=1, help="Run in debug mode (default = False)")
-parser.add_argument('-tw_cred', default='twitter_API_keys.txt', type=str, nargs=1,
+parser.add_argument('-dbg_mode', default=False, type=bool, help="Run in debug mode (default = False)")
+parser.add_argument('-tw_cred', default='twitter_API_keys.txt', type=str,
                     help="Contains Twitter API credentials. Must be in directory above repo.")
-parser.add_argument('-news_cred', default='newsapi_key.txt', type=str, nargs=1,
+parser.add_argument('-news_cred', default='newsapi_key.txt', type=str,
                     help="Contains NewsAPI key. Must be in directory above repo.")
-parser.add_argument('-url_path', default='url_content_lookup.csv', type=str, nargs=1,
+parser.add_argument('-url_path', default='url_content_lookup.csv', type=str,
                     help="Directory of the url lookup table")
-parser.add_argument('-qaly_path', type=str, nargs=1, default='global_prios/global_prios.csv',
+parser.add_argument('-qaly_path', type=str, default='global_prios/global_prios.csv',
                     help="Path to the QALY table (default =global_prios/global_prios.csv)")
-parser.add_argument('-db_filename', default='news.db', type=str, nargs=1,
+parser.add_argument('-db_filename', default='news.db', type=str,
                     help="Name of news database. Default = news.db")
+parser.add_argument('-cache_filename', default='article_cache.db', type=str,
+                    help="Name of the database caching extracted article text. Default = article_cache.db")
 
-parser.add_argument('-periodicity_s', default=3600, type=float, nargs=1,
+parser.add_argument('-periodicity_s', default=3600, type=float,
                     help="Tweet periodicity (s). Default=3600.")
-parser.add_argument('-max_time', default=7*24*3600, type=float, nargs=1,
+parser.add_argument('-max_time', default=7*24*3600, type=float,
                     help="Duration to tweet (s). Default=604800 (1 week).")
-parser.add_argument('-tweet_time_window', default=2*7*24.0, type=float, nargs=1,
+parser.add_argument('-tweet_time_window', default=2*7*24.0, type=float,
                     help="Time window to search into the past for news (hours). Default=336 (2 weeks).")
-parser.add_argument('-news_refresh_period', default=24.0/3, type=float, nargs=1,
-                    help="Periodicity to update news database (hours). Default = 8.")
+parser.add_argument('-news_refresh_period', default=24.0/3, type=float,
+                    help="Longest period between polls of a news source (hours); busier sources are polled more "
+                         "often, as their publish rates call for. Default = 8.")
+parser.add_argument('-daemon', action='store_true',
+                    help="Run ingestion, rescoring and tweeting as independent scheduled tasks, so that a slow news "
+                         "refresh does not delay tweets. Stop with SIGINT or SIGTERM.")
+parser.add_argument('-ingest_check_s', default=600.0, type=float,
+                    help="In daemon mode, periodicity to check if the news database is out of date (s). Default=600.")
+parser.add_argument('-rescore_check_s', default=300.0, type=float,
+                    help="In daemon mode, periodicity to check if the QALY table has changed (s). Default=300.")
+parser.add_argument('-http_cache', default=None, type=str,
+                    help="Keep NewsAPI and publisher responses in this database, so that a rerun within "
+                         "-http_cache_ttl_s does not request them again. Default: off, or http_cache.db in debug mode.")
+parser.add_argument('-http_cache_ttl_s', default=3600.0, type=float,
+                    help="Age after which a cached response is revalidated with the server (s). Default=3600.")
+parser.add_argument('-replay', action='store_true',
+                    help="Serve every NewsAPI and publisher request from -http_cache, without using the network.")
+parser.add_argument('-hot_days', default=None, type=float,
+                    help="After each refresh, move articles published more than this many days ago out of the news "
+                         "database into monthly archives (e.g. news.2020-01.db), keeping the database the tweets are "
+                         "drawn from small. Must cover -tweet_time_window. Default: keep all articles.")
+parser.add_argument('-compare_qaly_paths', default=[], type=str, nargs='+',
+                    help="Also score each new article against these QALY tables, in the same pass, saving the scores "
+                         "in the table_scores table of the news database. Tweets follow -qaly_path only.")
+parser.add_argument('-queue_filename', default=None, type=str,
+                    help="Queue new articles in this database for worker processes to fetch and score (see "
+                         "job_queue.py), writing their results here. Default: fetch and score in this process.")
+parser.add_argument('-queue_workers', default=0, type=int,
+                    help="With -queue_filename, the number of worker processes to start on this host. More can be "
+                         "started, here or on hosts sharing the filesystem, with python job_queue.py -worker. "
+                         "Default = 0.")
+parser.add_argument('-queue_lease_s', default=300.0, type=float,
+                    help="With -queue_filename, the time after which a job claimed by a worker which has not reported "
+                         "back is handed to another worker (s). Default = 300.")
+parser.add_argument('-queue_journal_mode', default='WAL', type=str,
+                    help="Journal mode of the job queue: WAL, or DELETE if workers on other hosts share it over a "
+                         "network filesystem (as must theirs, with job_queue.py -journal_mode). Default = WAL.")
+parser.add_argument('-backup_dir', default=None, type=str,
+                    help="Directory of the news database's backups. Default: the directory of the database.")
+parser.add_argument('-backup_retention', default=3, type=int,
+                    help="Number of backup generations to keep. Default=3.")
+parser.add_argument('-wal_shipping', action='store_true',
+                    help="Back up by shipping the news database's new WAL frames after each refresh (and in daemon "
+                         "mode every -backup_check_s), taking a full snapshot once a day, rather than by taking a full "
+                         "snapshot after each refresh.")
+parser.add_argument('-backup_check_s', default=600.0, type=float,
+                    help="In daemon mode with -wal_shipping, periodicity to ship the WAL (s). Default=600.")
+parser.add_argument('-metrics_file', default=None, type=str,
+                    help="Write pipeline counters and latency histograms to this file periodically, in the Prometheus "
+                         "text format if it ends in .prom, otherwise as JSON. Default: off.")
+parser.add_argument('-metrics_interval_s', default=60.0, type=float,
+                    help="Periodicity to write the metrics file (s). Default=60.")
+parser.add_argument('-profile_dir', default=None, type=str,
+                    help="Profile each news refresh and rescore with cProfile, writing the stats into this directory. "
+                         "Default: off.")
 
 
 args = parser.parse_args()
@@ -33,10 +95,13 @@ news_api_filename = args.news_cred
 url_path = args.url_path
 qaly_path = args.qaly_path
 db_filename = args.db_filename
+cache_filename = args.cache_filename
 periodicity_s = args.periodicity_s
 max_time = args.max_time
 tweet_time_window = args.tweet_time_window
 news_refresh_period = args.news_refresh_period
+if args.hot_days is not None and args.hot_days * 24 < tweet_time_window:
+    parser.error('-hot_days must cover -tweet_time_window')
 
 credentials_dir = '../'
 
@@ -59,8 +124,36 @@ auth = tweepy.OAuthHandler(consumer_token, consumer_secret)
 auth.set_access_token(access_token, access_token_secret)
 tweepyapi = tweepy.API(auth)
 
-while True:
-    tweeting.tweet_news(tweepyapi, api_key, qaly_path, url_path,
-                        db_filename, tweet_time_window, news_refresh_period,
-                        dbg_mode=dbg_mode)
-    sleep(periodicity_s)
+http_cache = args.http_cache
+if http_cache is None and (dbg_mode or args.replay):
+    http_cache = 'http_cache.db'
+http_client.configure(cache_filename=http_cache, cache_ttl_s=args.http_cache_ttl_s, replay=args.replay)
+backup.configure(backup_dir=args.backup_dir, retention=args.backup_retention, wal_shipping=args.wal_shipping)
+job_queue.configure(lease_s=args.queue_lease_s, journal_mode=args.queue_journal_mode)
+metrics.profile_dir = args.profile_dir
+exporter = None
+if args.metrics_file is not None:
+    exporter = metrics.Exporter(args.metrics_file, interval_s=args.metrics_interval_s).start()
+
+if args.queue_filename is not None and args.queue_workers > 0:
+    workers = job_queue.start_workers(args.queue_workers, args.queue_filename, qaly_path, url_path,
+                                      cache_filename=cache_filename, compare_qaly_paths=args.compare_qaly_paths)
+    atexit.register(job_queue.stop_workers, workers)
+elif args.queue_filename is not None:
+    print('WARNING: no -queue_workers, queued articles wait for workers started with python job_queue.py -worker')
+
+if args.daemon:
+    asyncio.run(daemon.run(tweepyapi, api_key, qaly_path, url_path, db_filename, tweet_time_window,
+                           news_refresh_period, periodicity_s, ingest_check_s=args.ingest_check_s,
+                           rescore_check_s=args.rescore_check_s, backup_check_s=args.backup_check_s,
+                           dbg_mode=dbg_mode, cache_filename=cache_filename, hot_days=args.hot_days,
+                           compare_qaly_paths=args.compare_qaly_paths, queue_filename=args.queue_filename))
+    if exporter is not None:
+        exporter.stop()
+else:
+    while True:
+        tweeting.tweet_news(tweepyapi, api_key, qaly_path, url_path,
+                            db_filename, tweet_time_window, news_refresh_period,
+                            dbg_mode=dbg_mode, cache_filename=cache_filename, hot_days=args.hot_days,
+                            compare_qaly_paths=args.compare_qaly_paths, queue_filename=args.queue_filename)
+        sleep(periodicity_s)
@@ -0,0 +1,228 @@
+import bisect
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0,
+           float('inf'))
+
+profile_dir = None  # if set, profiled blocks (see profiled) write cProfile stats into this directory
+
+# What each metric recorded by the pipeline measures. Metrics not listed here are exported too, without help text.
+help_texts = {
+    'newsapi_requests_total': 'NewsAPI pages requested',
+    'newsapi_errors_total': 'NewsAPI pages which returned an error instead of results',
+    'newsapi_request_seconds': 'Time to request and decode a NewsAPI page',
+    'sources_polled_total': 'News sources polled by the refresh scheduler, counting each source of a shared query',
+    'newsapi_page_seconds': 'Time to fetch, score and save the articles of a NewsAPI page',
+    'page_fetches_total': 'Article pages requested from publishers',
+    'page_fetch_errors_total': 'Article pages which could not be fetched after all retries',
+    'page_fetch_retries_total': 'Article page requests retried after an error',
+    'page_fetch_seconds': 'Time to request an article page from its publisher',
+    'http_cache_hits_total': 'HTTP requests served from the response cache',
+    'http_cache_misses_total': 'HTTP requests not in the response cache, or stale there, so sent to the server',
+    'http_cache_revalidations_total': 'Stale cached HTTP responses the server confirmed unchanged (304 Not Modified)',
+    'jobs_queued_total': 'Articles queued for workers to fetch and score (see job_queue)',
+    'jobs_claimed_total': 'Queued articles claimed by workers',
+    'job_retries_total': 'Queued articles released to be claimed again because their page could not be fetched',
+    'job_leases_expired_total': 'Queued articles claimed again because the worker holding them did not report back',
+    'jobs_failed_total': 'Queued articles given up on because every worker which claimed them failed to report back',
+    'jobs_written_total': 'Queued articles scored by workers and written to the news database, or found duplicates',
+    'html_parse_seconds': 'Time to extract the story from an article page',
+    'article_cache_hits_total': 'Article contents found in the article cache',
+    'article_cache_misses_total': 'Article contents not in the article cache (or from an older extractor)',
+    'duplicate_urls_total': 'NewsAPI results skipped because their canonical URL was seen before',
+    'near_duplicates_total': 'Articles collapsed into an earlier article whose text they nearly duplicate',
+    'unsupported_urls_total': 'Article URLs skipped because no source in the URL lookup table matches them',
+    'articles_scored_total': 'Articles scored against the QALY table',
+    'score_batch_seconds': 'Time to score a batch of articles against the QALY table',
+    'articles_written_total': 'Article rows written to the news database',
+    'db_write_seconds': 'Time to write a batch of articles to the news database',
+    'rescore_seconds': 'Time to rescore the news database',
+    'refresh_seconds': 'Time to refresh the news database from NewsAPI',
+    'backup_seconds': 'Time to back up the news database',
+    'backup_snapshots_total': 'Full snapshots taken of the news database',
+    'backup_errors_total': 'Backups of the news database which failed',
+    'wal_frames_shipped_total': 'WAL frames of the news database shipped to its backup log',
+    'tweets_total': 'Tweets posted',
+    'tweet_seconds': 'Time to draw an article and tweet it',
+}
+
+_counters = {}  # name -> value
+_histograms = {}  # name -> [count of each bucket, sum, count]
+_lock = threading.Lock()
+
+
+def inc(name, value=1):
+    """Add value to a counter, creating it at 0 on first use"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value):
+    """Record an observation (e.g. a duration in seconds) in a histogram, creating it on first use"""
+    i = bisect.bisect_left(buckets, value)
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = [[0] * len(buckets), 0.0, 0]
+        histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+@contextlib.contextmanager
+def timer(name):
+    """Record the time spent in a with block in a histogram, whether or not the block raises
+
+    Example
+    ------------------
+    >>> with timer('db_write_seconds'):
+    ...     conn.executemany(...)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def reset():
+    """Forget all counters and histograms"""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def snapshot():
+    """The current value of every metric
+
+    Returns
+    ----------------
+    snapshot : A dict with keys
+                - 'time' : A string of the form YYYY-MM-DDTHH:MM:SS, when the snapshot was taken
+                - 'counters' : A dict, name -> value
+                - 'histograms' : A dict, name -> dict with keys 'buckets' (a list of [upper bound, cumulative count],
+                                 the last bound being the string '+Inf'), 'sum' and 'count'
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {name: (list(counts), total, count) for name, (counts, total, count) in _histograms.items()}
+    snapshot = {'time': datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), 'counters': counters,
+                'histograms': {}}
+    for name, (counts, total, count) in histograms.items():
+        cumulative, rows = 0, []
+        for bound, n in zip(buckets, counts):
+            cumulative += n
+            rows.append(['+Inf' if bound == float('inf') else bound, cumulative])
+        snapshot['histograms'][name] = {'buckets': rows, 'sum': total, 'count': count}
+    return snapshot
+
+
+def to_prometheus(snapshot):
+    """Render a snapshot in the Prometheus text exposition format"""
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        if name in help_texts:
+            lines.append('# HELP {0} {1}'.format(name, help_texts[name]))
+        lines.append('# TYPE {} counter'.format(name))
+        lines.append('{0} {1}'.format(name, value))
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        if name in help_texts:
+            lines.append('# HELP {0} {1}'.format(name, help_texts[name]))
+        lines.append('# TYPE {} histogram'.format(name))
+        for bound, cumulative in histogram['buckets']:
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(name, bound, cumulative))
+        lines.append('{0}_sum {1!r}'.format(name, histogram['sum']))
+        lines.append('{0}_count {1}'.format(name, histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def write(filename, fmt=None):
+    """Write a snapshot of all metrics to a file, replacing it atomically so that a scraper never reads half a file
+
+    Parameters
+    ----------------
+    filename : A string, the name of the file
+    fmt : A string, 'json' or 'prometheus'. By default, 'prometheus' if filename ends in .prom, otherwise 'json'
+    """
+    if fmt is None:
+        fmt = 'prometheus' if filename.endswith('.prom') else 'json'
+    if fmt == 'prometheus':
+        text = to_prometheus(snapshot())
+    elif fmt == 'json':
+        text = json.dumps(snapshot(), indent=2)
+    else:
+        raise ValueError('Unknown metrics format: {}'.format(fmt))
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as outfile:
+            outfile.write(text)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+class Exporter(object):
+    """Writes a snapshot of all metrics to a file every interval_s seconds, on a daemon thread, and once more on stop
+
+    Parameters
+    ----------------
+    filename : A string, the name of the file
+    interval_s : A float, the period in seconds between writes
+    fmt : A string, see write
+    """
+
+    def __init__(self, filename, interval_s=60.0, fmt=None):
+        self.filename = filename
+        self.interval_s = interval_s
+        self.fmt = fmt
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-exporter', daemon=True)
+
+    def _write(self):
+        try:
+            write(self.filename, self.fmt)
+        except OSError as e:
+            print('WARNING: could not write metrics to {0}: {1!r}'.format(self.filename, e))
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self._write()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._write()
+
+
+@contextlib.contextmanager
+def profiled(name):
+    """Profile a with block with cProfile if profile_dir is set, writing the stats to <profile_dir>/<name>-<time>.prof
+
+    Only the calling thread is profiled; work the block hands to other threads is seen through the histograms instead.
+    The stats can be read with pstats, or e.g. snakeviz.
+    """
+    if profile_dir is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, '{0}-{1}.prof'.format(
+            name, datetime.datetime.now().strftime('%Y%m%dT%H%M%S'))))
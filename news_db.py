@@ -0,0 +1,422 @@
+import glob
+import os
+import sqlite3 as sq
+import threading
+
+busy_timeout_s = 30.0  # how long a write waits for another process to release its lock
+wal_autocheckpoint = 1000  # WAL pages after which a commit checkpoints, 0 for never (see backup.configure)
+
+
+def _copy_topic_strings(conn):
+    """Fill article_topics from the topics strings of the articles already in the news table"""
+    rows = conn.execute("SELECT url, topics FROM news WHERE topics IS NOT NULL AND topics != 'NULL'").fetchall()
+    set_article_topics(conn, [(url, topics.split('; ')) for url, topics in rows])  # see get_topic_string
+
+
+# Schema migrations of the news database, applied in order by migrate. Each is a list of SQL statements, or of
+# functions taking the connection. The number of migrations applied so far is kept in the database's user_version.
+# Append new migrations to the end; never edit or reorder applied ones.
+migrations = [
+    # 1: time-window queries filter and sort on published_at
+    ['CREATE INDEX IF NOT EXISTS news_published_at ON news(published_at)'],
+    # 2: the version of the QALY table which scored each article, and the topic hashes of each version, so that
+    # rescoring can skip articles (and topics) whose scores are already up to date
+    ['ALTER TABLE news ADD COLUMN scorer_version TEXT',
+     '''CREATE TABLE IF NOT EXISTS scorer_versions (
+        version TEXT PRIMARY KEY,
+        topic_hashes TEXT NOT NULL
+        )'''],
+    # 3: counters kept by the writers, e.g. the score epoch, which lets news_sampler notice rescoring
+    ['''CREATE TABLE IF NOT EXISTS news_meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+        )'''],
+    # 4: progress of NewsAPI refreshes, so that an interrupted refresh resumes where it stopped
+    ['''CREATE TABLE IF NOT EXISTS refresh_checkpoints (
+        id INTEGER PRIMARY KEY,
+        query TEXT NOT NULL,
+        query_from TEXT,
+        n_pages INTEGER,
+        pages_done TEXT NOT NULL,
+        attempts INTEGER NOT NULL,
+        started_at DATETIME NOT NULL,
+        finished INTEGER NOT NULL DEFAULT 0
+        )'''],
+    # 5: SimHash fingerprints of the text of recent articles, and the URLs which were collapsed into another article as
+    # duplicates (see dedup), so that syndicated copies of a story are neither fetched nor stored again
+    ['''CREATE TABLE IF NOT EXISTS simhashes (
+        url TEXT PRIMARY KEY,
+        simhash INTEGER NOT NULL,
+        published_at DATETIME
+        )''',
+     'CREATE INDEX IF NOT EXISTS simhashes_published_at ON simhashes(published_at)',
+     '''CREATE TABLE IF NOT EXISTS duplicates (
+        url TEXT PRIMARY KEY,
+        canonical_url TEXT NOT NULL
+        )'''],
+    # 6: topics by integer id, and the topics of each article as rows, so that articles can be selected (and counted)
+    # by topic through an index. news.topics is still written, as a human-readable copy
+    ['''CREATE TABLE IF NOT EXISTS topics (
+        topic_id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL
+        )''',
+     '''CREATE TABLE IF NOT EXISTS article_topics (
+        url TEXT NOT NULL,
+        topic_id INTEGER NOT NULL REFERENCES topics(topic_id),
+        published_at DATETIME,
+        position INTEGER NOT NULL,
+        PRIMARY KEY (url, topic_id)
+        ) WITHOUT ROWID''',
+     'CREATE INDEX IF NOT EXISTS article_topics_topic_published_at ON article_topics(topic_id, published_at)',
+     _copy_topic_strings],
+    # 7: scores of articles against alternative QALY tables (see score_articles.MultiQalyScorer), by table name
+    ['''CREATE TABLE IF NOT EXISTS table_scores (
+        url TEXT NOT NULL,
+        qaly_table TEXT NOT NULL,
+        score REAL NOT NULL,
+        topics TEXT,
+        scorer_version TEXT,
+        PRIMARY KEY (url, qaly_table)
+        ) WITHOUT ROWID'''],
+    # 8: per-source polling state of the refresh scheduler (see scheduler.py), and per-source publish rates
+    ['''CREATE TABLE IF NOT EXISTS source_polls (
+        source TEXT PRIMARY KEY,
+        high_water DATETIME,
+        last_polled DATETIME
+        )''',
+     'CREATE INDEX IF NOT EXISTS news_source_published_at ON news(source, published_at)'],
+    # 9: the NewsAPI description of each article, which is scored together with its text (see
+    # score_articles.scored_text), so that rescoring scores the same text as ingestion did
+    ['ALTER TABLE news ADD COLUMN description TEXT'],
+    # 10: a count of the articles ever deleted (e.g. by roll_over), kept by a trigger whatever process deletes them.
+    # news has no AUTOINCREMENT, so SQLite may give a new article the rowid of a deleted one, and readers which sync by
+    # rowid (see news_sampler) must start over when this changes
+    ["INSERT OR IGNORE INTO news_meta(key, value) VALUES('delete_epoch', 0)",
+     '''CREATE TRIGGER IF NOT EXISTS news_delete_epoch AFTER DELETE ON news BEGIN
+        UPDATE news_meta SET value=value+1 WHERE key='delete_epoch';
+        END'''],
+    # 11: the end of each refresh's time window, fixed when it starts, so that each page of a resumed refresh holds the
+    # results it held before (NewsAPI returns the newest first, so new articles would push old ones onto later pages)
+    ['ALTER TABLE refresh_checkpoints ADD COLUMN query_to TEXT'],
+]
+
+_local = threading.local()  # per-thread dict of db_filename -> connection
+
+
+def connect(db_filename):
+    """Get this thread's persistent connection to a database, opening it on first use
+
+    Connections use write-ahead logging, so readers (e.g. tweeting) do not block on a writer (e.g. rescoring) and vice
+    versa.
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the database
+
+    Returns
+    ----------------
+    conn : A sqlite3.Connection, shared by all callers on this thread. Do not close it, see close_connections
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_filename)
+    if conn is None:
+        conn = sq.connect(db_filename, timeout=busy_timeout_s)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA wal_autocheckpoint={:d}'.format(wal_autocheckpoint))
+        connections[db_filename] = conn
+    return conn
+
+
+def close_connections():
+    """Close this thread's persistent connections"""
+    connections = getattr(_local, 'connections', {})
+    for conn in connections.values():
+        conn.close()
+    connections.clear()
+
+
+def migrate(db_filename):
+    """Bring the schema of a news database up to date by applying the migrations it has not had yet
+
+    Returns
+    ----------------
+    n_applied : An int, the number of migrations applied
+    """
+    conn = connect(db_filename)
+    n_applied = 0
+    while True:
+        # Each migration runs in its own write transaction, so a migration is applied once even if several processes
+        # start on the same database, and a failed migration leaves the schema as it was
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(migrations):
+                conn.commit()
+                return n_applied
+            for statement in migrations[version]:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute('PRAGMA user_version={:d}'.format(version + 1))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        n_applied += 1
+
+
+def get_score_epoch(conn):
+    """The number of times scores of existing articles have been rewritten (see bump_score_epoch)"""
+    row = conn.execute("SELECT value FROM news_meta WHERE key='score_epoch'").fetchone()
+    return 0 if row is None else row[0]
+
+
+def get_delete_epoch(conn):
+    """The number of articles ever deleted from the news table (see migration 10)"""
+    row = conn.execute("SELECT value FROM news_meta WHERE key='delete_epoch'").fetchone()
+    return 0 if row is None else row[0]
+
+
+def bump_score_epoch(conn):
+    """Record that scores of existing articles have been rewritten. Call inside the transaction which rewrites them"""
+    conn.execute("INSERT OR IGNORE INTO news_meta(key, value) VALUES('score_epoch', 0)")
+    conn.execute("UPDATE news_meta SET value=value+1 WHERE key='score_epoch'")
+
+
+def existing_urls(conn, urls, table='news'):
+    """The URLs among urls which have a row in a table keyed by url (e.g. news, or duplicates)"""
+    existing = set()
+    urls = list(urls)
+    for start in range(0, len(urls), 500):  # keep under SQLite's limit on the number of bound parameters
+        chunk = urls[start:start + 500]
+        existing.update(row[0] for row in conn.execute('SELECT url FROM {0} WHERE url IN ({1})'.format(
+            table, ','.join('?' * len(chunk))), chunk))
+    return existing
+
+
+def set_article_topics(conn, articles):
+    """Replace the topics of articles which are in the news table, adding topics not seen before. Runs inside the
+    caller's transaction.
+
+    Parameters
+    ----------------
+    conn : A sqlite3.Connection to the news database
+    articles : An iterable of tuples (url, topics), where topics is a list of strings in the order they were assigned
+    """
+    topic_ids = dict(conn.execute('SELECT name, topic_id FROM topics'))
+    urls = []
+    rows = []
+    for url, topics in articles:
+        urls.append((url,))
+        for position, topic in enumerate(topics):
+            if topic not in topic_ids:
+                topic_ids[topic] = conn.execute('INSERT INTO topics(name) VALUES(?)', (topic,)).lastrowid
+            rows.append((url, topic_ids[topic], position, url))
+    conn.executemany('DELETE FROM article_topics WHERE url=?', urls)
+    conn.executemany('''INSERT OR IGNORE INTO article_topics(url, topic_id, published_at, position)
+                        SELECT ?, ?, published_at, ? FROM news WHERE url=?''', rows)
+
+
+def get_article_topics(conn, urls):
+    """The topics of articles
+
+    Parameters
+    ----------------
+    conn : A sqlite3.Connection to the news database
+    urls : An iterable of strings, the URLs of the articles
+
+    Returns
+    ----------------
+    topics : A dict, keys are URLs, values are lists of topics in the order they were assigned. Articles without
+             topics are left out
+    """
+    topics = {}
+    urls = list(urls)
+    for start in range(0, len(urls), 500):
+        chunk = urls[start:start + 500]
+        for url, name in conn.execute('''SELECT article_topics.url, topics.name FROM article_topics
+                                         JOIN topics ON topics.topic_id = article_topics.topic_id
+                                         WHERE article_topics.url IN ({})
+                                         ORDER BY article_topics.url, article_topics.position
+                                      '''.format(','.join('?' * len(chunk))), chunk):
+            topics.setdefault(url, []).append(name)
+    return topics
+
+
+def set_table_scores(conn, rows):
+    """Save the scores of articles against alternative QALY tables, replacing earlier ones. Runs inside the caller's
+    transaction.
+
+    Parameters
+    ----------------
+    conn : A sqlite3.Connection to the news database
+    rows : An iterable of tuples (url, qaly_table, score, topics, scorer_version), where qaly_table is the name of the
+           table (see score_articles.table_name) and topics a string (see score_articles.get_topic_string)
+    """
+    conn.executemany('''INSERT OR REPLACE INTO table_scores(url, qaly_table, score, topics, scorer_version)
+                        VALUES(?, ?, ?, ?, ?)''', rows)
+
+
+def articles_with_topic(conn, topic, since):
+    """The articles of a topic published after a given time, newest first
+
+    Parameters
+    ----------------
+    conn : A sqlite3.Connection to the news database
+    topic : A string, the name of the topic
+    since : A string of the form YYYY-MM-DDTHH:MM:SS
+
+    Returns
+    ----------------
+    articles : A list of tuples (url, published_at)
+    """
+    return conn.execute('''SELECT url, published_at FROM article_topics
+                           WHERE topic_id = (SELECT topic_id FROM topics WHERE name=?) AND published_at > datetime(?)
+                           ORDER BY published_at DESC''', (topic, since)).fetchall()
+
+
+def count_topics(conn, since):
+    """The number of articles of each topic published after a given time (a string of the form YYYY-MM-DDTHH:MM:SS)
+
+    Returns
+    ----------------
+    counts : A dict, keys are topics, values are ints. Topics without articles are left out
+    """
+    return dict(conn.execute('''SELECT topics.name, COUNT(*) FROM article_topics
+                                JOIN topics ON topics.topic_id = article_topics.topic_id
+                                WHERE article_topics.published_at > datetime(?)
+                                GROUP BY article_topics.topic_id''', (since,)))
+
+
+def archive_filename(db_filename, month):
+    """The name of the archive of a news database's articles of a month (a string of the form YYYY-MM), e.g.
+    news.2020-01.db for news.db
+    """
+    root, ext = os.path.splitext(db_filename)
+    return '{0}.{1}{2}'.format(root, month, ext)
+
+
+def partitions(db_filename, since=None, until=None):
+    """The databases holding a news database's articles: its monthly archives (see roll_over), oldest first, then the
+    database itself
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the news database
+    since : A string of the form YYYY-MM-DDTHH:MM:SS, if given leave out archives of articles published before it
+    until : A string of the form YYYY-MM-DDTHH:MM:SS, if given leave out archives of articles published after it
+
+    Returns
+    ----------------
+    filenames : A list of strings
+    """
+    root, ext = os.path.splitext(db_filename)
+    filenames = []
+    for filename in sorted(glob.glob(glob.escape(root) + '.[0-9][0-9][0-9][0-9]-[0-9][0-9]' + glob.escape(ext))):
+        month = filename[len(root) + 1:len(root) + 8]
+        if (since is None or month >= since[:7]) and (until is None or month <= until[:7]):
+            filenames.append(filename)
+    return filenames + [db_filename]
+
+
+def query_partitions(db_filename, sql, parameters=(), since=None, until=None):
+    """Run a query on each partition of a news database (see partitions), e.g. for reporting over all articles
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the news database
+    sql : A string, the query
+    parameters : A sequence or dict, the parameters of the query
+    since, until : Strings, see partitions. They only choose the partitions; filter on them in the query as well
+
+    Returns
+    ----------------
+    rows : An iterator of tuples, the rows of each partition in turn
+    """
+    for filename in partitions(db_filename, since=since, until=until):
+        yield from connect(filename).execute(sql, parameters)
+
+
+def _create_archive(conn, filename):
+    """Create an empty archive with the same schema (and so the same migrations) as the database of conn"""
+    tmp_filename = filename + '.tmp'
+    archive = sq.connect(tmp_filename)
+    try:
+        with archive:
+            for sql, in conn.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'"
+                                     " ORDER BY rowid"):
+                archive.execute(sql)
+            archive.execute('PRAGMA user_version={:d}'.format(conn.execute('PRAGMA user_version').fetchone()[0]))
+    finally:
+        archive.close()
+    os.replace(tmp_filename, filename)
+
+
+def roll_over(db_filename, cutoff):
+    """Move the articles published before cutoff into the monthly archives of a news database, creating archives as
+    needed, so that the database itself only holds the recent articles that tweeting and its window rescoring read
+
+    Each article's topics, fingerprint, scores against alternative QALY tables and the URLs collapsed into it as
+    duplicates move with it. Each month is copied to its archive, then deleted, in one transaction on each database;
+    if a roll-over is interrupted between the two, running it again completes it.
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the news database
+    cutoff : A string of the form YYYY-MM-DDTHH:MM:SS, it should be earlier than the start of the tweet window
+
+    Returns
+    ----------------
+    archives : A dict, keys are the names of the archives written to, values are the numbers of articles moved there
+    """
+    conn = connect(db_filename)
+    months = [month for month, in conn.execute('''SELECT DISTINCT substr(published_at, 1, 7) FROM news
+                                                  WHERE published_at < datetime(?)''', (cutoff,))]
+    columns = ', '.join(row[1] for row in conn.execute('PRAGMA table_info(news)'))
+    archives = {}
+    for month in months:
+        year, month_of_year = int(month[:4]), int(month[5:7])
+        next_month = '{0:04d}-{1:02d}'.format(year + month_of_year // 12, month_of_year % 12 + 1)
+        filename = archive_filename(db_filename, month)
+        if not os.path.exists(filename):
+            _create_archive(conn, filename)
+        migrate(filename)
+        conn.execute('ATTACH DATABASE ? AS archive', (filename,))
+        try:
+            conn.execute('DROP TABLE IF EXISTS temp.moving')  # left behind if a previous roll-over failed
+            with conn:
+                conn.execute('''CREATE TEMP TABLE moving AS SELECT url FROM news
+                                WHERE published_at >= ? AND published_at < ? AND published_at < datetime(?)''',
+                             (month, next_month, cutoff))
+                conn.execute('INSERT OR REPLACE INTO archive.news({0}) SELECT {0} FROM main.news '
+                             'WHERE url IN (SELECT url FROM temp.moving)'.format(columns))
+                # Topic ids differ between databases, so topics are matched by name
+                conn.execute('''INSERT OR IGNORE INTO archive.topics(name)
+                                SELECT DISTINCT topics.name FROM main.article_topics
+                                JOIN main.topics ON topics.topic_id = article_topics.topic_id
+                                WHERE article_topics.url IN (SELECT url FROM temp.moving)''')
+                conn.execute('''INSERT OR REPLACE INTO archive.article_topics(url, topic_id, published_at, position)
+                                SELECT article_topics.url, archive_topics.topic_id, article_topics.published_at,
+                                       article_topics.position
+                                FROM main.article_topics
+                                JOIN main.topics ON topics.topic_id = article_topics.topic_id
+                                JOIN archive.topics AS archive_topics ON archive_topics.name = topics.name
+                                WHERE article_topics.url IN (SELECT url FROM temp.moving)''')
+                conn.execute('''INSERT OR REPLACE INTO archive.simhashes SELECT * FROM main.simhashes
+                                WHERE url IN (SELECT url FROM temp.moving)''')
+                conn.execute('''INSERT OR REPLACE INTO archive.table_scores SELECT * FROM main.table_scores
+                                WHERE url IN (SELECT url FROM temp.moving)''')
+                conn.execute('''INSERT OR REPLACE INTO archive.duplicates SELECT * FROM main.duplicates
+                                WHERE canonical_url IN (SELECT url FROM temp.moving)''')
+                for table, key in (('article_topics', 'url'), ('simhashes', 'url'), ('table_scores', 'url'),
+                                   ('duplicates', 'canonical_url'), ('news', 'url')):
+                    conn.execute('DELETE FROM main.{0} WHERE {1} IN (SELECT url FROM temp.moving)'.format(table, key))
+                archives[filename] = conn.execute('SELECT COUNT(*) FROM temp.moving').fetchone()[0]
+                conn.execute('DROP TABLE temp.moving')
+        finally:
+            conn.execute('DETACH DATABASE archive')
+    return archives
@@ -0,0 +1,229 @@
+import datetime
+import heapq
+import math
+import random
+import threading
+from array import array
+import news_db
+
+_samplers = {}  # (db_filename, sample_log_qalys) -> NewsSampler, one per process
+_samplers_lock = threading.Lock()
+
+
+class FenwickSampler(object):
+    """Weighted random sampling over a changing set of keys
+
+    Weights are kept in a Fenwick (binary indexed) tree over a flat array of doubles, so setting or removing a weight
+    and drawing a key each cost O(log n).
+
+    Parameters
+    ----------------
+    capacity : An int, the initial number of slots. The tree doubles in size when it runs out
+    """
+
+    def __init__(self, capacity=1024):
+        self._keys = []  # slot -> key, or None if the slot is free
+        self._slots = {}  # key -> slot
+        self._free = []  # free slots
+        self._weights = array('d')  # slot -> weight
+        self._capacity = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self._weights.extend(array('d', [0.0]) * (capacity - self._capacity))
+        self._capacity = capacity
+        self._rebuild()
+
+    def _rebuild(self):
+        """Recompute the tree from the weights in O(n), which also discards accumulated rounding error"""
+        tree = array('d', [0.0]) + self._weights
+        for i in range(1, self._capacity + 1):
+            parent = i + (i & -i)
+            if parent <= self._capacity:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _add(self, slot, delta):
+        i = slot + 1
+        tree = self._tree
+        while i <= self._capacity:
+            tree[i] += delta
+            i += i & -i
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def total(self):
+        """The sum of all weights"""
+        total = 0.0
+        i = self._capacity
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return max(total, 0.0)
+
+    def set(self, key, weight):
+        """Set the weight of a key, adding the key if it is new"""
+        slot = self._slots.get(key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+                self._keys[slot] = key
+            else:
+                if len(self._keys) == self._capacity:
+                    self._allocate(2 * self._capacity)
+                slot = len(self._keys)
+                self._keys.append(key)
+            self._slots[key] = slot
+        self._add(slot, weight - self._weights[slot])
+        self._weights[slot] = weight
+
+    def remove(self, key):
+        """Remove a key, if present"""
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            return
+        self._add(slot, -self._weights[slot])
+        self._weights[slot] = 0.0
+        self._keys[slot] = None
+        self._free.append(slot)
+
+    def _find(self, target):
+        """The slot at which the running sum of weights first exceeds target"""
+        pos = 0
+        step = 1 << (self._capacity.bit_length() - 1)
+        tree = self._tree
+        while step:
+            nxt = pos + step
+            if nxt <= self._capacity and tree[nxt] <= target:
+                pos = nxt
+                target -= tree[nxt]
+            step >>= 1
+        return pos
+
+    def sample(self, rng=random):
+        """Draw a key with probability proportional to its weight
+
+        Returns
+        ----------------
+        key : The drawn key, or None if all weights are zero
+        """
+        for attempt in range(2):
+            total = self.total()
+            if total <= 0.0:
+                return None
+            slot = self._find(rng.random() * total)
+            if slot < len(self._keys) and self._keys[slot] is not None and self._weights[slot] > 0.0:
+                return self._keys[slot]
+            self._rebuild()  # rounding error pointed at an empty slot
+        return None
+
+
+class NewsSampler(object):
+    """The articles of a news database published within a time window, kept ready for weighted sampling
+
+    The sampler is synchronised with the database incrementally: articles inserted since the last sync are read by
+    rowid, and articles which have aged out of the window are dropped. It is rebuilt from scratch only when scores have
+    been rewritten (see news_db.bump_score_epoch), articles have been deleted (whose rowids SQLite may give to new
+    articles, see news_db.get_delete_epoch) or the window has grown.
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the news database
+    sample_log_qalys : A bool, weight articles by log(score + 1) rather than by score
+    """
+
+    def __init__(self, db_filename, sample_log_qalys=True):
+        self.db_filename = db_filename
+        self.sample_log_qalys = sample_log_qalys
+        self.score_total = 0.0  # sum of the scores of articles in the window
+        self._sampler = None
+        self._scores = {}  # url -> score
+        self._expiry = []  # heap of (published_at, url)
+        self._max_rowid = 0
+        self._score_epoch = None
+        self._delete_epoch = None
+        self._window_start = None
+        self._lock = threading.Lock()
+
+    def _weight(self, score):
+        return math.log(score + 1.0) if self.sample_log_qalys else score
+
+    def _add(self, url, score, published_at):
+        if url in self._scores:
+            self._remove(url)
+        self._scores[url] = score
+        self.score_total += score
+        self._sampler.set(url, self._weight(score))
+        heapq.heappush(self._expiry, (published_at, url))
+
+    def _remove(self, url):
+        score = self._scores.pop(url, None)
+        if score is not None:
+            self.score_total -= score
+            self._sampler.remove(url)
+
+    def _rebuild(self, conn, window_start):
+        self._sampler = FenwickSampler()
+        self._scores = {}
+        self._expiry = []
+        self.score_total = 0.0
+        self._max_rowid = conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM news').fetchone()[0]
+        for url, score, published_at in conn.execute('''SELECT url, score, published_at FROM news
+                                                        WHERE published_at > datetime(?) AND rowid <= ?''',
+                                                     (window_start, self._max_rowid)):
+            self._add(url, score, published_at)
+
+    def sync(self, query_db_from):
+        """Bring the sampler up to date with the database
+
+        Parameters
+        ----------------
+        query_db_from : A datetime, the start of the time window
+        """
+        # Same format as SQLite's datetime(), so that comparisons match those against datetime(?) elsewhere
+        window_start = datetime.datetime.strftime(query_db_from, '%Y-%m-%d %H:%M:%S')
+        conn = news_db.connect(self.db_filename)
+        with self._lock:
+            score_epoch = news_db.get_score_epoch(conn)
+            delete_epoch = news_db.get_delete_epoch(conn)
+            if (self._sampler is None or score_epoch != self._score_epoch or delete_epoch != self._delete_epoch
+                    or window_start < self._window_start):
+                self._rebuild(conn, window_start)
+            else:
+                for rowid, url, score, published_at in conn.execute('''SELECT rowid, url, score, published_at
+                                                                       FROM news WHERE rowid > ?''',
+                                                                    (self._max_rowid,)):
+                    self._max_rowid = max(self._max_rowid, rowid)
+                    if published_at > window_start:
+                        self._add(url, score, published_at)
+            self._score_epoch = score_epoch
+            self._delete_epoch = delete_epoch
+            self._window_start = window_start
+
+            while self._expiry and self._expiry[0][0] <= window_start:
+                published_at, url = heapq.heappop(self._expiry)
+                self._remove(url)
+            if not self._scores:
+                self.score_total = 0.0  # discard rounding error
+
+    def __len__(self):
+        return len(self._scores)
+
+    def sample(self, rng=random):
+        """Draw the URL of an article with probability proportional to its weight, or None if all weights are zero"""
+        with self._lock:
+            return self._sampler.sample(rng)
+
+
+def get_news_sampler(db_filename, sample_log_qalys=True):
+    """Get the process-wide NewsSampler of a news database"""
+    with _samplers_lock:
+        key = (db_filename, sample_log_qalys)
+        sampler = _samplers.get(key)
+        if sampler is None:
+            sampler = _samplers[key] = NewsSampler(db_filename, sample_log_qalys)
+        return sampler
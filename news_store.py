@@ -0,0 +1,126 @@
+import datetime
+import dedup
+import metrics
+import news_db
+import score_articles
+
+dt_format = "%Y-%m-%dT%H:%M:%S"
+dedup_window_hours = 72.0  # an article is only checked against stories published up to this long before the refresh
+
+
+def update_news_db(db_filename, article_dict, qaly_scorer=None):
+    """Append article_dict into news database
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the news database
+    article_dict: A dict of dicts, the keys are URLS, the values are dicts which must contain at least:
+        score : A float, the score of the article
+        topics : A list of strings, the topics associated with the URL
+        published_at : A string, of the form YYYY-MM-DDTHH:MM:SS, the datetime the article was published
+        description : Optionally, a string, the NewsAPI description of the article, which it was scored with
+        table_scores : Optionally, see score_articles.score_all. Saved in the table_scores table
+    qaly_scorer : A QalyScorer, the scorer which produced the scores, whose version is recorded against each row, or
+                  the MultiQalyScorer which produced them and the table_scores
+    """
+    table_versions = {}
+    if isinstance(qaly_scorer, score_articles.MultiQalyScorer):
+        table_versions = {name: scorer.version for name, scorer in qaly_scorer.scorers.items()}
+        qaly_scorer = qaly_scorer.scorers[qaly_scorer.primary]
+    scorer_version = None if qaly_scorer is None else qaly_scorer.version
+    conn = news_db.connect(db_filename)
+    with metrics.timer('db_write_seconds'), conn:
+        # Articles already in the database are left as they are, topics included
+        existing = news_db.existing_urls(conn, article_dict)
+        new_articles = [(url, url_dict) for url, url_dict in article_dict.items() if url not in existing]
+        rows = [(url, url_dict['score'], score_articles.get_topic_string(url_dict['topics']), url_dict['publishedAt'],
+                 url_dict['source'], scorer_version, url_dict.get('description')) for url, url_dict in new_articles]
+        if qaly_scorer is not None:
+            score_articles.record_scorer_version(conn, qaly_scorer)
+        conn.executemany('''INSERT or IGNORE INTO news(
+                            url,
+                            score,
+                            topics,
+                            published_at,
+                            source,
+                            scorer_version,
+                            description)
+                            VALUES(?, ?, ?, ?, ?, ?, ?)
+                            ''', rows)
+        news_db.set_article_topics(conn, [(url, url_dict['topics']) for url, url_dict in new_articles])
+        news_db.set_table_scores(conn, [(url, name, score, score_articles.get_topic_string(topics),
+                                         table_versions.get(name))
+                                        for url, url_dict in new_articles
+                                        for name, (score, topics) in url_dict.get('table_scores', {}).items()])
+    metrics.inc('articles_written_total', len(rows))
+    print('News db updated!')
+
+
+def load_dedup_index(db_filename, since):
+    """Load the SimHash fingerprints of the articles published since a given time into an index (see dedup), including
+    those of articles rolled over into the monthly archives (see news_db.roll_over)
+
+    Parameters
+    ---------------
+    db_filename : A string, the name of the news database
+    since : A datetime, the earliest publish time to load
+
+    Returns
+    ---------------
+    dedup_index : A dedup.SimHashIndex, keyed by URL
+    """
+    dedup_index = dedup.SimHashIndex()
+    since = datetime.datetime.strftime(since, dt_format)
+    for url, fingerprint in news_db.query_partitions(db_filename, 'SELECT url, simhash FROM simhashes '
+                                                     'WHERE published_at > datetime(?)', (since,), since=since):
+        dedup_index.add(url, dedup.from_signed(fingerprint))
+    return dedup_index
+
+
+def find_known_urls(db_filename, urls, published_at=()):
+    """The URLs which are already in the news database, or were collapsed into another article as duplicates
+
+    Articles rolled over into the monthly archives (see news_db.roll_over) are found too, in the archives of the months
+    the articles were published in. A duplicate is archived with the article it duplicates, which may have been
+    published up to dedup_window_hours before or after it, so the months are widened by as much.
+
+    Parameters
+    ---------------
+    db_filename : A string, the name of the news database
+    urls : A list of strings, the canonical URLs of the articles
+    published_at : A list of strings of the form YYYY-MM-DDTHH:MM:SS, the times the articles were published. If empty,
+                   only the news database itself is searched
+
+    Returns
+    ---------------
+    known : A set of strings, the URLs among urls which are known
+    """
+    filenames = [db_filename]
+    if published_at:
+        window = datetime.timedelta(hours=dedup_window_hours)
+        since = datetime.datetime.strptime(min(published_at)[:19], dt_format) - window
+        until = datetime.datetime.strptime(max(published_at)[:19], dt_format) + window
+        filenames = news_db.partitions(db_filename, since=datetime.datetime.strftime(since, dt_format),
+                                       until=datetime.datetime.strftime(until, dt_format))
+    known = set()
+    for filename in filenames:
+        conn = news_db.connect(filename)
+        known |= news_db.existing_urls(conn, urls) | news_db.existing_urls(conn, urls, table='duplicates')
+    return known
+
+
+def save_fingerprints(db_filename, fingerprints, duplicates):
+    """Save the fingerprints of new articles, and the URLs found to duplicate other articles
+
+    Parameters
+    ---------------
+    db_filename : A string, the name of the news database
+    fingerprints : A list of tuples (url, fingerprint, published_at), see dedup.simhash
+    duplicates : A list of tuples (url, canonical_url), where canonical_url is the article url duplicates
+    """
+    conn = news_db.connect(db_filename)
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO simhashes(url, simhash, published_at) VALUES(?, ?, ?)',
+                         [(url, dedup.to_signed(fingerprint), published_at)
+                          for url, fingerprint, published_at in fingerprints])
+        conn.executemany('INSERT OR IGNORE INTO duplicates(url, canonical_url) VALUES(?, ?)', duplicates)
@@ -0,0 +1,190 @@
+import datetime
+import get_articles
+import job_queue
+import metrics
+import news_db
+
+dt_format = "%Y-%m-%dT%H:%M:%S"
+rate_window_h = 7 * 24.0  # each source's publish rate is measured over the articles of this many hours
+target_articles = 20.0  # a source is due once it is expected to have published this many articles since its last poll
+min_interval_h = 0.5  # however busy a source, it is polled at most this often
+early_fraction = 0.25  # once a poll is due, sources which would be due within this fraction of their interval join it
+group_span_h = 2.0  # sources whose high-water marks are at most this far apart share a NewsAPI query
+max_group_size = 20  # NewsAPI takes at most 20 sources per query
+
+
+def publish_rates(conn, source_ids, now):
+    """The number of articles each source publishes per hour, over the last rate_window_h hours of news
+
+    If the news database holds less than rate_window_h hours of news, the rates are measured over what there is.
+
+    Parameters
+    ----------------
+    conn : A sqlite3.Connection to the news database
+    source_ids : A list of strings, the NewsAPI ids of the sources
+    now : A datetime
+
+    Returns
+    ----------------
+    rates : A dict, keys are source ids, values are floats
+    """
+    since = datetime.datetime.strftime(now - datetime.timedelta(hours=rate_window_h), dt_format)
+    counts = dict(conn.execute('''SELECT source, COUNT(*) FROM news WHERE published_at > datetime(?)
+                                  GROUP BY source''', (since,)))
+    oldest = conn.execute('SELECT MIN(published_at) FROM news WHERE published_at > datetime(?)', (since,)).fetchone()[0]
+    window_h = rate_window_h
+    if oldest is not None:
+        delta = now - datetime.datetime.strptime(oldest, dt_format)
+        window_h = min(window_h, max(delta.total_seconds() / 3600.0, 1.0))
+    return dict((source_id, counts.get(source_id, 0) / window_h) for source_id in source_ids)
+
+
+def poll_interval(rate, max_interval_h):
+    """The hours between polls of a source publishing rate articles per hour, see target_articles"""
+    if rate <= 0:
+        return max_interval_h
+    return min(max(target_articles / rate, min_interval_h), max_interval_h)
+
+
+def load_marks(conn, source_ids):
+    """The high-water mark and last poll of each source
+
+    A source which has not been polled by the scheduler yet (e.g. in a news database built before it) gets the
+    publication time of its newest article as both.
+
+    Returns
+    ----------------
+    marks : A dict, keys are source ids, values are tuples (high_water, last_polled) of datetimes or None
+    """
+    polls = dict((source, (high_water, last_polled)) for source, high_water, last_polled in
+                 conn.execute('SELECT source, high_water, last_polled FROM source_polls'))
+    marks = {}
+    for source_id in source_ids:
+        if source_id in polls:
+            high_water, last_polled = polls[source_id]
+        else:
+            high_water = conn.execute('SELECT MAX(published_at) FROM news WHERE source=?', (source_id,)).fetchone()[0]
+            last_polled = high_water
+        marks[source_id] = tuple(None if mark is None else datetime.datetime.strptime(mark, dt_format)
+                                 for mark in (high_water, last_polled))
+    return marks
+
+
+def _can_share(group_from, query_from):
+    """Whether a source to be queried from query_from can join a query from group_from (the earlier of the two)"""
+    if group_from is None or query_from is None:
+        return group_from is None and query_from is None
+    return query_from - group_from <= datetime.timedelta(hours=group_span_h)
+
+
+def due_groups(db_filename, source_ids, max_interval_h, lag_minutes=20, now=None):
+    """Choose which sources to poll now, and group them into NewsAPI queries
+
+    Each source is polled once it is expected to have published target_articles new articles, judging by its publish
+    rate, and at least every max_interval_h hours. It is queried from its own high-water mark (the newest article seen
+    from it), less lag_minutes, rather than from the newest article of any source. Sources whose marks are close share
+    a query, so that quiet sources are polled rarely and busy ones often, without a query for each source.
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the news database
+    source_ids : A list of strings, the NewsAPI ids of the sources
+    max_interval_h : A float, the longest a source goes without being polled, in hours
+    lag_minutes : An int, the overlap of each query with the articles already seen, to allow for the delay between a
+                  story being published and it being discoverable on NewsAPI
+    now : A datetime, by default the current time
+
+    Returns
+    ----------------
+    groups : A list of tuples (query_from, source ids), where query_from is a string of the form YYYY-MM-DDTHH:MM:SS,
+             or None for sources never seen before. Empty if no source is due
+    """
+    now = datetime.datetime.now() if now is None else now
+    conn = news_db.connect(db_filename)
+    rates = publish_rates(conn, source_ids, now)
+    marks = load_marks(conn, source_ids)
+
+    overdue = {}  # source id -> fraction of its interval elapsed since its last poll
+    for source_id in source_ids:
+        high_water, last_polled = marks[source_id]
+        if last_polled is None:
+            overdue[source_id] = float('inf')
+        else:
+            interval_h = poll_interval(rates[source_id], max_interval_h)
+            overdue[source_id] = (now - last_polled).total_seconds() / 3600.0 / interval_h
+    if not any(elapsed >= 1.0 for elapsed in overdue.values()):
+        return []
+
+    due = []
+    for source_id in source_ids:
+        if overdue[source_id] >= 1.0 - early_fraction:
+            high_water = marks[source_id][0] or marks[source_id][1]
+            due.append((None if high_water is None else high_water - datetime.timedelta(minutes=lag_minutes),
+                        source_id))
+    due.sort(key=lambda item: (item[0] is not None, item[0] or now))
+
+    groups = []
+    for query_from, source_id in due:
+        if groups and len(groups[-1][1]) < max_group_size and _can_share(groups[-1][0], query_from):
+            groups[-1][1].append(source_id)
+        else:
+            groups.append((query_from, [source_id]))
+    return [(None if query_from is None else datetime.datetime.strftime(query_from, dt_format), group_sources)
+            for query_from, group_sources in groups]
+
+
+def record_poll(db_filename, source_ids, polled_at):
+    """Record that sources were polled, raising their high-water marks to their newest articles
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the news database
+    source_ids : A list of strings, the NewsAPI ids of the sources polled
+    polled_at : A datetime, the time the poll started
+    """
+    polled_at = datetime.datetime.strftime(polled_at, dt_format)
+    conn = news_db.connect(db_filename)
+    with conn:
+        for source_id in source_ids:
+            newest = conn.execute('SELECT MAX(published_at) FROM news WHERE source=?', (source_id,)).fetchone()[0]
+            conn.execute('INSERT OR IGNORE INTO source_polls(source) VALUES(?)', (source_id,))
+            conn.execute('''UPDATE source_polls SET last_polled=?,
+                                high_water=CASE WHEN high_water IS NULL OR high_water < ? THEN ? ELSE high_water END
+                            WHERE source=?''', (polled_at, newest, newest, source_id))
+
+
+def poll(api_key, db_filename, qaly_path, url_path, groups, cache_filename='article_cache.db', compare_qaly_paths=(),
+         queue_filename=None, max_age_h=None):
+    """Query NewsAPI for each group of sources (see due_groups), saving new articles and the sources' new marks
+
+    With a job queue, the articles of every group are queued first, then written as workers score them, in one drain
+    for the whole poll (see job_queue.drain), before the groups' marks are raised.
+
+    Parameters
+    ----------------
+    api_key : A string, the NewsAPI API key
+    db_filename : A string, the name of the news database
+    qaly_path : A string, directory of the QALY table
+    url_path : A string, directory of the url lookup table
+    groups : A list of tuples (query_from, source ids), see due_groups
+    cache_filename : A string, the name of the article cache database
+    compare_qaly_paths : A list of strings, see get_articles.get_many_results
+    queue_filename : A string, see get_articles.get_many_results
+    max_age_h : A float, see get_articles.get_many_results
+    """
+    polls = []
+    for query_from, source_ids in groups:
+        print('Polling {0} from {1}'.format(', '.join(source_ids), query_from))
+        polled_at = datetime.datetime.now()
+        get_articles.get_many_results(api_key, db_filename, qaly_path, url_path, query_from=query_from,
+                                      cache_filename=cache_filename, compare_qaly_paths=compare_qaly_paths,
+                                      source_ids=source_ids, queue_filename=queue_filename, max_age_h=max_age_h)
+        if queue_filename is None:
+            record_poll(db_filename, source_ids, polled_at)
+        else:
+            polls.append((source_ids, polled_at))
+        metrics.inc('sources_polled_total', len(source_ids))
+    if polls:  # the high-water marks are raised to the articles written
+        job_queue.drain(queue_filename, db_filename, qaly_path, compare_qaly_paths=compare_qaly_paths)
+        for source_ids, polled_at in polls:
+            record_poll(db_filename, source_ids, polled_at)
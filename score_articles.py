@@ -1,24 +1,339 @@
-from keyword_parser import parse_keywords
-import sqlite3 as sq
-from get_full_content import get_url_content
+from keyword_parser import parse_keywords, parse_expression
+from keyword_matcher import KeywordMatcher
+import metrics
+import news_db
+from get_full_content import get_cached_url_content
 import argparse
 import datetime
+import multiprocessing
+import sqlite3 as sq
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+import json
+import numpy as np
+import os
+import pickle
+import tempfile
+import urllib3
 
 dt_format = "%Y-%m-%dT%H:%M:%S"
 
+qaly_cache_dirname = '.qaly_cache'  # compiled QALY tables are kept in this directory next to the table
+qaly_cache_format = 1  # bump when the layout of the compiled rows changes
+_qaly_scorers = {}  # absolute path of the QALY table -> (file stat key, QalyScorer)
+
+
+class QalyScorer(object):
+    """A compiled QALY table which scores articles by evaluating each topic's keyword expression as a boolean tree
+
+    Identical subexpressions (e.g. the list of countries shared by most topics) are stored once and evaluated at most
+    once per article. Every keyword in the table is found with a single scan of the article.
+
+    Parameters
+    ----------------
+    rows : A list of tuples (topic, score, tree), in table order, where tree is the output of
+           keyword_parser.parse_expression
+    version : A string, identifies the QALY table the scorer was compiled from (see get_qaly_version)
+    """
+
+    def __init__(self, rows, version=None):
+        self.rows = list(rows)
+        self.version = version
+        self._nodes = []  # node id -> keyword string, or (op, tuple of child node ids)
+        self._node_ids = {}  # tree -> node id
+        self.topics = []  # list of (topic, score, root node id)
+        for topic, score, tree in self.rows:
+            self.topics.append((topic, float(score), self._intern(tree)))
+        self.keywords = frozenset(node for node in self._nodes if isinstance(node, str))
+        self.matcher = KeywordMatcher(self.keywords)
+
+    def _intern(self, tree):
+        node_id = self._node_ids.get(tree)
+        if node_id is not None:
+            return node_id
+        if isinstance(tree, str):
+            node = tree
+        else:
+            op, children = tree
+            child_ids = [self._intern(child) for child in children]
+            # Evaluate keyword lookups before subexpressions, so that short-circuiting skips as much as possible
+            child_ids.sort(key=lambda child_id: not isinstance(self._nodes[child_id], str))
+            node = (op, tuple(child_ids))
+        node_id = len(self._nodes)
+        self._nodes.append(node)
+        self._node_ids[tree] = node_id
+        return node_id
+
+    def _evaluate(self, node_id, found, memo):
+        node = self._nodes[node_id]
+        if isinstance(node, str):
+            return node in found
+        value = memo.get(node_id)
+        if value is None:
+            op, child_ids = node
+            if op == 'AND':
+                value = all(self._evaluate(child_id, found, memo) for child_id in child_ids)
+            else:
+                value = any(self._evaluate(child_id, found, memo) for child_id in child_ids)
+            memo[node_id] = value
+        return value
+
+    def score_keywords(self, found):
+        """Score an article given the set of keywords which occur in it
+
+        Parameters
+        ----------------
+        found : A set of strings, the keywords found in the article
+
+        Returns
+        ----------------
+        article_score : A float, the score of the article
+        article_topics : A list of strings, the topics associated with the article
+        """
+        article_score = 0
+        article_topics = []
+        if not found:
+            return article_score, article_topics
+        memo = {}
+        for topic, score, root_id in self.topics:
+            if topic not in article_topics and self._evaluate(root_id, found, memo):
+                article_score += score
+                article_topics.append(topic)
+        return article_score, article_topics
+
+    def score(self, article):
+        """Score a single article, see score_article"""
+        return self.score_keywords(self.matcher.find(article))
+
+    def match_rows(self, articles, present=None):
+        """Find, for each topic and article, the first of the topic's rows which matches the article
+
+        Keyword presence is found for all articles together (see keyword_presence), then each node of the expression
+        trees is evaluated for all articles with a single array operation, in the order the nodes were interned
+        (children before parents).
+
+        Parameters
+        ----------------
+        articles : A list of strings, the texts of the articles
+        present : A dict, the output of keyword_presence for (at least) this scorer's keywords and the articles, if it
+                  was already found (e.g. by a MultiQalyScorer)
+
+        Returns
+        ----------------
+        topic_names : A list of strings, the topics in order of their first row
+        first_rows : A numpy array of ints, topics x articles, the index in rows of the row which scored each topic
+                     for each article, or -1 if none did
+        """
+        n = len(articles)
+        if present is None:
+            present = keyword_presence(self.keywords, articles, self.matcher)
+        values = []  # node id -> boolean array over the articles
+        for node in self._nodes:
+            if isinstance(node, str):
+                values.append(present[node])
+            else:
+                op, child_ids = node
+                reduce = np.logical_and.reduce if op == 'AND' else np.logical_or.reduce
+                values.append(reduce([values[child_id] for child_id in child_ids]))
+
+        # As in score_keywords, a topic is scored by the first of its rows which matches
+        topic_names = []
+        first_rows = {}  # topic -> array of row indices
+        for row, (topic, score, root_id) in enumerate(self.topics):
+            if topic not in first_rows:
+                topic_names.append(topic)
+                first_rows[topic] = np.full(n, -1)
+            first_rows[topic][values[root_id] & (first_rows[topic] < 0)] = row
+        return topic_names, np.stack([first_rows[topic] for topic in topic_names])
+
+    def score_batch(self, articles, present=None):
+        """Score many articles at once, see match_rows
+
+        Parameters
+        ----------------
+        articles : A list of strings (or None, for no text), the texts of the articles
+        present : A dict, see match_rows
+
+        Returns
+        ----------------
+        scores : A numpy array of floats, the score of each article
+        topics : A list with the topics of each article, each a list of strings in the order score would give
+        """
+        articles = [article or '' for article in articles]
+        n = len(articles)
+        scores = np.zeros(n)
+        topics = [[] for _ in range(n)]
+        if n == 0 or not self.topics:
+            return scores, topics
+
+        topic_names, first_rows = self.match_rows(articles, present=present)
+        topic_ids = dict((topic, topic_id) for topic_id, topic in enumerate(topic_names))
+        for row, (topic, score, root_id) in enumerate(self.topics):  # summed in row order, as score_keywords does
+            scores[first_rows[topic_ids[topic]] == row] += score
+        # The first_rows of each article's topics also order them
+        topic_ids, article_ids = np.nonzero(first_rows >= 0)
+        order = np.lexsort((first_rows[topic_ids, article_ids], article_ids))
+        for topic_id, article_id in zip(topic_ids[order].tolist(), article_ids[order].tolist()):
+            topics[article_id].append(topic_names[topic_id])
+        return scores, topics
+
+    def topic_hashes(self):
+        """A hash of each topic's score and keyword expression, which changes iff the topic's definition does
+
+        Returns
+        ----------------
+        hashes : A dict, keys are topics, values are hex digests. A topic defined by several rows gets one hash
+                 covering all of them
+        """
+        hashes = {}
+        for topic, score, tree in self.rows:
+            hashes[topic] = hashlib.sha256(repr((hashes.get(topic), float(score), tree)).encode('utf-8')).hexdigest()
+        return hashes
+
+    def subset(self, topics):
+        """A QalyScorer made of only the rows of the given topics, whose matcher only searches for their keywords"""
+        return QalyScorer([row for row in self.rows if row[0] in topics])
+
+
+def keyword_presence(keywords, articles, matcher=None):
+    """Find which articles contain each keyword, with a single scan of each article for all of them (see
+    KeywordMatcher), filling in only the keywords found
+
+    Parameters
+    ----------------
+    keywords : An iterable of strings
+    articles : A list of strings, the texts of the articles
+    matcher : A KeywordMatcher of (at least) keywords, to scan with. Built on the fly if None; pass it in when finding
+              the keywords of many batches
+
+    Returns
+    ----------------
+    present : A dict, keys are keywords, values are boolean arrays over the articles
+    """
+    keywords = frozenset(keywords)
+    if matcher is None:
+        matcher = KeywordMatcher(keywords)
+    present = dict((keyword, np.zeros(len(articles), dtype=bool)) for keyword in keywords)
+    for i, article in enumerate(articles):
+        for keyword in matcher.find(article):
+            if keyword in present:  # the matcher may search for more keywords than these
+                present[keyword][i] = True
+    return present
+
+
+class MultiQalyScorer(object):
+    """Scores articles against several QALY tables at once, e.g. to compare alternative tables on the same news
+
+    The keywords of all the tables are searched for together, by one matcher over the union of their keywords, so an
+    article is scanned once however many tables it is scored against, and each table's expressions are then evaluated
+    on the shared result. A batch of articles shares one keyword presence matrix, found with the same matcher (see
+    keyword_presence).
+
+    Parameters
+    ----------------
+    scorers : A dict, keys are the names of the tables (see table_name), values are QalyScorers
+    primary : A string, the name of the table whose scores are an article's own score and topics (see score_all), or
+              None if all tables are alternatives
+    """
+
+    def __init__(self, scorers, primary=None):
+        self.scorers = dict(scorers)
+        self.primary = primary
+        self.keywords = frozenset().union(*(scorer.keywords for scorer in self.scorers.values()))
+        self.matcher = KeywordMatcher(self.keywords)
+
+    def score(self, article):
+        """Score a single article against every table
+
+        Returns
+        ----------------
+        results : A dict, keys are the names of the tables, values are tuples (score, topics), see score_article
+        """
+        found = self.matcher.find(article)
+        return {name: scorer.score_keywords(found) for name, scorer in self.scorers.items()}
+
+    def score_batch(self, articles):
+        """Score many articles against every table, see QalyScorer.score_batch
+
+        Returns
+        ----------------
+        results : A dict, keys are the names of the tables, values are tuples (scores, topics)
+        """
+        articles = [article or '' for article in articles]
+        present = keyword_presence(self.keywords, articles, self.matcher)
+        return {name: scorer.score_batch(articles, present=present) for name, scorer in self.scorers.items()}
+
+
+def table_name(qaly_path):
+    """The name a QALY table's scores are saved under in the table_scores table, e.g. global_prios_1 for
+    global_prios/Old_GP_tables/global_prios_1.csv
+    """
+    return os.path.splitext(os.path.basename(qaly_path))[0]
+
+
+def load_multi_scorer(qaly_paths, primary_path=None):
+    """Get a MultiQalyScorer for several QALY tables, see load_qaly_scorer
+
+    Parameters
+    ----------------
+    qaly_paths : A list of strings, the paths to the QALY tables
+    primary_path : A string, the path of the primary table (see MultiQalyScorer), one of qaly_paths, or None
+
+    Returns
+    ----------------
+    multi_scorer : A MultiQalyScorer, whose tables are named by table_name
+    """
+    scorers = {}
+    for qaly_path in qaly_paths:
+        name = table_name(qaly_path)
+        if name in scorers:
+            raise ValueError('Two QALY tables are named {}, rename one of them'.format(name))
+        scorers[name] = load_qaly_scorer(qaly_path)
+    return MultiQalyScorer(scorers, primary=None if primary_path is None else table_name(primary_path))
+
 
-def get_qaly_data(filename):
+def get_qaly_version(filename):
+    """The SHA-256 hex digest of the QALY table at filename, which changes iff the table does"""
+    with open(filename, 'rb') as infile:
+        return hashlib.sha256(infile.read()).hexdigest()
+
+
+def read_qaly_rows(filename):
+    """Parses a text file containing the table of topics, scores, and search strings into expression trees
+
+    Returns
+    ----------------
+    rows : A list of tuples (topic, score, tree), see QalyScorer
+    """
+    rows = []
+    with open(filename, 'r') as infile:
+        for linenum, line in enumerate(infile):
+            if linenum == 0:
+                continue
+
+            topic, score, keywords, ref = line.split(',')
+            rows.append((topic, float(score), parse_expression(keywords)))
+    return rows
+
+
+def get_qaly_data(filename, dnf=False):
     """Parses a text file containing the table of topics, scores, and search strings
 
     Parameters
     ----------------
     filename : A string, the path to the score table
+    dnf : A bool, if True return the table expanded into DNF as a dict (see Returns) rather than a QalyScorer
 
     Returns
     ----------------
-    qaly_scorer : A dict, keys are tuples of keywords, all of which are necessary to be assigned a topic. Values are
-                  tuples where value[0] is the score of the topic and value[1] is the topic ID
+    qaly_scorer : A QalyScorer. If dnf is True, a dict instead, keys are tuples of keywords, all of which are
+                  necessary to be assigned a topic. Values are tuples where value[0] is the score of the topic and
+                  value[1] is the topic ID
     """
+    if not dnf:
+        return QalyScorer(read_qaly_rows(filename), version=get_qaly_version(filename))
+
     qaly_scorer = {}
     with open(filename, 'r') as infile:
         for linenum, line in enumerate(infile):
@@ -33,32 +348,182 @@ def get_qaly_data(filename):
     return qaly_scorer
 
 
-def score_article(article, qaly_scorer):
-    """Assigns a score to text
+def load_qaly_scorer(filename, cache_dir=None):
+    """Get the QalyScorer for a QALY table, compiling the table only if it has changed
+
+    Scorers are memoized in-process, keyed by the path of the table and revalidated against its modification time and
+    size. The parsed table is also saved on disk, keyed by the hash of its contents, so that a new process only
+    re-parses the table after it has been edited.
+
+    Parameters
+    ----------------
+    filename : A string, the path to the score table
+    cache_dir : A string, the directory holding compiled tables. Default: .qaly_cache in the directory of the table
+
+    Returns
+    ----------------
+    qaly_scorer : A QalyScorer, with version set to the hash of the table
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    stat_key = (stat.st_mtime_ns, stat.st_size)
+    cached = _qaly_scorers.get(path)
+    if cached is not None and cached[0] == stat_key:
+        return cached[1]
+
+    version = get_qaly_version(path)
+    if cached is not None and cached[1].version == version:  # touched, but not changed
+        _qaly_scorers[path] = (stat_key, cached[1])
+        return cached[1]
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), qaly_cache_dirname)
+    artifact = os.path.join(cache_dir, '{0}.v{1}.pickle'.format(version, qaly_cache_format))
+    try:
+        with open(artifact, 'rb') as infile:
+            rows = pickle.load(infile)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        rows = read_qaly_rows(path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file first so that concurrent readers never see a partial artifact
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as outfile:
+                    pickle.dump(rows, outfile)
+                os.replace(tmp_path, artifact)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError) as e:
+            print('WARNING: could not save compiled QALY table: {}'.format(e))
+
+    qaly_scorer = QalyScorer(rows, version=version)
+    _qaly_scorers[path] = (stat_key, qaly_scorer)
+    return qaly_scorer
+
+
+def compile_matcher(qaly_scorer):
+    """Build the keyword matcher and clause index for a QALY table, so that an article can be scored in a single scan
 
     Parameters
     ----------------
-    article : A string, the text of an article to score
     qaly_scorer : A dict, keys are tuples of keywords, all of which are necessary to be assigned a topic. Values are
                   tuples where value[0] is the score of the topic and value[1] is the topic ID
 
+    Returns
+    ----------------
+    matcher : A tuple (keyword_matcher, clauses, keyword_clauses) where keyword_matcher is a KeywordMatcher over all
+              keywords in the table, clauses is a list of (set of keywords, (score, topic)) in table order, and
+              keyword_clauses maps each keyword to the indices of the clauses which contain it
+    """
+    clauses = []
+    keyword_clauses = {}
+    for clause_index, (keyword_set, value) in enumerate(qaly_scorer.items()):
+        keyword_set = set(keyword_set)
+        clauses.append((keyword_set, value))
+        for keyword in keyword_set:
+            keyword_clauses.setdefault(keyword, []).append(clause_index)
+    return KeywordMatcher(keyword_clauses), clauses, keyword_clauses
+
+
+def score_article(article, qaly_scorer, matcher=None):
+    """Assigns a score to text
+
+    Parameters
+    ----------------
+    article : A string, the text of an article to score
+    qaly_scorer : A QalyScorer, or a dict where keys are tuples of keywords, all of which are necessary to be
+                  assigned a topic, and values are tuples where value[0] is the score of the topic and value[1] is the
+                  topic ID
+    matcher : A tuple, the output of compile_matcher(qaly_scorer), only used if qaly_scorer is a dict. Built on the fly
+              if None; pass it in when scoring many articles against the same table
+
     Returns
     ----------------
     article_score : An int, the score of the article
     article_topics : A list of strings, the topics associated with the article
     """
+    if isinstance(qaly_scorer, QalyScorer):
+        return qaly_scorer.score(article)
+    if matcher is None:
+        matcher = compile_matcher(qaly_scorer)
+    keyword_matcher, clauses, keyword_clauses = matcher
+
+    # Scan the article once, then count how many of each clause's keywords were found
+    found_counts = {}
+    for keyword in keyword_matcher.find(article):
+        for clause_index in keyword_clauses[keyword]:
+            found_counts[clause_index] = found_counts.get(clause_index, 0) + 1
 
     article_score = 0
     article_topics = []
-    for keyword_set in qaly_scorer:
-        if all(keyword in article for keyword in keyword_set):
-            topic = qaly_scorer[keyword_set][1]
-            if topic not in article_topics:
-                article_score += qaly_scorer[keyword_set][0]
-                article_topics.append(topic)
+    for clause_index in sorted(found_counts):
+        keyword_set, (score, topic) = clauses[clause_index]
+        if found_counts[clause_index] == len(keyword_set) and topic not in article_topics:
+            article_score += score
+            article_topics.append(topic)
     return article_score, article_topics
 
 
+def score_batch(articles, qaly_scorer):
+    """Score many articles at once, see QalyScorer.score_batch
+
+    Parameters
+    ----------------
+    articles : A list of strings, the texts of the articles
+    qaly_scorer : A QalyScorer, or a dict of DNF clauses (see score_article), which is scored article by article
+
+    Returns
+    ----------------
+    scores : A list of floats, the score of each article
+    topics : A list with the topics of each article, each a list of strings
+    """
+    if isinstance(qaly_scorer, QalyScorer):
+        scores, topics = qaly_scorer.score_batch(articles)
+        return scores.tolist(), topics
+    matcher = compile_matcher(qaly_scorer)
+    results = [score_article(article, qaly_scorer, matcher) for article in articles]
+    return [result[0] for result in results], [result[1] for result in results]
+
+
+def scored_text(description, content):
+    """The text an article is scored on: its NewsAPI description followed by its extracted content, or only the
+    description if it has no content
+
+    Parameters
+    ----------------
+    description : A string, or None
+    content : A string, or None, see get_full_content.get_url_content
+
+    Returns
+    ----------------
+    text : A string, or None if the article has neither
+    """
+    if content is None:
+        return description
+    return (description or '') + ' ' + content
+
+
+def fetch_scored_text(url_path, url, description, cache_filename, offline=False):
+    """The text an article of the news database was scored on (see scored_text), to score it again, with its content
+    read from the article cache. Articles saved before their descriptions were kept (news_db migration 9) have none,
+    and are scored on their content alone.
+
+    Raises
+    ----------------
+    KeyError : if offline is True and url is not in the cache
+    urllib3.exceptions.HTTPError : if the content is not cached and could not be fetched
+    """
+    try:
+        content = get_cached_url_content(url_path, url, cache_filename, offline=offline)
+    except urllib3.exceptions.HTTPError as e:
+        metrics.inc('page_fetch_errors_total')
+        print('WARNING: could not fetch {0}: {1}'.format(url, e))
+        raise
+    return scored_text(description, content)
+
+
 def score_all(article_dict, qaly_scorer):
     """Associate a score with all articles in a dictionary of articles
 
@@ -67,19 +532,32 @@ def score_all(article_dict, qaly_scorer):
     article_dict : A dict, the keys are URLs of articles, the values are dicts with the following keys
                         - 'content' : A string, the text of the article
                         - 'publishedAt' : A string, the time the article was published in the form YYYY-MM-DDTHH:MM:SS
-    qaly_scorer : A dict, keys are tuples of keywords, all of which are necessary to be assigned a topic. Values are
-                  tuples where value[0] is the score of the topic and value[1] is the topic ID
+    qaly_scorer : A QalyScorer, a dict of DNF clauses (see score_article), or a MultiQalyScorer with a primary table
 
     Returns
     ----------------
     article_dict : Same as the parameter article_dict, with new entries in the value dicts
                     - 'score' : An int, the score of the article
                     - 'topics' : A list of strings, the topics of the article
+                    - 'table_scores' : Only for a MultiQalyScorer, a dict, keys are the names of its other tables,
+                                       values are tuples (score, topics) against that table
     """
-    for article_url in article_dict:
-        article_score, article_topics = score_article(article_dict[article_url]['content'], qaly_scorer)
+    urls = list(article_dict)
+    contents = [article_dict[url]['content'] for url in urls]
+    with metrics.timer('score_batch_seconds'):
+        if isinstance(qaly_scorer, MultiQalyScorer):
+            results = {name: (scores.tolist(), topics)
+                       for name, (scores, topics) in qaly_scorer.score_batch(contents).items()}
+            scores, topics = results.pop(qaly_scorer.primary)
+            for i, article_url in enumerate(urls):
+                article_dict[article_url]['table_scores'] = {name: (table_scores[i], table_topics[i])
+                                                             for name, (table_scores, table_topics) in results.items()}
+        else:
+            scores, topics = score_batch(contents, qaly_scorer)
+    for article_url, article_score, article_topics in zip(urls, scores, topics):
         article_dict[article_url]['score'] = article_score
         article_dict[article_url]['topics'] = article_topics
+    metrics.inc('articles_scored_total', len(article_dict))
     return article_dict
 
 
@@ -112,7 +590,16 @@ def get_topic_string(topics):
         return topics_string
 
 
-def resubmit_score_topics(db_filename, article_dict):
+def record_scorer_version(conn, qaly_scorer):
+    """Save the topic hashes of a QalyScorer under its version, so that rows scored by it can be rescored
+    incrementally later (see rescore_incremental). Runs inside the caller's transaction.
+    """
+    if qaly_scorer.version is not None:
+        conn.execute('INSERT OR IGNORE INTO scorer_versions(version, topic_hashes) VALUES(?, ?)',
+                     (qaly_scorer.version, json.dumps(qaly_scorer.topic_hashes(), sort_keys=True)))
+
+
+def resubmit_score_topics(db_filename, article_dict, qaly_scorer=None):
     """Update score and topics in news database
 
     Parameters
@@ -121,38 +608,317 @@ def resubmit_score_topics(db_filename, article_dict):
     article_dict: A dict of dicts, the keys are URLS, the values are dicts which must contain at least:
         score : A float, the score of the article
         topics : A list of strings, the topics associated with the URL
+    qaly_scorer : A QalyScorer, the scorer which produced the scores. Its version is recorded against each row. If
+                  None, the rows' versions are cleared, so an incremental rescore will rescore them in full
     """
-    conn = sq.connect(db_filename)
-    c = conn.cursor()
-    for url, url_dict in article_dict.items():
-        insert_string = '''UPDATE news SET score={0}, topics={1} WHERE url={2}
-                        '''.format(url_dict['score'],
-                                   add_quotes(get_topic_string(url_dict['topics'])),
-                                   add_quotes(url))
-        c.execute(insert_string)
-    conn.commit()
-    conn.close()
+    scorer_version = None if qaly_scorer is None else qaly_scorer.version
+    rows = [(url_dict['score'], get_topic_string(url_dict['topics']), scorer_version, url)
+            for url, url_dict in article_dict.items()]
+    conn = news_db.connect(db_filename)
+    with metrics.timer('db_write_seconds'), conn:
+        if qaly_scorer is not None:
+            record_scorer_version(conn, qaly_scorer)
+        conn.executemany('UPDATE news SET score=?, topics=?, scorer_version=? WHERE url=?', rows)
+        news_db.set_article_topics(conn, [(url, url_dict['topics']) for url, url_dict in article_dict.items()])
+        news_db.bump_score_epoch(conn)
+    metrics.inc('articles_written_total', len(rows))
     print('News db updated!')
 
 
+def rescore_incremental(db_filename, qaly_scorer, since, url_path, cache_filename, offline=False, batch_size=1000):
+    """Rescore only the articles in the news database which were scored by a different version of the QALY table
+
+    For an article scored by a version whose topic hashes were recorded, only topics which were added or whose
+    definition changed are evaluated again, against a matcher made of just their keywords. Topics which are unchanged
+    keep their previous result, and removed topics are dropped. If no topic was added or changed, no article content
+    is needed at all.
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the news database
+    qaly_scorer : A QalyScorer, the current QALY table, with its version set (see load_qaly_scorer)
+    since : A string of the form YYYY-MM-DDTHH:MM:SS, the earliest publish time to rescore
+    url_path : A string, directory of the url lookup table
+    cache_filename : A string, the name of the article cache database
+    offline : A bool, if True only use content held in the article cache, and skip articles which are not there
+    batch_size : An int, the number of articles scored at a time (see QalyScorer.score_batch)
+
+    Returns
+    ----------------
+    n_rescored : An int, the number of articles updated
+    n_skipped : An int, the number of articles skipped because their content was not cached (offline), or
+                could not be fetched
+    """
+    conn = news_db.connect(db_filename)
+    stale = conn.execute('''SELECT url, scorer_version, description FROM news
+                            WHERE published_at > datetime(?) AND (scorer_version IS NULL OR scorer_version != ?)
+                         ''', (since, qaly_scorer.version)).fetchall()
+    old_topics = news_db.get_article_topics(conn, [url for url, _, _ in stale])
+    known_versions = dict((version, json.loads(topic_hashes)) for version, topic_hashes in
+                          conn.execute('SELECT version, topic_hashes FROM scorer_versions'))
+
+    current_hashes = qaly_scorer.topic_hashes()
+    topic_rows = {}  # topic -> indices of its rows in qaly_scorer.rows
+    for i, (topic, score, tree) in enumerate(qaly_scorer.rows):
+        topic_rows.setdefault(topic, []).append(i)
+
+    partial_scorers = {}  # old version -> (topics to re-evaluate, QalyScorer of those topics, its rows' indices)
+    to_score = {}  # old version -> list of (url, topics kept, content), scored a batch at a time
+    article_dict = {}
+    n_skipped = 0
+
+    def score_pending(scorer_version):
+        changed, partial_scorer, partial_rows = partial_scorers[scorer_version]
+        articles = to_score.pop(scorer_version)
+        first_rows = None
+        if changed:
+            first_rows = partial_scorer.match_rows([content or '' for _, _, content in articles])[1]
+        for j, (url, topics, _) in enumerate(articles):
+            # A kept topic has a single row, which is the one it was scored by. A changed topic is scored by the first
+            # of its rows which matches now. Scores are summed, and topics ordered, by row, as score_article would.
+            rows = [topic_rows[topic][0] for topic in topics]
+            if first_rows is not None:
+                rows.extend(partial_rows[row] for row in first_rows[:, j].tolist() if row >= 0)
+            rows.sort()
+            article_score = 0
+            for row in rows:
+                article_score += qaly_scorer.topics[row][1]
+            article_dict[url] = {'score': article_score,
+                                 'topics': [qaly_scorer.topics[row][0] for row in rows]}
+
+    for i, (url, scorer_version, description) in enumerate(stale):
+        if i % 100 == 0:
+            print("{0} of {1}".format(i, len(stale)))
+        if scorer_version not in partial_scorers:
+            old_hashes = known_versions.get(scorer_version)
+            if old_hashes is None:  # unknown version, rescore every topic
+                changed = set(current_hashes)
+            else:
+                # A topic defined by several rows is re-evaluated, since we can't tell which row's score it took
+                changed = set(topic for topic, topic_hash in current_hashes.items()
+                              if old_hashes.get(topic) != topic_hash or len(topic_rows[topic]) > 1)
+            partial_rows = sorted(row for topic in changed for row in topic_rows[topic])
+            partial_scorers[scorer_version] = (changed, qaly_scorer.subset(changed), partial_rows)
+        changed = partial_scorers[scorer_version][0]
+
+        topics = [topic for topic in old_topics.get(url, [])
+                  if topic in current_hashes and topic not in changed]
+        content = None
+        if changed:
+            try:
+                content = fetch_scored_text(url_path, url, description, cache_filename, offline=offline)
+            except (KeyError, urllib3.exceptions.HTTPError):
+                n_skipped += 1
+                continue
+        to_score.setdefault(scorer_version, []).append((url, topics, content))
+        if len(to_score[scorer_version]) >= batch_size:
+            score_pending(scorer_version)
+    for scorer_version in list(to_score):
+        score_pending(scorer_version)
+
+    resubmit_score_topics(db_filename, article_dict, qaly_scorer)
+    return len(article_dict), n_skipped
+
+
+def _rescore_shard(articles, qaly_path, url_path, cache_filename, offline):
+    """Score a shard of articles, tuples (url, description), in a worker process of rescore_parallel
+
+    Returns
+    ----------------
+    results : A list of tuples (url, score, topics)
+    n_skipped : An int, the number of URLs skipped because their content was not cached (offline), or
+                could not be fetched
+    """
+    qaly_scorer = load_qaly_scorer(qaly_path)  # compiled once per worker
+    found_urls = []
+    contents = []
+    n_skipped = 0
+    for url, description in articles:
+        try:
+            contents.append(fetch_scored_text(url_path, url, description, cache_filename, offline=offline))
+        except (KeyError, urllib3.exceptions.HTTPError):
+            n_skipped += 1
+            continue
+        found_urls.append(url)
+    scores, topics = score_batch(contents, qaly_scorer)
+    return list(zip(found_urls, scores, topics)), n_skipped
+
+
+def rescore_parallel(db_filename, qaly_path, since, url_path, cache_filename, workers, offline=False,
+                     shard_size=100, batch_size=2000):
+    """Rescore every article published since a given time, sharding the articles across a pool of processes
+
+    URLs are streamed from the database a shard at a time, with at most two shards per worker in flight, and scores
+    are written back in batches as shards complete, so memory use does not grow with the number of articles.
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the news database
+    qaly_path : A string, the path to the QALY table
+    since : A string of the form YYYY-MM-DDTHH:MM:SS, the earliest publish time to rescore
+    url_path : A string, directory of the url lookup table
+    cache_filename : A string, the name of the article cache database
+    workers : An int, the number of worker processes
+    offline : A bool, if True only use content held in the article cache, and skip articles which are not there
+    shard_size : An int, the number of URLs sent to a worker at a time
+    batch_size : An int, the number of scored articles written to the database per transaction
+
+    Returns
+    ----------------
+    n_rescored : An int, the number of articles updated
+    n_skipped : An int, the number of articles skipped because their content was not cached (offline), or
+                could not be fetched
+    """
+    qaly_scorer = load_qaly_scorer(qaly_path)
+    # A separate read connection, so that URLs can be streamed while batches are written
+    read_conn = sq.connect(db_filename, timeout=news_db.busy_timeout_s)
+    n_total = read_conn.execute('SELECT COUNT(*) FROM news WHERE published_at > datetime(?)', (since,)).fetchone()[0]
+    cursor = read_conn.execute('SELECT url, description FROM news WHERE published_at > datetime(?)', (since,))
+
+    n_rescored = 0
+    n_skipped = 0
+    n_done = 0
+    article_dict = {}
+    start = time.time()
+    # Workers are spawned rather than forked, so that they don't inherit this process's database connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        in_flight = set()
+        exhausted = False
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < 2 * workers:
+                articles = cursor.fetchmany(shard_size)
+                if not articles:
+                    exhausted = True
+                    break
+                in_flight.add(executor.submit(_rescore_shard, articles, qaly_path, url_path, cache_filename, offline))
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                results, shard_skipped = future.result()
+                n_skipped += shard_skipped
+                n_done += len(results) + shard_skipped
+                for url, article_score, article_topics in results:
+                    article_dict[url] = {'score': article_score,
+                                         'topics': article_topics}
+            if len(article_dict) >= batch_size:
+                resubmit_score_topics(db_filename, article_dict, qaly_scorer)
+                n_rescored += len(article_dict)
+                article_dict = {}
+            print('{0} of {1} ({2:.1f} articles/s)'.format(n_done, n_total, n_done / max(time.time() - start, 1e-9)))
+
+    if article_dict:
+        resubmit_score_topics(db_filename, article_dict, qaly_scorer)
+        n_rescored += len(article_dict)
+    read_conn.close()
+    return n_rescored, n_skipped
+
+
+def compare_tables(db_filename, multi_scorer, since, url_path, cache_filename, offline=False, batch_size=1000,
+                   summary=None):
+    """Score every article published since a given time against each table of a MultiQalyScorer, saving the results
+    in the table_scores table (the articles' own scores are left as they are)
+
+    Parameters
+    ----------------
+    db_filename : A string, the name of the news database
+    multi_scorer : A MultiQalyScorer
+    since : A string of the form YYYY-MM-DDTHH:MM:SS, the earliest publish time to score
+    url_path : A string, directory of the url lookup table
+    cache_filename : A string, the name of the article cache database
+    offline : A bool, if True only use content held in the article cache, and skip articles which are not there
+    batch_size : An int, the number of articles scored, and saved, at a time
+    summary : A dict, as returned, to add this database's results to, e.g. to summarize several partitions together
+
+    Returns
+    ----------------
+    summary : A dict, keys are the names of the tables, values are dicts with keys
+                - 'articles' : An int, the number of articles scored
+                - 'scored' : An int, the number of articles with a positive score
+                - 'total_score' : A float, the sum of the scores
+                - 'topics' : A dict, the number of articles with each topic
+    n_skipped : An int, the number of articles skipped because their content was not cached (offline), or
+                could not be fetched
+    """
+    if summary is None:
+        summary = {}
+    for name in multi_scorer.scorers:
+        summary.setdefault(name, {'articles': 0, 'scored': 0, 'total_score': 0.0, 'topics': {}})
+    versions = {name: scorer.version for name, scorer in multi_scorer.scorers.items()}
+    conn = news_db.connect(db_filename)
+    articles = conn.execute('SELECT url, description FROM news WHERE published_at > datetime(?)', (since,)).fetchall()
+    n_skipped = 0
+    for start in range(0, len(articles), batch_size):
+        print("{0} of {1}".format(start, len(articles)))
+        batch_urls = []
+        contents = []
+        for url, description in articles[start:start + batch_size]:
+            try:
+                contents.append(fetch_scored_text(url_path, url, description, cache_filename, offline=offline))
+            except (KeyError, urllib3.exceptions.HTTPError):
+                n_skipped += 1
+                continue
+            batch_urls.append(url)
+        with metrics.timer('score_batch_seconds'):
+            results = multi_scorer.score_batch(contents)
+        metrics.inc('articles_scored_total', len(contents))
+        rows = []
+        for name, (scores, topics) in results.items():
+            table_summary = summary[name]
+            table_summary['articles'] += len(batch_urls)
+            table_summary['scored'] += int(np.count_nonzero(scores > 0))
+            table_summary['total_score'] += float(scores.sum())
+            for url, article_score, article_topics in zip(batch_urls, scores.tolist(), topics):
+                rows.append((url, name, article_score, get_topic_string(article_topics), versions[name]))
+                for topic in article_topics:
+                    table_summary['topics'][topic] = table_summary['topics'].get(topic, 0) + 1
+        with conn:
+            news_db.set_table_scores(conn, rows)
+    return summary, n_skipped
+
+
+def print_comparison(summary, n_topics=5):
+    """Print a summary of each table's scores (see compare_tables) side by side"""
+    for name, table_summary in summary.items():
+        n_articles = table_summary['articles']
+        top_topics = sorted(table_summary['topics'].items(), key=lambda item: -item[1])[:n_topics]
+        print('{0}: {1} articles, {2} with a positive score, mean score {3:.3g}'.format(
+            name, n_articles, table_summary['scored'], table_summary['total_score'] / max(n_articles, 1)))
+        print('    top topics: {}'.format(', '.join('{0} ({1})'.format(topic, n) for topic, n in top_topics)))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Score articles in database.")
-    parser.add_argument('-db_filename', default='news.db', type=str, nargs=1, help="The news database to score")
-    parser.add_argument('-since', type=str, nargs=1,
+    parser.add_argument('-db_filename', default='news.db', type=str, help="The news database to score")
+    parser.add_argument('-since', type=str,
                         help="""The earliest datetime to score in form YYYY-MM-DDTHH:MM:SS 
                         (default: 2 weeks prior to now)""")
-    parser.add_argument('-qaly_path', type=str, nargs=1, default='global_prios/global_prios.csv',
+    parser.add_argument('-qaly_path', type=str, default='global_prios/global_prios.csv',
                         help="Path to the QALY table (default =global_prios/global_prios.csv)")
-    parser.add_argument('-url_path', default='url_content_lookup.csv', type=str, nargs=1,
+    parser.add_argument('-url_path', default='url_content_lookup.csv', type=str,
                         help="Directory of the url lookup table")
+    parser.add_argument('-cache_filename', default='article_cache.db', type=str,
+                        help="The database caching extracted article text (default = article_cache.db)")
+    parser.add_argument('-offline', action='store_true',
+                        help="Only score articles held in the article cache, without fetching anything")
+    parser.add_argument('-incremental', action='store_true',
+                        help="""Only rescore articles scored by a different version of the QALY table, and only for 
+                        the topics which changed""")
+    parser.add_argument('-workers', type=int, default=1,
+                        help="Number of processes to rescore with (default = 1). Ignored with -incremental")
+    parser.add_argument('-compare', type=str, nargs='+', default=None,
+                        help="""Paths to alternative QALY tables. Instead of rescoring, score the articles against 
+                        -qaly_path and each of these in one pass, save the scores in the table_scores table and print 
+                        a summary of each table""")
 
     args = parser.parse_args()
     _db_filename = args.db_filename
     _qaly_path = args.qaly_path
     _url_path = args.url_path
+    _cache_filename = args.cache_filename
 
     if args.since is not None:
-        since = args.since[0]
+        since = args.since
         try:
             datetime.datetime.strptime(since, dt_format)
         except ValueError:
@@ -161,27 +927,60 @@ if __name__ == '__main__':
         since = datetime.datetime.now() + datetime.timedelta(days=-14)
         since = datetime.datetime.strftime(since, dt_format)
 
-    conn = sq.connect(_db_filename)
-    c = conn.cursor()
-    date_query = '''SELECT url FROM news
-                        WHERE published_at > datetime('{}')
-        '''.format(since)
-    c.execute(date_query)
-    recent_news = c.fetchall()
-    conn.close()
-
-    # Score URLs
-    _qaly_scorer = get_qaly_data(_qaly_path)
-
-    _article_dict = {}
-    for i, _url_temp in enumerate(recent_news):
-        _url = _url_temp[0]
-        if i % 20 == 0:
-            print("{0} of {1}".format(i, len(recent_news)))
-        content = get_url_content(_url_path, _url)
-        _article_score, _article_topics = score_article(content, _qaly_scorer)
-        _article_dict[_url] = {'score': _article_score,
-                               'topics': _article_topics}
-
-    resubmit_score_topics(_db_filename, _article_dict)
-
+    if args.compare is not None:
+        _multi_scorer = load_multi_scorer([_qaly_path] + args.compare)
+        _summary = {}
+        for _partition in news_db.partitions(_db_filename, since=since):
+            news_db.migrate(_partition)
+            if _partition != _db_filename:
+                print('Archive {}'.format(_partition))
+            _summary, _n_skipped = compare_tables(_partition, _multi_scorer, since, _url_path, _cache_filename,
+                                                  offline=args.offline, summary=_summary)
+            if _n_skipped > 0:
+                print('{} articles which were not cached, or could not be fetched, were skipped'.format(_n_skipped))
+        print_comparison(_summary)
+    else:
+        _qaly_scorer = load_qaly_scorer(_qaly_path)
+
+        # Articles moved into monthly archives (see news_db.roll_over) are rescored too, one partition at a time
+        for _partition in news_db.partitions(_db_filename, since=since):
+            news_db.migrate(_partition)
+            if _partition != _db_filename:
+                print('Archive {}'.format(_partition))
+            if args.incremental:
+                _n_rescored, _n_skipped = rescore_incremental(_partition, _qaly_scorer, since, _url_path,
+                                                              _cache_filename, offline=args.offline)
+                print('{} articles rescored'.format(_n_rescored))
+                if _n_skipped > 0:
+                    print('{} articles which were not cached, or could not be fetched, were skipped'.format(_n_skipped))
+            elif args.workers > 1:
+                _n_rescored, _n_skipped = rescore_parallel(_partition, _qaly_path, since, _url_path, _cache_filename,
+                                                           args.workers, offline=args.offline)
+                print('{} articles rescored'.format(_n_rescored))
+                if _n_skipped > 0:
+                    print('{} articles which were not cached, or could not be fetched, were skipped'.format(_n_skipped))
+            else:
+                conn = news_db.connect(_partition)
+                date_query = '''SELECT url, description FROM news
+                                    WHERE published_at > datetime(?)
+                    '''
+                recent_news = conn.execute(date_query, (since,)).fetchall()
+
+                # Score URLs
+                _article_dict = {}
+                _n_skipped = 0
+                for i, (_url, _description) in enumerate(recent_news):
+                    if i % 20 == 0:
+                        print("{0} of {1}".format(i, len(recent_news)))
+                    try:
+                        content = fetch_scored_text(_url_path, _url, _description, _cache_filename,
+                                                    offline=args.offline)
+                    except (KeyError, urllib3.exceptions.HTTPError):
+                        _n_skipped += 1
+                        continue
+                    _article_dict[_url] = {'content': content}
+                _article_dict = score_all(_article_dict, _qaly_scorer)
+
+                if _n_skipped > 0:
+                    print('{} articles which were not cached, or could not be fetched, were skipped'.format(_n_skipped))
+                resubmit_score_topics(_partition, _article_dict, _qaly_scorer)
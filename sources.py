@@ -0,0 +1,84 @@
+import os
+import re
+import threading
+from collections import namedtuple
+from urllib.parse import urlparse
+
+Source = namedtuple('Source', ['source_id', 'keyword', 'delimiter', 'class_matcher'])
+Source.__doc__ = """A news source whose articles can be extracted
+
+source_id : A string, the NewsAPI id of the source
+keyword : A string, a URL belongs to the source if its hostname contains the keyword
+delimiter : A string, a regular expression matching the class of the HTML elements holding the story
+class_matcher : The compiled delimiter
+"""
+
+_registries = {}  # absolute path of the URL lookup table -> (file stat key, SourceRegistry)
+_registries_lock = threading.Lock()
+
+
+class SourceRegistry(object):
+    """The news sources of a URL lookup table, indexed by hostname
+
+    Parameters
+    ----------------
+    url_lookup : A string, the path to the URL lookup table, a CSV file with columns source,keyword,delimiter
+    """
+
+    def __init__(self, url_lookup):
+        self.sources = []
+        with open(url_lookup, 'r') as infile:
+            for line_num, line in enumerate(infile):
+                line = line.rstrip('\r\n')
+                if line_num == 0 or not line:
+                    continue
+                source_id, keyword, delimiter = line.split(',')
+                self.sources.append(Source(source_id, keyword, delimiter, re.compile(delimiter)))
+        self._by_host = {}  # hostname -> Source or None, filled in as hosts are seen
+        self._lock = threading.Lock()
+
+    def source_ids(self):
+        """The NewsAPI ids of all sources, in table order and without repeats"""
+        source_ids = []
+        for source in self.sources:
+            if source.source_id not in source_ids:
+                source_ids.append(source.source_id)
+        return source_ids
+
+    def lookup(self, url):
+        """Find the source a URL belongs to, without any I/O
+
+        Parameters
+        ----------------
+        url : A string, the URL of an article
+
+        Returns
+        ----------------
+        source : A Source, or None if no source in the table matches the URL. If several match, the last one in the
+                 table wins.
+        """
+        host = urlparse(url).hostname or ''
+        try:
+            return self._by_host[host]
+        except KeyError:
+            pass
+        match = None
+        for source in reversed(self.sources):
+            if source.keyword in host:
+                match = source
+                break
+        with self._lock:
+            self._by_host[host] = match
+        return match
+
+
+def get_source_registry(url_lookup):
+    """Get the SourceRegistry for a URL lookup table, loading it again only if the file has changed"""
+    path = os.path.abspath(url_lookup)
+    stat = os.stat(path)
+    stat_key = (stat.st_mtime_ns, stat.st_size)
+    with _registries_lock:
+        cached = _registries.get(path)
+        if cached is None or cached[0] != stat_key:
+            cached = _registries[path] = (stat_key, SourceRegistry(path))
+        return cached[1]
@@ -0,0 +1,51 @@
+import pytest
+import get_full_content
+from article_cache import ArticleCache, get_article_cache
+
+
+def test_put_and_get(tmp_path):
+    cache = ArticleCache(str(tmp_path / 'cache.db'))
+    assert cache.get('https://example.com/a') is None
+    cache.put_many([('https://example.com/a', 'Café text ' * 100), ('https://example.com/b', None)], 2)
+    content, fetched_at, extractor_version = cache.get('https://example.com/a')
+    assert (content, len(fetched_at), extractor_version) == ('Café text ' * 100, 19, 2)
+    assert cache.get('https://example.com/b')[::2] == (None, 2)
+
+    # A URL fetched again replaces its entry, and entries outlive the connection
+    cache.put('https://example.com/a', 'new text', 3)
+    cache.close()
+    assert ArticleCache(str(tmp_path / 'cache.db')).get('https://example.com/a')[::2] == ('new text', 3)
+
+
+def test_get_article_cache_is_shared(tmp_path):
+    cache_filename = str(tmp_path / 'cache.db')
+    assert get_article_cache(cache_filename) is get_article_cache(cache_filename)
+
+
+def test_get_cached_url_content(tmp_path, monkeypatch):
+    cache_filename = str(tmp_path / 'cache.db')
+    fetched = []
+
+    def get_url_content(url_lookup, url):
+        fetched.append(url)
+        return 'fetched ' + url
+    monkeypatch.setattr(get_full_content, 'get_url_content', get_url_content)
+    cache = get_article_cache(cache_filename)
+    cache.put('https://example.com/old', 'old extraction', get_full_content.extractor_version - 1)
+    cache.put('https://example.com/empty', None, get_full_content.extractor_version)
+
+    # Offline, whatever the cache holds is returned, and nothing is fetched
+    assert get_full_content.get_cached_url_content(None, 'https://example.com/old', cache_filename,
+                                                   offline=True) == 'old extraction'
+    with pytest.raises(KeyError):
+        get_full_content.get_cached_url_content(None, 'https://example.com/new', cache_filename, offline=True)
+    assert fetched == []
+
+    # Online, pages extracted by an older extractor are fetched again, and pages without content are not
+    assert get_full_content.get_cached_url_content(None, 'https://example.com/empty', cache_filename) is None
+    for _ in range(2):
+        assert get_full_content.get_cached_url_content(None, 'https://example.com/old', cache_filename) == \
+            'fetched https://example.com/old'
+    assert fetched == ['https://example.com/old']
+    assert cache.get('https://example.com/old')[::2] == ('fetched https://example.com/old',
+                                                         get_full_content.extractor_version)
@@ -0,0 +1,100 @@
+import sqlite3 as sq
+import pytest
+import backup
+import news_db
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    """Back up into tmp_path, restoring the backup settings afterwards"""
+    for name in ('retention', 'backup_dir', 'wal_shipping', 'snapshot_period_h'):
+        monkeypatch.setattr(backup, name, getattr(backup, name))
+    monkeypatch.setattr(news_db, 'wal_autocheckpoint', news_db.wal_autocheckpoint)
+    yield
+    backup.wait()
+
+
+def make_db(db_filename):
+    conn = news_db.connect(db_filename)
+    with conn:
+        conn.execute('CREATE TABLE t (x INTEGER, pad TEXT)')
+    return conn
+
+
+def insert(conn, values):
+    with conn:
+        conn.executemany('INSERT INTO t VALUES (?, ?)', [(x, 'x' * (x % 5000)) for x in values])
+
+
+def rows(db_filename):
+    conn = sq.connect(db_filename)
+    try:
+        return conn.execute('SELECT x, pad FROM t ORDER BY x').fetchall()
+    finally:
+        conn.close()
+
+
+def test_snapshots(tmp_path, settings):
+    backup.configure(retention=2, backup_dir=str(tmp_path / 'backups'))
+    (tmp_path / 'backups').mkdir()
+    db_filename = str(tmp_path / 'news.db')
+    conn = make_db(db_filename)
+    for n in range(3):
+        insert(conn, range(100 * n, 100 * n + 100))
+        backup.backup_db(db_filename)
+    generations = backup.generations(db_filename)
+    assert len(generations) == 2 and all(log_filename is None for _, log_filename in generations)
+    assert all(filename.startswith(str(tmp_path / 'backups')) for filename, _ in generations)
+
+    assert backup.restore(db_filename, str(tmp_path / 'restored.db')) == 0
+    assert rows(str(tmp_path / 'restored.db')) == rows(db_filename)
+    backup.restore(db_filename, str(tmp_path / 'older.db'), generation=0)
+    assert len(rows(str(tmp_path / 'older.db'))) == 200
+
+
+def test_wal_shipping(tmp_path, settings):
+    backup.configure(wal_shipping=True)
+    db_filename = str(tmp_path / 'news.db')
+    conn = make_db(db_filename)
+    insert(conn, range(100))
+    backup.backup_db(db_filename)
+    for n in range(1, 5):
+        insert(conn, range(100 * n, 100 * n + 100))
+        with conn:
+            conn.execute('DELETE FROM t WHERE x % 7 = ?', (n,))
+        backup.backup_db(db_filename)
+    [(snapshot_filename, log_filename)] = backup.generations(db_filename)
+    assert log_filename is not None
+    assert backup.restore(db_filename, str(tmp_path / 'restored.db')) == 8
+    assert rows(str(tmp_path / 'restored.db')) == rows(db_filename)
+
+
+def test_wal_shipping_with_other_checkpointers(tmp_path, settings):
+    backup.configure(wal_shipping=True)
+    db_filename = str(tmp_path / 'news.db')
+    conn = make_db(db_filename)
+    insert(conn, range(10))
+    backup.backup_db(db_filename)
+
+    # A reader holds the WAL, so the shipper's checkpoint leaves the WAL to be appended to rather than restarted, then
+    # a connection with automatic checkpoints (e.g. score_articles.py) writes and checkpoints
+    reader = sq.connect(db_filename, isolation_level=None)
+    other = sq.connect(db_filename, isolation_level=None, timeout=0.1)
+    other.execute('PRAGMA wal_autocheckpoint=1')
+    reader.execute('BEGIN')
+    reader.execute('SELECT COUNT(*) FROM t').fetchone()
+    backup.backup_db(db_filename)
+    other.execute("INSERT INTO t VALUES (100, 'written while the reader held the WAL')")
+    reader.execute('COMMIT')
+    for mode in ('PASSIVE', 'RESTART', 'TRUNCATE'):
+        other.execute('PRAGMA wal_checkpoint({})'.format(mode)).fetchone()
+        other.execute('INSERT INTO t VALUES (?, ?)', (101 + len(mode), mode))
+    insert(conn, range(200, 210))
+    backup.backup_db(db_filename)
+    reader.close()
+    other.close()
+
+    # No frame was checkpointed before it was shipped, so the first generation still holds everything
+    assert len(backup.generations(db_filename)) == 1
+    backup.restore(db_filename, str(tmp_path / 'restored.db'))
+    assert rows(str(tmp_path / 'restored.db')) == rows(db_filename)
@@ -0,0 +1,80 @@
+import datetime
+import random
+import dedup
+import news_db
+import news_store
+import tweeting
+
+
+def test_canonicalize_url():
+    canonical = 'https://www.bbc.com/news/World-1?id=7&page=2'
+    for variant in ['https://www.bbc.com/news/World-1?page=2&id=7',
+                    'HTTPS://WWW.BBC.COM:443/news/World-1?id=7&utm_source=twitter&page=2#comments',
+                    ' https://www.bbc.com./news/World-1?fbclid=abc&id=7&page=2&_ga=1 ']:
+        assert dedup.canonicalize_url(variant) == canonical, variant
+    assert dedup.canonicalize_url('http://example.com:8080') == 'http://example.com:8080/'
+    # The path is case-sensitive, and parameters which change the page are kept
+    assert dedup.canonicalize_url('https://www.bbc.com/news/world-1?id=7&page=2') != canonical
+    assert dedup.canonicalize_url('https://www.bbc.com/news/World-1?id=8&page=2') != canonical
+
+
+def test_signed_round_trip():
+    for fingerprint in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+        value = dedup.to_signed(fingerprint)
+        assert -(1 << 63) <= value < 1 << 63 and dedup.from_signed(value) == fingerprint
+
+
+def test_simhash_near_duplicates():
+    rng = random.Random(0)
+    vocabulary = ['word{}'.format(i) for i in range(500)]
+    story = [rng.choice(vocabulary) for _ in range(400)]
+    edited = list(story)
+    edited[100:102] = ['Reuters', 'reported']
+    other = [rng.choice(vocabulary) for _ in range(400)]
+    fingerprint = dedup.simhash(' '.join(story))
+    assert dedup.simhash(' '.join(story).upper()) == fingerprint
+    assert bin(fingerprint ^ dedup.simhash(' '.join(edited))).count('1') <= dedup.max_distance
+    assert bin(fingerprint ^ dedup.simhash(' '.join(other))).count('1') > dedup.max_distance
+    assert dedup.simhash(' '.join(story[:dedup.min_words - 1])) is None
+    assert dedup.simhash(None) is None
+
+
+def test_simhash_index():
+    rng = random.Random(0)
+    fingerprints = [rng.getrandbits(dedup.n_bits) for _ in range(1000)]
+    index = dedup.SimHashIndex()
+    for n, fingerprint in enumerate(fingerprints):
+        index.add(n, fingerprint)
+    assert len(index) == len(fingerprints)
+    for n, fingerprint in enumerate(fingerprints[:200]):
+        # Flip up to max_distance bits, anywhere, including across the bands
+        near = fingerprint
+        for bit in rng.sample(range(dedup.n_bits), rng.randint(0, dedup.max_distance)):
+            near ^= 1 << bit
+        assert index.find(near) == n
+        far = fingerprint
+        for bit in rng.sample(range(dedup.n_bits), 20):
+            far ^= 1 << bit
+        # Brute force agrees on whether anything is within max_distance of a distant fingerprint
+        found = index.find(far)
+        nearest = min(bin(other ^ far).count('1') for other in fingerprints)
+        assert (found is not None) == (nearest <= dedup.max_distance)
+
+
+def test_known_urls_and_fingerprints(tmp_path):
+    db_filename = str(tmp_path / 'news.db')
+    conn = news_db.connect(db_filename)
+    conn.execute(tweeting.news_create_str)
+    news_db.migrate(db_filename)
+    with conn:
+        conn.execute("INSERT INTO news(url, score, published_at) VALUES('https://example.com/a', 1.0, "
+                     "'2020-01-02T00:00:00')")
+    news_store.save_fingerprints(db_filename, [('https://example.com/a', (1 << 64) - 1, '2020-01-02T00:00:00'),
+                                               ('https://example.com/old', 5, '2019-12-01T00:00:00')],
+                                 [('https://example.com/copy', 'https://example.com/a')])
+    assert news_store.find_known_urls(db_filename, ['https://example.com/a', 'https://example.com/copy',
+                                                    'https://example.com/new']) == \
+        {'https://example.com/a', 'https://example.com/copy'}
+
+    index = news_store.load_dedup_index(db_filename, datetime.datetime(2020, 1, 1))
+    assert len(index) == 1 and index.find((1 << 64) - 2) == 'https://example.com/a'
@@ -0,0 +1,35 @@
+import html
+import os
+import re
+from benchmarks.bench_extraction import legacy_extract_story
+from benchmarks.pages import fixture_filename
+from get_full_content import extract_story
+from sources import SourceRegistry
+
+url_lookup = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'url_content_lookup.csv')
+
+
+def test_extract_story():
+    page = '''<html><body><nav class="menu"><p>Home</p></nav>
+              <div class="story-body"><h1>Title</h1><p>First <a href="/x">linked</a> &amp; bold.</p>
+                <div class="story-body__inner"><p>Second.</p></div></div>
+              <p class="story-body">Third.</p><div class="related"><p>Elsewhere</p></div></body></html>'''
+    # The nested container is read once, with its parent
+    assert extract_story(page, re.compile('story-body')) == 'First linked & bold. Second. Third.'
+    assert extract_story(page.encode('utf-8'), re.compile('^related$')) == 'Elsewhere'
+    assert extract_story(page, re.compile('missing')) == ''
+
+
+def test_extract_story_matches_legacy_on_fixtures():
+    # The legacy extraction kept HTML entities escaped, which extract_story decodes
+    n_fixtures = 0
+    for source in SourceRegistry(url_lookup).sources:
+        filename = fixture_filename(source)
+        if not os.path.exists(filename):
+            continue
+        with open(filename, 'rb') as infile:
+            page = infile.read()
+        story = extract_story(page, source.class_matcher)
+        assert story and story == html.unescape(legacy_extract_story(page, source.class_matcher)), source.source_id
+        n_fixtures += 1
+    assert n_fixtures > 0
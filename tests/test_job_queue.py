@@ -0,0 +1,118 @@
+import time
+import pytest
+import job_queue
+import news_db
+import tweeting
+
+url_path = 'url_content_lookup.csv'
+
+
+def page(*articles):
+    """A page of NewsAPI results, articles being tuples (url, description)"""
+    return {'articles': [{'url': url, 'publishedAt': '2020-01-01T00:00:00Z', 'source': {'id': 'test'},
+                          'description': description} for url, description in articles]}
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    """A job queue and an empty news database, with a QALY table, and pages fetched with the text of each URL"""
+    for name in ('lease_s', 'max_attempts', 'idle_sleep_s'):
+        monkeypatch.setattr(job_queue, name, getattr(job_queue, name))
+    monkeypatch.setattr(job_queue, 'fetch_many_contents',
+                        lambda url_path, urls, cache_filename, max_workers: ['text of ' + url for url in urls])
+    db_filename = str(tmp_path / 'news.db')
+    tweeting.create_db(db_filename, tweeting.news_create_str)
+    qaly_path = tmp_path / 'table.csv'
+    qaly_path.write_text('Topic,Score,Keywords,Reference\nA,3,alpha,\n')
+    return str(tmp_path / 'jobs.db'), db_filename, str(qaly_path), str(tmp_path / 'cache.db')
+
+
+def work(queue, worker):
+    queue_filename, db_filename, qaly_path, cache_filename = queue
+    return job_queue.work(queue_filename, worker, qaly_path, url_path, cache_filename=cache_filename)
+
+
+def test_enqueue_page(queue):
+    queue_filename, db_filename, _, _ = queue
+    assert job_queue.enqueue_page(queue_filename, db_filename, page(('https://example.com/a?utm_source=x', 'A'),
+                                                                    ('https://example.com/a', 'A again'),
+                                                                    ('https://example.com/b', 'B'))) == 2
+    assert job_queue.enqueue_page(queue_filename, db_filename, page(('https://example.com/b', 'B'))) == 0
+    assert job_queue.status(queue_filename) == {'pending': 2, 'leased': 0, 'done': 0, 'failed': 0}
+
+
+def test_lease_expiry(queue, monkeypatch):
+    queue_filename, db_filename, qaly_path, _ = queue
+    job_queue.enqueue_page(queue_filename, db_filename, page(('https://example.com/a', 'alpha')))
+    job_queue.lease_s = 0.2
+    job_queue.max_attempts = 4
+    [job] = job_queue.claim(queue_filename, 'worker1', 10)
+    assert job[0] == 'https://example.com/a' and job[-1] == 1
+    assert job_queue.claim(queue_filename, 'worker2', 10) == []
+    assert job_queue.status(queue_filename)['leased'] == 1
+
+    # worker1 stalls fetching past its lease, so the job is handed to worker2, and worker1's late result is ignored
+    def stalled_fetch(url_path, urls, cache_filename, max_workers):
+        time.sleep(0.3)
+        assert [job[-1] for job in job_queue.claim(queue_filename, 'worker2', 10)] == [3]
+        return ['text of ' + url for url in urls]
+    time.sleep(0.3)
+    fetch_many_contents = job_queue.fetch_many_contents
+    monkeypatch.setattr(job_queue, 'fetch_many_contents', stalled_fetch)
+    assert work(queue, 'worker1') == 1
+    assert job_queue.connect(queue_filename).execute('SELECT state, worker, score FROM jobs').fetchall() == \
+        [('leased', 'worker2', None)]
+
+    # Once worker2's lease expires too, the job is claimed and reported on its last attempt
+    time.sleep(0.3)
+    job_queue.lease_s = 300.0
+    monkeypatch.setattr(job_queue, 'fetch_many_contents', fetch_many_contents)
+    assert work(queue, 'worker3') == 1
+    assert job_queue.status(queue_filename)['done'] == 1
+    assert job_queue.write_results(queue_filename, db_filename, qaly_path) == 1
+    assert job_queue.status(queue_filename) == {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+    assert news_db.connect(db_filename).execute('SELECT url, score FROM news').fetchall() == \
+        [('https://example.com/a', 3.0)]
+
+
+def test_failed_jobs(queue):
+    queue_filename, db_filename, _, _ = queue
+    job_queue.enqueue_page(queue_filename, db_filename, page(('https://example.com/a', 'alpha')))
+    job_queue.lease_s = 0.0
+    job_queue.max_attempts = 2
+    # A job whose workers never report back is handed out max_attempts times, then given up on
+    assert [job[-1] for job in job_queue.claim(queue_filename, 'worker1', 10)] == [1]
+    assert [job[-1] for job in job_queue.claim(queue_filename, 'worker2', 10)] == [2]
+    assert job_queue.claim(queue_filename, 'worker3', 10) == []
+    assert job_queue.status(queue_filename)['failed'] == 1
+
+
+def test_drain(queue):
+    queue_filename, db_filename, qaly_path, _ = queue
+    job_queue.idle_sleep_s = 0.01
+    job_queue.enqueue_page(queue_filename, db_filename, page(('https://example.com/a', 'alpha'),
+                                                             ('https://example.com/b', 'beta')))
+    # Without workers, drain writes nothing and gives up after timeout_s
+    assert job_queue.drain(queue_filename, db_filename, qaly_path, timeout_s=0) == 0
+    assert job_queue.status(queue_filename)['pending'] == 2
+
+    assert work(queue, 'worker1') == 2
+    assert job_queue.drain(queue_filename, db_filename, qaly_path, timeout_s=0) == 2
+    assert sorted(news_db.connect(db_filename).execute('SELECT url, score, description FROM news')) == \
+        [('https://example.com/a', 3.0, 'alpha'), ('https://example.com/b', 0.0, 'beta')]
+    assert job_queue.drain(queue_filename, db_filename, qaly_path) == 0
+
+
+def test_stale_scorer_version(queue):
+    queue_filename, db_filename, qaly_path, _ = queue
+    job_queue.enqueue_page(queue_filename, db_filename, page(('https://example.com/a', 'alpha')))
+    assert work(queue, 'worker1') == 1
+    # Scored by a version of the QALY table which has since changed, so the job is queued to be scored again
+    job_queue.connect(queue_filename).execute("UPDATE jobs SET scorer_version='old'")
+    assert job_queue.write_results(queue_filename, db_filename, qaly_path) == 0
+    assert job_queue.connect(queue_filename).execute('SELECT state, attempts FROM jobs').fetchall() == [('pending', 0)]
+    assert news_db.connect(db_filename).execute('SELECT COUNT(*) FROM news').fetchone()[0] == 0
+
+    assert work(queue, 'worker1') == 1
+    assert job_queue.write_results(queue_filename, db_filename, qaly_path) == 1
+    assert news_db.connect(db_filename).execute('SELECT url FROM news').fetchall() == [('https://example.com/a',)]
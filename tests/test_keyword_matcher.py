@@ -0,0 +1,46 @@
+import os
+import random
+import score_articles
+from keyword_matcher import KeywordMatcher
+
+qaly_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'global_prios', 'global_prios.csv')
+
+
+def legacy_score_article(article, qaly_scorer):
+    """score_articles.score_article before the keyword automaton: one substring search per keyword and clause"""
+    article_score = 0
+    article_topics = []
+    for keyword_set in qaly_scorer:
+        if all(keyword in article for keyword in keyword_set):
+            topic = qaly_scorer[keyword_set][1]
+            if topic not in article_topics:
+                article_score += qaly_scorer[keyword_set][0]
+                article_topics.append(topic)
+    return article_score, article_topics
+
+
+def test_find_matches_substring_search():
+    # Keywords which overlap, nest and share prefixes and suffixes, in texts over the same small alphabet
+    keywords = ['he', 'she', 'his', 'hers', 'a', 'aa', 'aaa', 'ab', 'bab', 'b a', 'ahe', '']
+    matcher = KeywordMatcher(keywords)
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = ''.join(rng.choice('abehirs ') for _ in range(rng.randint(0, 30)))
+        assert matcher.find(text) == set(keyword for keyword in keywords if keyword and keyword in text), text
+
+
+def test_find_without_keywords():
+    assert KeywordMatcher([]).find('anything') == set()
+    assert KeywordMatcher(['']).find('anything') == set()
+    assert KeywordMatcher(['word']).find('') == set()
+
+
+def test_score_article_matches_legacy():
+    qaly_scorer = score_articles.get_qaly_data(qaly_path, dnf=True)
+    matcher = score_articles.compile_matcher(qaly_scorer)
+    keywords = sorted(set(keyword for keyword_set in qaly_scorer for keyword in keyword_set))
+    rng = random.Random(0)
+    for _ in range(500):
+        article = ' '.join(rng.choice(keywords + ['filler', 'text']) for _ in range(rng.randint(0, 8)))
+        assert score_articles.score_article(article, qaly_scorer, matcher) == \
+            legacy_score_article(article, qaly_scorer), article
@@ -0,0 +1,56 @@
+import itertools
+import os
+import random
+import score_articles
+from keyword_parser import parse_expression, parse_keywords
+
+qaly_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'global_prios', 'global_prios.csv')
+expressions = ['poverty AND (global OR "international challenge" OR (africa AND subafrica))',
+               'poverty AND (global OR "international challenge" OR (africa AND (subafrica OR subaf)) OR india OR '
+               '(lower AND (middle OR mid OR (m AND M)) AND income))',
+               '(cancer OR tumor) AND (cancer OR world)',
+               'a OR (b AND (c OR (d AND (e OR a))))']
+
+
+def evaluate(tree, found):
+    if isinstance(tree, str):
+        return tree in found
+    op, children = tree
+    return (all if op == 'AND' else any)(evaluate(child, found) for child in children)
+
+
+def keywords_of(tree):
+    if isinstance(tree, str):
+        return {tree}
+    return set().union(*(keywords_of(child) for child in tree[1]))
+
+
+def test_parse_expression_example():
+    assert parse_expression(expressions[0]) == \
+        ('AND', ('poverty', ('OR', ('global', 'international challenge', ('AND', ('africa', 'subafrica'))))))
+
+
+def test_parse_expression_matches_dnf():
+    # The tree is true for exactly the sets of keywords which satisfy one of the DNF clauses
+    for expression in expressions:
+        tree = parse_expression(expression)
+        clauses = parse_keywords(expression)
+        keywords = sorted(keywords_of(tree))
+        assert keywords == sorted(set(keyword for clause in clauses for keyword in clause))
+        for n in range(len(keywords) + 1):
+            for found in itertools.combinations(keywords, n):
+                found = set(found)
+                assert evaluate(tree, found) == any(found.issuperset(clause) for clause in clauses), (expression, found)
+
+
+def test_qaly_scorer_matches_dnf_scorer(tmp_path):
+    dnf_scorer = score_articles.get_qaly_data(qaly_path, dnf=True)
+    qaly_scorer = score_articles.load_qaly_scorer(qaly_path, cache_dir=str(tmp_path))
+    keywords = sorted(qaly_scorer.keywords)
+    rng = random.Random(0)
+    articles = [' '.join(rng.choice(keywords + ['filler']) for _ in range(rng.randint(0, 8))) for _ in range(500)]
+    scores, topics = score_articles.score_batch(articles, qaly_scorer)
+    for article, score, article_topics in zip(articles, scores, topics):
+        expected = score_articles.score_article(article, dnf_scorer)
+        assert score_articles.score_article(article, qaly_scorer) == expected, article
+        assert (score, article_topics) == expected, article
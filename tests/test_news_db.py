@@ -0,0 +1,132 @@
+import pytest
+import news_db
+import news_store
+import tweeting
+
+
+def make_baseline_db(db_filename, rows=()):
+    """A news database as the baseline created it, with no migration applied"""
+    conn = news_db.connect(db_filename)
+    with conn:
+        conn.execute(tweeting.news_create_str)
+        conn.executemany('INSERT INTO news(url, score, topics, published_at, source) VALUES(?, ?, ?, ?, ?)', rows)
+    return conn
+
+
+def names(conn, kind):
+    return set(name for name, in conn.execute('SELECT name FROM sqlite_master WHERE type=?', (kind,)))
+
+
+def test_migrate_baseline(tmp_path):
+    db_filename = str(tmp_path / 'news.db')
+    conn = make_baseline_db(db_filename, [('https://example.com/a', 3.0, 'A; B', '2020-01-01T00:00:00', 'test'),
+                                          ('https://example.com/b', 0.0, 'NULL', '2020-01-02T00:00:00', 'test')])
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 0
+    assert news_db.migrate(db_filename) == len(news_db.migrations)
+    assert news_db.migrate(db_filename) == 0
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(news_db.migrations)
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    columns = set(row[1] for row in conn.execute('PRAGMA table_info(news)'))
+    assert {'scorer_version', 'description'} <= columns
+    assert {'scorer_versions', 'news_meta', 'refresh_checkpoints', 'simhashes', 'duplicates', 'topics',
+            'article_topics', 'table_scores', 'source_polls'} <= names(conn, 'table')
+    assert {'news_published_at', 'news_source_published_at', 'article_topics_topic_published_at'} <= \
+        names(conn, 'index')
+    assert conn.execute('SELECT COUNT(*) FROM news').fetchone()[0] == 2
+    # The topic strings of existing articles are copied into article_topics
+    assert news_db.get_article_topics(conn, ['https://example.com/a', 'https://example.com/b']) == \
+        {'https://example.com/a': ['A', 'B']}
+
+
+def test_migrate_partly_migrated(tmp_path):
+    db_filename = str(tmp_path / 'news.db')
+    conn = make_baseline_db(db_filename)
+    with conn:
+        for statement in news_db.migrations[0]:
+            conn.execute(statement)
+        conn.execute('PRAGMA user_version=1')
+    assert news_db.migrate(db_filename) == len(news_db.migrations) - 1
+    assert news_db.migrate(db_filename) == 0
+
+
+def test_failed_migration_is_rolled_back(tmp_path, monkeypatch):
+    db_filename = str(tmp_path / 'news.db')
+    conn = make_baseline_db(db_filename)
+    monkeypatch.setattr(news_db, 'migrations', news_db.migrations[:1] + [
+        ['CREATE TABLE half_done (x INTEGER)', 'SELECT * FROM no_such_table']])
+    with pytest.raises(Exception):
+        news_db.migrate(db_filename)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 1
+    assert 'half_done' not in names(conn, 'table')
+
+
+def test_article_topics(tmp_path):
+    db_filename = str(tmp_path / 'news.db')
+    conn = make_baseline_db(db_filename, [('https://example.com/{}'.format(n), 1.0, None,
+                                           '2020-01-0{}T00:00:00'.format(n), 'test') for n in range(1, 5)])
+    news_db.migrate(db_filename)
+    with conn:
+        news_db.set_article_topics(conn, [('https://example.com/1', ['B', 'A']), ('https://example.com/2', ['A']),
+                                          ('https://example.com/3', ['C', 'A']), ('https://example.com/4', []),
+                                          ('https://example.com/missing', ['A'])])
+    assert news_db.get_article_topics(conn, ['https://example.com/{}'.format(n) for n in range(1, 5)]) == \
+        {'https://example.com/1': ['B', 'A'], 'https://example.com/2': ['A'], 'https://example.com/3': ['C', 'A']}
+    assert news_db.articles_with_topic(conn, 'A', '2019-12-31T00:00:00') == \
+        [('https://example.com/3', '2020-01-03T00:00:00'), ('https://example.com/2', '2020-01-02T00:00:00'),
+         ('https://example.com/1', '2020-01-01T00:00:00')]
+    assert news_db.count_topics(conn, '2019-12-31T00:00:00') == {'A': 3, 'B': 1, 'C': 1}
+
+    # Topics are replaced, not added to
+    with conn:
+        news_db.set_article_topics(conn, [('https://example.com/3', ['A', 'D'])])
+    assert news_db.get_article_topics(conn, ['https://example.com/3']) == {'https://example.com/3': ['A', 'D']}
+    assert news_db.count_topics(conn, '2019-12-31T00:00:00') == {'A': 3, 'B': 1, 'D': 1}
+    assert news_db.articles_with_topic(conn, 'unknown', '2020-01-01T00:00:00') == []
+
+
+def test_roll_over(tmp_path):
+    db_filename = str(tmp_path / 'news.db')
+    tweeting.create_db(db_filename, tweeting.news_create_str)
+    conn = news_db.connect(db_filename)
+    articles = [('https://example.com/dec', '2019-12-31T23:00:00', ['A']),
+                ('https://example.com/jan1', '2020-01-01T00:00:00', ['B', 'A']),
+                ('https://example.com/jan2', '2020-01-15T00:00:00', []),
+                ('https://example.com/feb', '2020-02-02T00:00:00', ['A'])]
+    with conn:
+        conn.executemany("INSERT INTO news(url, score, topics, published_at, source) VALUES(?, 1.0, ?, ?, 'test')",
+                         [(url, '; '.join(topics) or 'NULL', published_at) for url, published_at, topics in articles])
+        news_db.set_article_topics(conn, [(url, topics) for url, _, topics in articles])
+        news_db.set_table_scores(conn, [(url, 'other', 2.0, 'A', None) for url, _, _ in articles])
+    news_store.save_fingerprints(db_filename, [(url, n + 1, published_at)
+                                               for n, (url, published_at, _) in enumerate(articles)],
+                                 [('https://example.com/jan1-copy', 'https://example.com/jan1')])
+    delete_epoch = news_db.get_delete_epoch(conn)
+
+    dec_filename, jan_filename = news_db.archive_filename(db_filename, '2019-12'), \
+        news_db.archive_filename(db_filename, '2020-01')
+    assert news_db.roll_over(db_filename, '2020-02-01T00:00:00') == {dec_filename: 1, jan_filename: 2}
+    assert news_db.roll_over(db_filename, '2020-02-01T00:00:00') == {}
+    assert news_db.partitions(db_filename) == [dec_filename, jan_filename, db_filename]
+    assert news_db.partitions(db_filename, since='2020-01-20T00:00:00') == [jan_filename, db_filename]
+
+    # Each article moved with its topics, scores, fingerprint and duplicates
+    for filename, urls in ((db_filename, ['https://example.com/feb']), (dec_filename, ['https://example.com/dec']),
+                           (jan_filename, ['https://example.com/jan1', 'https://example.com/jan2'])):
+        partition = news_db.connect(filename)
+        assert [url for url, in partition.execute('SELECT url FROM news ORDER BY url')] == urls
+        assert news_db.get_article_topics(partition, urls) == dict((url, topics) for url, _, topics in articles
+                                                                   if url in urls and topics)
+        for table in ('table_scores', 'simhashes'):
+            assert partition.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0] == len(urls)
+    assert news_db.connect(jan_filename).execute('SELECT * FROM duplicates').fetchall() == \
+        [('https://example.com/jan1-copy', 'https://example.com/jan1')]
+    assert news_db.get_delete_epoch(conn) == delete_epoch + 3
+
+    # Archived articles are still known, and found by queries over all partitions
+    assert news_store.find_known_urls(db_filename, ['https://example.com/jan1-copy', 'https://example.com/new'],
+                                      ['2020-01-02T00:00:00', '2020-02-03T00:00:00']) == \
+        {'https://example.com/jan1-copy'}
+    assert news_store.find_known_urls(db_filename, ['https://example.com/jan1-copy']) == set()
+    assert sorted(url for url, in news_db.query_partitions(db_filename, 'SELECT url FROM news')) == \
+        sorted(url for url, _, _ in articles)
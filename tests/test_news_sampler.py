@@ -0,0 +1,87 @@
+import datetime
+import random
+import news_db
+import tweeting
+from news_sampler import FenwickSampler, NewsSampler
+
+
+def test_fenwick_sampler():
+    sampler = FenwickSampler(capacity=4)
+    weights = {}
+    rng = random.Random(0)
+    for i in range(200):  # grows past its capacity, and reuses the slots of removed keys
+        key = rng.randrange(50)
+        if rng.random() < 0.3:
+            sampler.remove(key)
+            weights.pop(key, None)
+        else:
+            weights[key] = rng.choice([0.0, rng.random() * 10])
+            sampler.set(key, weights[key])
+        assert len(sampler) == len(weights) and all(key in sampler for key in weights)
+        assert abs(sampler.total() - sum(weights.values())) < 1e-9
+
+    counts = dict((key, 0) for key in weights)
+    n_draws = 20000
+    for _ in range(n_draws):
+        counts[sampler.sample(rng)] += 1
+    total = sum(weights.values())
+    for key, weight in weights.items():
+        assert abs(counts[key] / n_draws - weight / total) < 0.02, key
+        if weight == 0.0:
+            assert counts[key] == 0
+
+
+def test_fenwick_sampler_without_weight():
+    sampler = FenwickSampler()
+    assert sampler.sample() is None
+    sampler.set('a', 0.0)
+    assert sampler.sample() is None
+    sampler.set('a', 1.0)
+    assert sampler.sample() == 'a'
+    sampler.remove('a')
+    assert sampler.sample() is None and len(sampler) == 0
+
+
+def test_news_sampler_sync(tmp_path):
+    db_filename = str(tmp_path / 'news.db')
+    conn = news_db.connect(db_filename)
+    conn.execute(tweeting.news_create_str)
+    news_db.migrate(db_filename)
+    now = datetime.datetime(2020, 1, 10)
+
+    def insert(n, hours_ago, score):
+        with conn:
+            conn.execute('INSERT INTO news(url, score, published_at) VALUES(?, ?, ?)',
+                         ('https://example.com/{}'.format(n), score,
+                          (now - datetime.timedelta(hours=hours_ago)).strftime('%Y-%m-%dT%H:%M:%S')))
+
+    def expected(window_start):
+        return dict(conn.execute('SELECT url, score FROM news WHERE published_at > datetime(?)',
+                                 (window_start.strftime('%Y-%m-%d %H:%M:%S'),)))
+
+    sampler = NewsSampler(db_filename, sample_log_qalys=False)
+    for n in range(10):
+        insert(n, 5 * n, n + 1.0)
+    sampler.sync(now - datetime.timedelta(hours=24))
+    assert sampler._scores == expected(now - datetime.timedelta(hours=24))
+
+    # New articles are read incrementally, and old ones age out of the window
+    insert(10, 1, 100.0)
+    sampler.sync(now - datetime.timedelta(hours=12))
+    assert sampler._scores == expected(now - datetime.timedelta(hours=12))
+    assert sampler.score_total == sum(expected(now - datetime.timedelta(hours=12)).values())
+
+    # A deleted article's rowid may be given to a new article, which must not be missed
+    with conn:
+        conn.execute("DELETE FROM news WHERE url='https://example.com/10'")
+    insert(11, 2, 7.0)
+    sampler.sync(now - datetime.timedelta(hours=12))
+    assert sampler._scores == expected(now - datetime.timedelta(hours=12))
+
+    # Rescored articles are picked up too
+    with conn:
+        conn.execute("UPDATE news SET score=50.0 WHERE url='https://example.com/0'")
+        news_db.bump_score_epoch(conn)
+    sampler.sync(now - datetime.timedelta(hours=12))
+    assert sampler._scores == expected(now - datetime.timedelta(hours=12))
+    assert sampler.sample() in sampler._scores
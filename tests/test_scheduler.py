@@ -0,0 +1,53 @@
+import datetime
+import news_db
+import scheduler
+import tweeting
+
+now = datetime.datetime(2020, 1, 10, 12)
+
+
+def make_db(tmp_path, articles):
+    """A news database holding articles, a list of (source, hours before now) tuples"""
+    db_filename = str(tmp_path / 'news.db')
+    tweeting.create_db(db_filename, tweeting.news_create_str)
+    conn = news_db.connect(db_filename)
+    with conn:
+        conn.executemany('INSERT INTO news(url, score, published_at, source) VALUES(?, 1.0, ?, ?)',
+                         [('https://example.com/{}'.format(n),
+                           (now - datetime.timedelta(hours=hours_ago)).strftime(scheduler.dt_format), source)
+                          for n, (source, hours_ago) in enumerate(articles)])
+    return db_filename
+
+
+def mark(hours_ago, lag_minutes=20):
+    return (now - datetime.timedelta(hours=hours_ago, minutes=lag_minutes)).strftime(scheduler.dt_format)
+
+
+def test_due_groups(tmp_path):
+    # busy publishes 10 articles an hour, so is polled every 2 hours; quiet publishes one a day, so every 12 hours
+    articles = [('busy', 0.1 * n + 0.5) for n in range(1680)] + [('quiet', 24 * n + 30) for n in range(7)]
+    db_filename = make_db(tmp_path, articles)
+
+    def groups(hours_since_poll):
+        scheduler.record_poll(db_filename, ['busy', 'quiet'], now - datetime.timedelta(hours=hours_since_poll))
+        return scheduler.due_groups(db_filename, ['busy', 'quiet'], 12.0, now=now)
+
+    assert groups(1.0) == []
+    assert groups(2.5) == [(mark(0.5), ['busy'])]
+    # Once a poll is due, quiet joins it when it is within early_fraction of its own interval, in its own query since
+    # its high-water mark is far from busy's
+    assert groups(10.0) == [(mark(30), ['quiet']), (mark(0.5), ['busy'])]
+    assert groups(13.0) == [(mark(30), ['quiet']), (mark(0.5), ['busy'])]
+
+    # A source never seen before is queried without a start
+    assert scheduler.due_groups(db_filename, ['busy', 'quiet', 'new'], 12.0, now=now)[0] == (None, ['new'])
+
+
+def test_due_groups_share_queries(tmp_path):
+    source_ids = ['source{:02d}'.format(n) for n in range(25)]
+    db_filename = make_db(tmp_path, [(source_id, 5 + 0.1 * n) for n, source_id in enumerate(source_ids)])
+    groups = scheduler.due_groups(db_filename, source_ids, 3.0, lag_minutes=0, now=now)
+    # Marks within group_span_h share a query, from the earliest of them, with at most max_group_size sources each
+    assert [len(group) for _, group in groups] == [scheduler.max_group_size, 25 - scheduler.max_group_size]
+    assert sorted(source_id for _, group in groups for source_id in group) == source_ids
+    assert groups[0][0] == mark(5 + 0.1 * 24, lag_minutes=0)
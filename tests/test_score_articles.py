@@ -0,0 +1,88 @@
+import itertools
+import os
+import pickle
+import get_articles
+import news_db
+import score_articles
+import tweeting
+from article_cache import get_article_cache
+from get_full_content import extractor_version
+
+words = ('alpha', 'beta', 'gamma', 'delta', 'eps', 'zeta')
+
+
+def write_table(path, rows):
+    with open(path, 'w') as outfile:
+        outfile.write('Topic,Score,Keywords,Reference\n')
+        for topic, score, keywords in rows:
+            outfile.write('{0},{1},{2},\n'.format(topic, score, keywords))
+    return str(path)
+
+
+def test_rescore_incremental_multi_row_topic(tmp_path):
+    # B is defined by two rows, and scored by whichever matches first; only C changes between the tables
+    old_path = write_table(tmp_path / 'old.csv', [('A', 3, 'alpha'), ('B', 5, 'gamma'), ('B', 7, 'delta'),
+                                                  ('C', 2, 'eps')])
+    new_path = write_table(tmp_path / 'new.csv', [('A', 3, 'alpha'), ('B', 5, 'gamma'), ('B', 7, 'delta'),
+                                                  ('C', 2, 'eps OR zeta')])
+    old_scorer = score_articles.load_qaly_scorer(old_path, cache_dir=str(tmp_path))
+    new_scorer = score_articles.load_qaly_scorer(new_path, cache_dir=str(tmp_path))
+
+    contents = {}
+    for n in range(1, len(words) + 1):
+        for combination in itertools.combinations(words, n):
+            contents['https://example.com/{}'.format(len(contents))] = ' '.join(reversed(combination))
+    cache_filename = str(tmp_path / 'article_cache.db')
+    get_article_cache(cache_filename).put_many(contents.items(), extractor_version)
+
+    db_filename = str(tmp_path / 'news.db')
+    conn = news_db.connect(db_filename)
+    conn.execute(tweeting.news_create_str)
+    news_db.migrate(db_filename)
+    article_dict = dict((url, {'content': content, 'publishedAt': '2020-01-01T00:00:00', 'source': 'test'})
+                        for url, content in contents.items())
+    get_articles.update_news_db(db_filename, score_articles.score_all(article_dict, old_scorer), old_scorer)
+
+    n_rescored, n_skipped = score_articles.rescore_incremental(db_filename, new_scorer, '2019-12-31T00:00:00', None,
+                                                               cache_filename, offline=True)
+    assert (n_rescored, n_skipped) == (len(contents), 0)
+    stored = news_db.get_article_topics(conn, contents)
+    for url, score in conn.execute('SELECT url, score FROM news'):
+        assert (score, stored.get(url, [])) == new_scorer.score(contents[url]), contents[url]
+
+
+def test_load_qaly_scorer_cache(tmp_path, monkeypatch):
+    path = write_table(tmp_path / 'table.csv', [('A', 3, 'alpha'), ('B', 5, 'beta AND gamma')])
+    cache_dir = tmp_path / 'cache'
+    scorer = score_articles.load_qaly_scorer(path, cache_dir=str(cache_dir))
+    assert score_articles.load_qaly_scorer(path, cache_dir=str(cache_dir)) is scorer
+    assert os.listdir(str(cache_dir)) == ['{0}.v{1}.pickle'.format(scorer.version, score_articles.qaly_cache_format)]
+
+    # Touched but not changed: the same scorer
+    os.utime(path, ns=(0, 0))
+    assert score_articles.load_qaly_scorer(path, cache_dir=str(cache_dir)) is scorer
+
+    # A new process loads the compiled table from disk, without parsing the table
+    monkeypatch.setattr(score_articles, '_qaly_scorers', {})
+    with monkeypatch.context() as patch:
+        patch.setattr(score_articles, 'read_qaly_rows', None)
+        loaded = score_articles.load_qaly_scorer(path, cache_dir=str(cache_dir))
+    assert loaded is not scorer and loaded.version == scorer.version and loaded.rows == scorer.rows
+
+    # An edited table is compiled again
+    write_table(tmp_path / 'table.csv', [('A', 3, 'alpha'), ('B', 5, 'beta OR gamma')])
+    edited = score_articles.load_qaly_scorer(path, cache_dir=str(cache_dir))
+    assert edited.version != scorer.version
+    assert edited.score('gamma') == (5, ['B']) and scorer.score('gamma') == (0, [])
+    assert len(os.listdir(str(cache_dir))) == 2
+
+
+def test_load_qaly_scorer_unsaved_cache(tmp_path, monkeypatch):
+    # A compiled table which cannot be saved leaves no temporary file behind, and the scorer is still returned
+    def fail_dump(obj, outfile):
+        raise OSError('disk full')
+    monkeypatch.setattr(pickle, 'dump', fail_dump)
+    path = write_table(tmp_path / 'table.csv', [('A', 3, 'alpha')])
+    cache_dir = tmp_path / 'cache'
+    assert score_articles.load_qaly_scorer(path, cache_dir=str(cache_dir)).score('alpha') == (3, ['A'])
+    assert os.listdir(str(cache_dir)) == []
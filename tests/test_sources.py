@@ -0,0 +1,42 @@
+import os
+from sources import SourceRegistry, get_source_registry
+
+
+def write_lookup(path, rows):
+    with open(path, 'w') as outfile:
+        outfile.write('source,keyword,delimiter\n')
+        for row in rows:
+            outfile.write(','.join(row) + '\n')
+    return str(path)
+
+
+def test_lookup(tmp_path):
+    registry = SourceRegistry(write_lookup(tmp_path / 'lookup.csv', [('bbc-news', 'bbc', 'story-body'),
+                                                                     ('bbc-sport', 'bbc.co.uk', 'sport-body'),
+                                                                     ('reuters', 'reuters', 'Article')]))
+    assert registry.source_ids() == ['bbc-news', 'bbc-sport', 'reuters']
+    assert registry.lookup('https://www.bbc.com/news/world-1').source_id == 'bbc-news'
+    # The last matching source wins, and the hostname alone is matched, not the path
+    assert registry.lookup('https://www.bbc.co.uk/sport/1').source_id == 'bbc-sport'
+    assert registry.lookup('https://www.reuters.com/world/bbc').source_id == 'reuters'
+    assert registry.lookup('https://example.com/reuters/bbc') is None
+    assert registry.lookup('not a url') is None
+    # Hosts seen before are answered from the index
+    assert registry.lookup('https://www.bbc.com/news/world-2') is registry.lookup('https://www.bbc.com/news/world-1')
+    assert registry.lookup('https://www.reuters.com/world/1').class_matcher.search('ArticleBody')
+
+
+def test_get_source_registry_reloads_edited_table(tmp_path):
+    path = write_lookup(tmp_path / 'lookup.csv', [('bbc-news', 'bbc', 'story-body')])
+    registry = get_source_registry(path)
+    assert get_source_registry(path) is registry
+    write_lookup(tmp_path / 'lookup.csv', [('bbc-news', 'bbc', 'story-body'), ('reuters', 'reuters', 'Article')])
+    os.utime(path, ns=(0, 0))
+    assert get_source_registry(path).source_ids() == ['bbc-news', 'reuters']
+
+
+def test_shipped_table():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'url_content_lookup.csv')
+    registry = get_source_registry(path)
+    assert registry.lookup('https://www.aljazeera.com/news/2020/1/1/story').source_id == 'al-jazeera-english'
+    assert registry.lookup('https://www.theguardian.com/world/2020/jan/01/story').source_id == 'the-guardian-uk'
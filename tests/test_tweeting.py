@@ -0,0 +1,30 @@
+import datetime
+import news_db
+import tweeting
+
+
+class FakeApi(object):
+    def __init__(self):
+        self.statuses = []
+
+    def update_status(self, status):
+        self.statuses.append(status)
+
+
+def test_tweet_from_db_topics(tmp_path):
+    db_filename = str(tmp_path / 'news.db')
+    tweeting.create_db(db_filename, tweeting.news_create_str)
+    conn = news_db.connect(db_filename)
+    published_at = (datetime.datetime.now() - datetime.timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S')
+    for url, topics in (('https://example.com/rows', 'A; B'), ('https://example.com/string', 'Old topic')):
+        with conn:
+            conn.execute('INSERT INTO news(url, score, topics, published_at) VALUES(?, 10.0, ?, ?)',
+                         (url, topics, published_at))
+            if url.endswith('rows'):
+                news_db.set_article_topics(conn, [(url, topics.split('; '))])
+        api = FakeApi()
+        tweeting.tweet_from_db(api, db_filename, 24, qaly_thresh=1.0)
+        # An article without topic rows (e.g. written before they existed) is tweeted with its stored topic string
+        assert api.statuses[0].startswith(topics + ' ') and api.statuses[0].endswith('\n' + url)
+        with conn:
+            conn.execute('DELETE FROM news WHERE url=?', (url,))
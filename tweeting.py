@@ -1,17 +1,21 @@
 import threading
 import time
+import backup
 import get_articles
-import numpy as np
-import sqlite3 as sq
+import job_queue
+import metrics
+import news_db
+import news_sampler
+import scheduler
 import os
 import datetime
-import os
+from sources import get_source_registry
 
 dt_format = "%Y-%m-%dT%H:%M:%S"
 
 
 def create_db(db_filename, create_str):
-    """Create a SQLite database
+    """Create a SQLite database, and bring its schema up to date (see news_db.migrate)
 
     Parameters
     ----------------
@@ -23,119 +27,184 @@ def create_db(db_filename, create_str):
     return_status : An bool, True if database is created, False if the file already exists
     """
     if not os.path.exists(db_filename):
-        conn = sq.connect(db_filename)
-        c = conn.cursor()
-        c.execute(create_str)
-        conn.commit()
-        conn.close()
+        conn = news_db.connect(db_filename)
+        with conn:
+            conn.execute(create_str)
+        news_db.migrate(db_filename)
         return True
     else:
+        news_db.migrate(db_filename)
         return False
 
 
+news_create_str = '''CREATE TABLE IF NOT EXISTS news (
+                    url TEXT PRIMARY KEY,
+                    score REAL NOT NULL,
+                    topics TEXT,
+                    published_at DATETIME,
+                    source TEXT
+                    )
+                '''
+
 
-def fetch_news_since(db_filename, query_db_from):
-    """Fetch news since a particular time from database
+def archive_and_back_up(db_filename, hot_days=None):
+    """Roll the articles published more than hot_days ago into the monthly archives of the news database (see
+    news_db.roll_over), then back up (in the background) the news database and the archives written to
 
     Parameters
-    -------------
+    --------------
     db_filename : A string, the name of the news database
-    query_db_from : A string of the form YYYY-MM-DDTHH:MM:SS, the earliest time to query the database from
-
-    Returns
-    -------------
-    recent_news : A list of tuples corresponding to entries of the news database, where the date published is greater
-                  than query_from
+    hot_days : A float, the number of days of articles to keep in the news database itself, or None to keep all
     """
-    conn = sq.connect(db_filename)
-    c = conn.cursor()
-    date_query = '''SELECT * FROM news
-                    WHERE published_at > datetime('{}')
-    '''.format(datetime.datetime.strftime(query_db_from, dt_format))
-    c.execute(date_query)
-    recent_news = c.fetchall()
-    conn.close()
-    return recent_news
+    filenames = [db_filename]
+    if hot_days is not None:
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=hot_days)
+        archives = news_db.roll_over(db_filename, datetime.datetime.strftime(cutoff, dt_format))
+        for filename, n_articles in sorted(archives.items()):
+            print('Archived {0} articles into {1}'.format(n_articles, filename))
+        filenames.extend(sorted(archives))
+    for filename in filenames:
+        backup.request_backup(filename)
 
 
-def tweet_news(tweepyapi, api_key, qaly_path, url_path, db_filename, tweet_time_window,
-               news_refresh_period, qaly_thresh=1.0, sample_log_qalys=True, dbg_mode=False, lag_minutes=20):
-    """Tweet a single news story drawn randomly, weighted by a QALY, over a time window extending into the past
+def refresh_news(api_key, qaly_path, url_path, db_filename, news_refresh_period, dbg_mode=False, lag_minutes=20,
+                 cache_filename='article_cache.db', hot_days=None, compare_qaly_paths=(), queue_filename=None):
+    """Create the news database if it does not exist, and refresh from NewsAPI the sources which are due
+
+    Each source is polled as often as its publish rate calls for (see scheduler.due_groups), from the newest article
+    seen from it, so a refresh only pulls the sources which have had time to publish.
 
     Parameters
     --------------
-    tweepyapi : tweepy.api.API object, contains Twitter API credentials and allows tweeting
     api_key : A string, the API key of the news API
     qaly_path : A string, directory of the QALY table
     url_path : A string, the directory of the URL lookup table for news sources
     db_filename : A string, the name of the news database
-    tweet_time_window : A float, the number of hours prior to now to draw from the news database to tweet from
-    news_refresh_period : A float, the period in hours between refreshing the news database
-    lag_minutes : A string, the number of minutes of lag to call NewsAPI since the most recent article in the database
-
-    qaly_thresh : A float, threshold on qalys to tweet
-    sample_log_qalys : A bool, sample the qalys in log-space
+    news_refresh_period : A float, the longest period in hours between polls of a source, however quiet
     dbg_mode : A bool, if True enter debug mode
-    """
-
-    create_str = '''CREATE TABLE IF NOT EXISTS news (
-                    url TEXT PRIMARY KEY,
-                    score REAL NOT NULL,
-                    topics TEXT,
-                    published_at DATETIME,
-                    source TEXT
-                    )
-                '''
+    lag_minutes : A string, the number of minutes of lag to call NewsAPI since the most recent article of each source
+    cache_filename : A string, the name of the article cache database
+    hot_days : A float, after a refresh, articles published more than hot_days ago are moved into monthly archives
+               (see archive_and_back_up). None keeps all articles in the news database
+    compare_qaly_paths : A list of strings, paths of alternative QALY tables to also score new articles against (see
+                         get_articles.get_many_results)
+    queue_filename : A string, the name of a job queue database. If given, new articles are queued for worker
+                     processes (see job_queue) to fetch and score, and this process only writes their results
 
-    is_first_time_setup = create_db(db_filename, create_str)
+    Returns
+    --------------
+    refreshed : A bool, True if NewsAPI was queried
+    """
+    is_first_time_setup = create_db(db_filename, news_create_str)
 
     if is_first_time_setup:
+        started_at = datetime.datetime.now()
         if dbg_mode:
             print('DBG MODE')
             get_articles.get_many_results(api_key, db_filename, qaly_path, url_path, page_limit_per_request=1,
-                                          results_per_page=10)
+                                          results_per_page=10, cache_filename=cache_filename,
+                                          compare_qaly_paths=compare_qaly_paths, queue_filename=queue_filename)
+            if queue_filename is not None:
+                job_queue.drain(queue_filename, db_filename, qaly_path, compare_qaly_paths=compare_qaly_paths)
         else:
             print('Building database. This may take some time...')
-            get_articles.get_many_results(api_key, db_filename, qaly_path, url_path)
-            os.system("cp {0} {0}.bckup".format(db_filename))
-
-    # Check if the news database is out of date, TODO: handle the case when database exists but is empty
-    last_article_publish_time = get_articles.find_newest_db_article(db_filename, lag_minutes=0)
-    last_article_publish_time_dtm = datetime.datetime.strptime(last_article_publish_time, dt_format)
-    query_db_from = datetime.datetime.now() - datetime.timedelta(hours=tweet_time_window)
-    delta = datetime.datetime.now() - last_article_publish_time_dtm
+            with metrics.timer('refresh_seconds'), metrics.profiled('refresh'):
+                get_articles.get_many_results(api_key, db_filename, qaly_path, url_path,
+                                              cache_filename=cache_filename, compare_qaly_paths=compare_qaly_paths,
+                                              queue_filename=queue_filename)
+                if queue_filename is not None:
+                    job_queue.drain(queue_filename, db_filename, qaly_path, compare_qaly_paths=compare_qaly_paths)
+            archive_and_back_up(db_filename, hot_days=hot_days)
+        scheduler.record_poll(db_filename, get_source_registry(url_path).source_ids(), started_at)
+        return True
 
-    hours_since_last_article = delta.days*24.0 + delta.seconds/3600.0
     if not dbg_mode:
-        if hours_since_last_article > news_refresh_period:
-            print('Last published article: {}'.format(last_article_publish_time))
-            print('Time difference to now: {} (hours)'.format(hours_since_last_article))
-            print('News db outdated. Updating...')
-            query_from = get_articles.find_newest_db_article(db_filename, lag_minutes=lag_minutes)
-            get_articles.get_many_results(api_key, db_filename, qaly_path, url_path, query_from=query_from)
-            os.system("cp {0} {0}.bckup".format(db_filename))
+        if queue_filename is not None:  # results left by an earlier refresh, without waiting for the workers
+            job_queue.drain(queue_filename, db_filename, qaly_path, compare_qaly_paths=compare_qaly_paths, timeout_s=0)
+        # Poll only the sources which are due, each from its own high-water mark
+        source_ids = get_source_registry(url_path).source_ids()
+        groups = scheduler.due_groups(db_filename, source_ids, news_refresh_period, lag_minutes=lag_minutes)
+        if groups:
+            print('News db outdated for {} sources. Updating...'.format(sum(len(group) for _, group in groups)))
+            with metrics.timer('refresh_seconds'), metrics.profiled('refresh'):
+                # A poll interrupted longer ago than this has been superseded, see get_articles.load_checkpoint
+                scheduler.poll(api_key, db_filename, qaly_path, url_path, groups, cache_filename=cache_filename,
+                               compare_qaly_paths=compare_qaly_paths, queue_filename=queue_filename,
+                               max_age_h=news_refresh_period)
+            archive_and_back_up(db_filename, hot_days=hot_days)
+            return True
     else:
         print('DBG: Skipping time window check')
+    return False
+
+
+def tweet_from_db(tweepyapi, db_filename, tweet_time_window, qaly_thresh=1.0, sample_log_qalys=True):
+    """Tweet a single news story from the news database drawn randomly, weighted by a QALY, over a time window
+    extending into the past
+
+    Parameters
+    --------------
+    tweepyapi : tweepy.api.API object, contains Twitter API credentials and allows tweeting
+    db_filename : A string, the name of the news database
+    tweet_time_window : A float, the number of hours prior to now to draw from the news database to tweet from
+    qaly_thresh : A float, threshold on qalys to tweet
+    sample_log_qalys : A bool, sample the qalys in log-space
+    """
+    with metrics.timer('tweet_seconds'):
+        query_db_from = datetime.datetime.now() - datetime.timedelta(hours=tweet_time_window)
+
+        # Bring the sampler of articles within the tweet time window up to date
+        sampler = news_sampler.get_news_sampler(db_filename, sample_log_qalys=sample_log_qalys)
+        sampler.sync(query_db_from)
 
-    # Pull articles that are within the tweet time window
-    recent_news = fetch_news_since(db_filename, query_db_from)
+        qaly_total = sampler.score_total
+        if qaly_total < qaly_thresh:  # there aren't enough newsworthy stories
+            _ = tweepyapi.update_status("I didn't find anything interesting in the past {0} hrs, at: {1}".format(
+                tweet_time_window, str(datetime.datetime.now())))
+            metrics.inc('tweets_total')
+            print('No news\n')
+            return
 
-    qalys_scores = np.array([a[1] for a in recent_news])
-    qaly_total = qalys_scores.sum()
-    if qaly_total < qaly_thresh:  # there aren't enough newsworthy stories
-        _ = tweepyapi.update_status("I didn't find anything interesting in the past {0} hrs, at: {1}".format(
-            tweet_time_window, str(datetime.datetime.now())))
-        print('No news\n')
-        return
+        # Sample articles according to score (in log-space if sample_log_qalys), and read only the chosen one
+        url = sampler.sample()
+        conn = news_db.connect(db_filename)
+        topics = '; '.join(news_db.get_article_topics(conn, [url]).get(url, []))
+        if not topics:  # articles without topic rows, e.g. scored before the join table, keep the stored topic string
+            topics = conn.execute('SELECT topics FROM news WHERE url=?', (url,)).fetchone()[0]
 
-    # Sample articles according to score
-    if sample_log_qalys:
-        qalys_scores = np.log(qalys_scores + 1.0)  # sample qalys in log-space
+        # Tweet
+        _ = tweepyapi.update_status(topics + ' {}'.format(str(datetime.datetime.now())) + '\n' + url)
+        metrics.inc('tweets_total')
 
-    # Tweet
-    article_choice_index = np.random.choice(len(qalys_scores), p=qalys_scores/qalys_scores.sum())
-    url = recent_news[article_choice_index][0]
-    topics = recent_news[article_choice_index][2]
-    _ = tweepyapi.update_status(topics + ' {}'.format(str(datetime.datetime.now())) + '\n' + url)
+        print('Tweet!')
 
-    print('Tweet!')
+
+def tweet_news(tweepyapi, api_key, qaly_path, url_path, db_filename, tweet_time_window,
+               news_refresh_period, qaly_thresh=1.0, sample_log_qalys=True, dbg_mode=False, lag_minutes=20,
+               cache_filename='article_cache.db', hot_days=None, compare_qaly_paths=(), queue_filename=None):
+    """Tweet a single news story drawn randomly, weighted by a QALY, over a time window extending into the past
+
+    Parameters
+    --------------
+    tweepyapi : tweepy.api.API object, contains Twitter API credentials and allows tweeting
+    api_key : A string, the API key of the news API
+    qaly_path : A string, directory of the QALY table
+    url_path : A string, the directory of the URL lookup table for news sources
+    db_filename : A string, the name of the news database
+    tweet_time_window : A float, the number of hours prior to now to draw from the news database to tweet from
+    news_refresh_period : A float, the longest period in hours between polls of a source, see refresh_news
+    lag_minutes : A string, the number of minutes of lag to call NewsAPI since the most recent article of each source
+
+    qaly_thresh : A float, threshold on qalys to tweet
+    sample_log_qalys : A bool, sample the qalys in log-space
+    dbg_mode : A bool, if True enter debug mode
+    cache_filename : A string, the name of the article cache database
+    hot_days : A float, see refresh_news
+    compare_qaly_paths : A list of strings, see refresh_news
+    queue_filename : A string, see refresh_news
+    """
+    refresh_news(api_key, qaly_path, url_path, db_filename, news_refresh_period, dbg_mode=dbg_mode,
+                 lag_minutes=lag_minutes, cache_filename=cache_filename, hot_days=hot_days,
+                 compare_qaly_paths=compare_qaly_paths, queue_filename=queue_filename)
+    tweet_from_db(tweepyapi, db_filename, tweet_time_window, qaly_thresh=qaly_thresh,
+                  sample_log_qalys=sample_log_qalys)